@@ -0,0 +1,321 @@
+"""Пересчет архива образцов по частям с ограниченной памятью.
+
+The archive (CSV, Excel, Parquet or a cohort_store directory) is read in
+fixed-size chunks; each chunk
+goes through ratios, z-scores, banding and the disease models (score_cohort)
+and its result tables are spilled to disk as one part file per table
+(Parquet when pyarrow is available, CSV otherwise). Only one chunk is in
+memory at a time. The chunk size is derived from a memory budget by scoring
+a small calibration sample under tracemalloc. A manifest records the
+completed chunks, so an interrupted run resumes after the last one; a
+changed archive, reference (Params_metaboscan, Ref_stats) or dedupe option
+starts the run over.
+
+Usage:
+    python archive_scoring.py archive.csv --ref Ref.xlsx --out archive_scores --max-memory-mb 512
+    python archive_scoring.py archive.csv --out archive_scores --restart
+    python archive_scoring.py archive.cohort --ref Ref_v2.xlsx --out scores_v2
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+import tracemalloc
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from cohort import CohortMatrix
+from cohort_store import is_cohort_store, open_cohort, values_path
+from scoring_core import calculate_cohort_ratios, read_ref_stats, score_cohort
+
+RESULT_TABLES = ("risk_scores", "category_scores", "zscores", "legacy_scores")
+MANIFEST_NAME = "manifest.json"
+
+DEFAULT_MAX_MEMORY_MB = 512
+CALIBRATION_ROWS = 256
+MIN_CHUNK_ROWS = 64
+# Headroom over the traced peak: allocator slack and untraced buffers
+MEMORY_SAFETY_FACTOR = 2.0
+
+
+def _spill_format():
+    try:
+        import pyarrow  # noqa: F401
+        return "parquet"
+    except ImportError:
+        return "csv"
+
+
+def _csv_chunks(path, chunk_rows, skip_rows):
+    yield from pd.read_csv(path, chunksize=chunk_rows, skiprows=range(1, skip_rows + 1))
+
+
+def _excel_chunks(path, chunk_rows, skip_rows):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows)
+        rows = islice(rows, skip_rows, None)
+        while block := list(islice(rows, chunk_rows)):
+            yield pd.DataFrame(block, columns=header).infer_objects()
+    finally:
+        workbook.close()
+
+
+def _parquet_chunks(path, chunk_rows, skip_rows):
+    import pyarrow.parquet as pq
+
+    skipped = 0
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+        if skipped < skip_rows:
+            skipped += batch.num_rows
+            continue
+        yield batch.to_pandas()
+
+
+def _store_chunks(path, chunk_rows, skip_rows):
+    cohort = open_cohort(path)
+    for start in range(skip_rows, len(cohort), chunk_rows):
+        yield cohort.select_rows(np.arange(start, min(start + chunk_rows, len(cohort))))
+
+
+def read_chunks(path, chunk_rows, skip_rows=0):
+    """DataFrames (CohortMatrix for a cohort store) of up to chunk_rows samples, after skip_rows"""
+    if is_cohort_store(path):
+        return _store_chunks(path, chunk_rows, skip_rows)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        return _csv_chunks(path, chunk_rows, skip_rows)
+    if extension in (".xlsx", ".xlsm"):
+        return _excel_chunks(path, chunk_rows, skip_rows)
+    if extension == ".parquet":
+        return _parquet_chunks(path, chunk_rows, skip_rows)
+    raise ValueError(f"Unsupported archive format: {path}")
+
+
+def score_chunk(frame, risk_params, ref_stats, **dedupe):
+    """Ratios and all scores of one chunk; tables come back with the sample id as a column.
+
+    A CohortMatrix chunk comes from a cohort store and already holds the ratios.
+    """
+    if isinstance(frame, CohortMatrix):
+        cohort = frame
+    else:
+        cohort = calculate_cohort_ratios(CohortMatrix.from_frame(frame, dtype=np.float64))
+    results = score_cohort(cohort, risk_params, ref_stats, **dedupe)
+    return {
+        key: table.reset_index() if table.index.name is not None else table
+        for key, table in results.items()
+    }
+
+
+def calibrate_chunk_rows(sample, risk_params, ref_stats, max_memory_mb):
+    """Chunk size that keeps the traced working set of one chunk within the budget"""
+    head = sample.select_rows([0, 1][:len(sample)]) if isinstance(sample, CohortMatrix) else sample.iloc[:2]
+    score_chunk(head, risk_params, ref_stats)  # load pipelines outside the trace
+    # main may already trace the whole run (no resource module): measure over what is held
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    try:
+        score_chunk(sample, risk_params, ref_stats)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    bytes_per_sample = max(peak - held, 1) * MEMORY_SAFETY_FACTOR / len(sample)
+    return max(MIN_CHUNK_ROWS, int(max_memory_mb * 2**20 / bytes_per_sample))
+
+
+def _source_fingerprint(path):
+    stat = os.stat(values_path(path) if is_cohort_store(path) else path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _settings_fingerprint(risk_params, ref_stats, dedupe):
+    """SHA-256 of everything besides the archive that the scores depend on"""
+    digest = hashlib.sha256()
+    for frame in (risk_params, ref_stats):
+        digest.update(frame.to_csv().encode("utf-8"))
+    digest.update(json.dumps(dedupe, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class SpillStore:
+    """Per-table part files plus a manifest of completed chunks in one directory"""
+
+    def __init__(self, out_dir, fmt=None):
+        self.out_dir = out_dir
+        self.fmt = fmt or _spill_format()
+        self.manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def part_path(self, key, chunk_index, fmt=None):
+        return os.path.join(self.out_dir, key, f"part-{chunk_index:05d}.{fmt or self.fmt}")
+
+    def clear(self):
+        """Remove parts and manifest of a previous run"""
+        for key in RESULT_TABLES:
+            for path in glob.glob(os.path.join(self.out_dir, key, "part-*")):
+                os.remove(path)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    def write_chunk(self, chunk_index, tables):
+        """Write every table of a chunk; each part appears atomically"""
+        for key in RESULT_TABLES:
+            path = self.part_path(key, chunk_index)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            table = tables[key].rename(columns=str)
+            if self.fmt == "parquet":
+                table.to_parquet(tmp_path, index=False)
+            else:
+                table.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, path)
+
+    def iter_table(self, key, fmt=None):
+        """Parts of one result table in chunk order"""
+        fmt = fmt or self.fmt
+        for path in sorted(glob.glob(os.path.join(self.out_dir, key, f"part-*.{fmt}"))):
+            yield pd.read_parquet(path) if fmt == "parquet" else pd.read_csv(path)
+
+    def read_table(self, key):
+        """Whole result table; only for results that fit in memory"""
+        fmt = (self.load_manifest() or {}).get("format", self.fmt)
+        parts = list(self.iter_table(key, fmt))
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+
+def score_archive(path, risk_params, ref_stats, out_dir, max_memory_mb=DEFAULT_MAX_MEMORY_MB,
+                  chunk_rows=None, restart=False, **dedupe):
+    """Score an archive chunk by chunk into out_dir; resumes unless restart is set.
+
+    dedupe (dedupe/rtol/atol) is passed to score_cohort; duplicates are found within a chunk.
+    Returns the final manifest.
+    """
+    store = SpillStore(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    fingerprint = _source_fingerprint(path)
+    settings = _settings_fingerprint(risk_params, ref_stats, dedupe)
+
+    manifest = None if restart else store.load_manifest()
+    if manifest is not None and manifest["source"] != fingerprint:
+        print(f"Archive changed since the previous run in {out_dir}, starting over")
+        manifest = None
+    if manifest is not None and manifest.get("settings") != settings:
+        print(f"Reference or dedupe options differ from the previous run in {out_dir}, starting over")
+        manifest = None
+    if manifest is not None and manifest["format"] != store.fmt:
+        print(f"Previous run in {out_dir} was written as {manifest['format']}, starting over")
+        manifest = None
+
+    if manifest is None:
+        store.clear()
+        if chunk_rows is None:
+            sample = next(read_chunks(path, CALIBRATION_ROWS), None)
+            if sample is None or len(sample) == 0:
+                print(f"Archive {path} has no samples")
+                return None
+            chunk_rows = calibrate_chunk_rows(sample, risk_params, ref_stats, max_memory_mb)
+        manifest = {
+            "source": fingerprint,
+            "settings": settings,
+            "format": store.fmt,
+            "chunk_rows": int(chunk_rows),
+            "max_memory_mb": max_memory_mb,
+            "completed_chunks": 0,
+            "rows": 0,
+            "finished": False,
+        }
+        store.save_manifest(manifest)
+    elif manifest["finished"]:
+        print(f"Archive already scored: {manifest['rows']} samples in {out_dir}")
+        return manifest
+    else:
+        print(f"Resuming after chunk {manifest['completed_chunks']} ({manifest['rows']} samples done)")
+
+    chunk_rows = manifest["chunk_rows"]
+    chunk_index = manifest["completed_chunks"]
+    for frame in read_chunks(path, chunk_rows, skip_rows=manifest["rows"]):
+        start = time.perf_counter()
+        store.write_chunk(chunk_index, score_chunk(frame, risk_params, ref_stats, **dedupe))
+        chunk_index += 1
+        manifest.update(completed_chunks=chunk_index, rows=manifest["rows"] + len(frame))
+        store.save_manifest(manifest)
+        print(f"Chunk {chunk_index}: {len(frame)} samples in {time.perf_counter() - start:.1f}s "
+              f"({manifest['rows']} total)")
+        del frame
+
+    manifest["finished"] = True
+    store.save_manifest(manifest)
+    return manifest
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (Linux reports KiB); None without the resource module"""
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def peak_memory_text():
+    """Peak RSS, or the tracemalloc peak of the run where RSS is not available (Windows)"""
+    rss = peak_rss_mb()
+    if rss is not None:
+        return f"peak RSS {rss:.0f} MB"
+    if tracemalloc.is_tracing():
+        return f"traced peak {tracemalloc.get_traced_memory()[1] / 2**20:.0f} MB"
+    return "peak memory unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a large sample archive in chunks")
+    parser.add_argument("archive", help="CSV, Excel or Parquet file (one sample per row) or a cohort store")
+    parser.add_argument("--ref", default="Ref.xlsx", help="Reference workbook (Params_metaboscan, Ref_stats)")
+    parser.add_argument("--out", default="archive_scores", help="Output directory for parts and manifest")
+    parser.add_argument("--max-memory-mb", type=float, default=DEFAULT_MAX_MEMORY_MB,
+                        help="Working-set budget for one chunk")
+    parser.add_argument("--chunk-rows", type=int, help="Fixed chunk size instead of calibrating")
+    parser.add_argument("--dedupe", action="store_true", help="Score identical sample rows once")
+    parser.add_argument("--rtol", type=float, help="Also merge replicates within this relative tolerance")
+    parser.add_argument("--restart", action="store_true", help="Ignore a previous partial run")
+    args = parser.parse_args()
+
+    risk_params = pd.read_excel(args.ref, sheet_name="Params_metaboscan")
+    ref_stats = read_ref_stats(args.ref, sheet_name="Ref_stats")
+
+    if peak_rss_mb() is None:
+        tracemalloc.start()
+    start = time.perf_counter()
+    manifest = score_archive(args.archive, risk_params, ref_stats, args.out,
+                             max_memory_mb=args.max_memory_mb, chunk_rows=args.chunk_rows,
+                             restart=args.restart, dedupe=args.dedupe, rtol=args.rtol)
+    if manifest is not None:
+        print(f"Scored {manifest['rows']} samples in {time.perf_counter() - start:.1f}s, "
+              f"chunk size {manifest['chunk_rows']}, {peak_memory_text()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Дисковый кэш отрисованных графиков, общий для сессий и пакетных отчетов.
+
+Rendered PNG bytes are stored under a content key: a SHA-256 of everything
+that determines the picture (panel title, bars, values, colours, norm band
+and render settings, see plot_utilit.cached_chart_uri). Any process that
+asks for the same chart — another Streamlit session, a patient_report
+worker — reads the file instead of running matplotlib. Files are written
+atomically; the total size is capped and the least recently used files
+(by mtime, refreshed on every hit) are evicted first.
+
+Settings: METABOSCAN_CHART_CACHE (directory), METABOSCAN_CHART_CACHE_MB
+(size cap, 0 disables the cache).
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from metrics import cache_lookup
+
+DEFAULT_DIR = os.environ.get("METABOSCAN_CHART_CACHE") or os.path.join(
+    tempfile.gettempdir(), "metaboscan_charts")
+DEFAULT_MAX_MB = float(os.environ.get("METABOSCAN_CHART_CACHE_MB", 512))
+# Eviction goes below the cap so that not every following write triggers a scan
+EVICT_TO_SHARE = 0.8
+CHART_SUFFIX = ".png"
+
+
+def content_key(payload):
+    """SHA-256 of a JSON-serialisable description of the chart"""
+    text = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ChartCache:
+    """PNG bytes by content key in a directory shared between processes"""
+
+    def __init__(self, directory=DEFAULT_DIR, max_bytes=DEFAULT_MAX_MB * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._total = None  # estimate of the bytes on disk, refreshed by every scan
+        self._lock = threading.Lock()  # sessions of one Streamlit process share the cache
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + CHART_SUFFIX)
+
+    def get(self, key):
+        """Cached bytes, or None; a hit marks the file as recently used"""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            cache_lookup("charts", False)
+            return None
+        cache_lookup("charts", True)
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique temp file per writer: threads of one process share the PID
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, size, _ in self._files())
+            else:
+                self._total += len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _files(self):
+        """(path, size, mtime) of every cached chart"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(CHART_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another process meanwhile
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def evict(self):
+        """Remove least recently used charts until the total is under the cap; returns the count"""
+        with self._lock:
+            return self._evict()
+
+    def _evict(self):
+        files = sorted(self._files(), key=lambda item: item[2])
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * EVICT_TO_SHARE
+        removed = 0
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._total = total
+        return removed
+
+
+_default_cache = None
+
+
+def default_cache():
+    """Process-wide cache from the environment settings; None when disabled"""
+    global _default_cache
+    if DEFAULT_MAX_MB <= 0:
+        return None
+    if _default_cache is None:
+        _default_cache = ChartCache()
+    return _default_cache
@@ -0,0 +1,122 @@
+"""Панели графиков z-score: описание из данных и расчет одним проходом.
+
+Panels (title, metabolites, norm band) are read once from chart_panels.json,
+so adding a panel is a data change. ``evaluate_panels`` computes z-scores,
+bar colours and the "<" highlighting for every panel and every sample in one
+vectorised pass against reference arrays compiled from ref_stats; drawing
+(plot_utilit.panel_figure) only reads the precomputed arrays.
+"""
+import json
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+CHART_PANELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chart_panels.json")
+
+# Bar colours by |z|: normal, moderate (> 1), significant (> 2)
+Z_COLORS = np.array(["#10b981", "#feb61d", "#dc2626"], dtype=object)
+
+
+@dataclass(frozen=True)
+class ChartPanel:
+    title: str
+    metabolites: tuple
+    norm: tuple = (-1, 1)
+
+
+@lru_cache(maxsize=None)
+def load_chart_panels(path=CHART_PANELS_PATH):
+    """Panel definitions in display order, read once per path"""
+    with open(path, encoding="utf-8") as f:
+        return tuple(
+            ChartPanel(
+                title=panel["title"],
+                metabolites=tuple(panel["metabolites"]),
+                norm=tuple(panel.get("norm", (-1, 1))),
+            )
+            for panel in json.load(f)
+        )
+
+
+@dataclass(frozen=True)
+class ChartReference:
+    """ref_stats of a list of metabolites as arrays"""
+    names: tuple
+    has_reference: np.ndarray  # mean and sd present
+    mean: np.ndarray
+    sd: np.ndarray
+    upper_only: np.ndarray     # norm like "< x": values below the mean count as normal
+    display_names: tuple       # name_short_view, or the name itself
+    missing_names: tuple       # name_view for the "Missing data" note
+
+
+def compile_reference(names, ref_stats):
+    """Reference arrays for names from the create_ref_stats_from_excel dict"""
+    names = tuple(names)
+    entries = [ref_stats.get(name, {}) for name in names]
+    has_reference = np.array(["mean" in entry and "sd" in entry for entry in entries], dtype=bool)
+    return ChartReference(
+        names=names,
+        has_reference=has_reference,
+        mean=np.array([entry.get("mean", np.nan) for entry in entries], dtype=np.float64),
+        sd=np.array([entry.get("sd", np.nan) for entry in entries], dtype=np.float64),
+        upper_only=np.array([
+            isinstance(entry.get("norm"), str) and "<" in entry["norm"] for entry in entries
+        ], dtype=bool),
+        display_names=tuple(entry.get("name_short_view", name) for name, entry in zip(names, entries)),
+        missing_names=tuple(entry.get("name_view", name) for name, entry in zip(names, entries)),
+    )
+
+
+def zscore_arrays(concentrations, reference):
+    """Samples x metabolites z-scores (2 decimals), colours and "<" highlight mask"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z_scores = np.round((concentrations - reference.mean) / reference.sd, 2)
+    highlighted = reference.upper_only & (z_scores <= 0)
+    z_scores[highlighted] = 0
+    level = np.select([np.abs(z_scores) > 2, np.abs(z_scores) > 1], [2, 1], 0)
+    return z_scores, Z_COLORS[level], highlighted
+
+
+@dataclass(frozen=True)
+class PanelZScores:
+    """Precomputed chart data of one panel for a set of samples"""
+    panel: ChartPanel
+    display_names: tuple   # bars, in panel order
+    z_scores: np.ndarray   # samples x bars
+    colors: np.ndarray     # samples x bars
+    highlighted: np.ndarray
+    missing_names: tuple   # metabolites without reference or data
+
+    def sample(self, position):
+        """The same panel restricted to one sample (for handing to a worker)"""
+        rows = slice(position, position + 1)
+        return PanelZScores(self.panel, self.display_names, self.z_scores[rows],
+                            self.colors[rows], self.highlighted[rows], self.missing_names)
+
+
+def evaluate_panels(store, ref_stats, panels=None):
+    """Chart data of every panel for every sample of a ConcentrationStore, one pass"""
+    panels = load_chart_panels() if panels is None else panels
+    names = list(dict.fromkeys(name for panel in panels for name in panel.metabolites))
+    reference = compile_reference(names, ref_stats)
+    in_data = np.array([name in store.cohort for name in names], dtype=bool)
+    z_scores, colors, highlighted = zscore_arrays(store.cohort.take(names), reference)
+
+    column = {name: i for i, name in enumerate(names)}
+    evaluated = []
+    for panel in panels:
+        positions = np.array([column[name] for name in dict.fromkeys(panel.metabolites)], dtype=np.intp)
+        shown = positions[reference.has_reference[positions] & in_data[positions]]
+        hidden = positions[~(reference.has_reference[positions] & in_data[positions])]
+        evaluated.append(PanelZScores(
+            panel=panel,
+            display_names=tuple(reference.display_names[i] for i in shown),
+            z_scores=z_scores[:, shown],
+            colors=colors[:, shown],
+            highlighted=highlighted[:, shown],
+            missing_names=tuple(reference.missing_names[i] for i in hidden),
+        ))
+    return evaluated
@@ -0,0 +1,234 @@
+"""Компактная колоночная матрица пациентов.
+
+CohortMatrix is the internal data model passed between stages: one float32
+2-D array (samples x columns, column-major so every marker is contiguous),
+an immutable column index and a sample-id vector. Ratios, z-scores, banding
+and model inference read columns or rows from it as views, without building
+per-row pandas objects.
+"""
+import numpy as np
+import pandas as pd
+
+# Columns of an upload that identify the sample rather than hold a measurement
+ID_COLUMN = "Код"
+
+
+class CohortRow:
+    """Zero-copy view of one sample, with the bits of the pandas Series API the pipelines use"""
+
+    __slots__ = ("cohort", "position")
+
+    def __init__(self, cohort, position):
+        self.cohort = cohort
+        self.position = position
+
+    @property
+    def index(self):
+        return self.cohort.columns
+
+    @property
+    def name(self):
+        return self.cohort.sample_ids[self.position]
+
+    def to_numpy(self):
+        return self.cohort.values[self.position]
+
+    def __getitem__(self, name):
+        return self.cohort.values[self.position, self.cohort.position(name)]
+
+    def __contains__(self, name):
+        return name in self.cohort
+
+    def get(self, name, default=None):
+        if name not in self.cohort:
+            return default
+        return self[name]
+
+    def keys(self):
+        return self.cohort.columns
+
+    def items(self):
+        return zip(self.cohort.columns, self.to_numpy())
+
+
+class CohortMatrix:
+    """Float32 samples x columns matrix with immutable column index and sample ids"""
+
+    __slots__ = ("values", "columns", "sample_ids", "meta", "_positions")
+
+    def __init__(self, values, columns, sample_ids=None, meta=None, dtype=np.float32):
+        values = np.asarray(values, dtype=dtype, order="F")
+        if values.ndim != 2:
+            raise ValueError("CohortMatrix values must be 2-D")
+        columns = pd.Index(columns)
+        if len(columns) != values.shape[1]:
+            raise ValueError(f"{len(columns)} column names for {values.shape[1]} columns")
+        if not columns.is_unique:
+            raise ValueError("CohortMatrix columns must be unique")
+        if sample_ids is None:
+            sample_ids = np.arange(values.shape[0])
+        sample_ids = np.asarray(sample_ids, dtype=object)
+        if len(sample_ids) != values.shape[0]:
+            raise ValueError(f"{len(sample_ids)} sample ids for {values.shape[0]} rows")
+
+        values.flags.writeable = False
+        sample_ids.flags.writeable = False
+        self.values = values
+        self.columns = columns
+        self.sample_ids = sample_ids
+        self.meta = meta or {}
+        self._positions = {name: i for i, name in enumerate(columns)}
+
+    @classmethod
+    def from_frame(cls, df, id_column=ID_COLUMN, dtype=np.float32):
+        """Build from a patient table: numeric columns become the matrix, the rest metadata"""
+        if isinstance(df, cls):
+            return df
+        numeric = df.select_dtypes(include="number")
+        labels = {
+            name: df[name].to_numpy(dtype=object)
+            for name in df.columns.difference(numeric.columns, sort=False)
+        }
+        sample_ids = labels.get(id_column, df.index.to_numpy())
+        return cls(numeric.to_numpy(dtype=dtype), numeric.columns, sample_ids,
+                   meta={"labels": labels}, dtype=dtype)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __getitem__(self, name):
+        """Contiguous read-only view of one column"""
+        return self.values[:, self._positions[name]]
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes_per_sample(self):
+        return self.values.shape[1] * self.values.itemsize
+
+    def position(self, name):
+        return self._positions[name]
+
+    def positions(self, names):
+        """Integer positions of names, -1 for names not in the matrix"""
+        return self.columns.get_indexer(pd.Index(names))
+
+    def row(self, i):
+        return CohortRow(self, i)
+
+    def rows(self):
+        for i in range(len(self)):
+            yield CohortRow(self, i)
+
+    def select_rows(self, positions):
+        """New matrix with the given samples only, labels included"""
+        positions = np.asarray(positions, dtype=np.intp)
+        meta = dict(self.meta)
+        if "labels" in meta:
+            meta["labels"] = {name: labels[positions] for name, labels in meta["labels"].items()}
+        return CohortMatrix(self.values[positions], self.columns, self.sample_ids[positions],
+                            meta, dtype=self.values.dtype)
+
+    def take(self, names, fill=np.nan):
+        """Samples x names block (a copy); names missing from the matrix are filled"""
+        positions = self.positions(names)
+        block = np.take(self.values, np.maximum(positions, 0), axis=1)
+        block[:, positions < 0] = fill
+        return block
+
+    def with_columns(self, new_columns):
+        """New matrix with extra columns appended (existing names are not replaced)"""
+        names = [name for name in new_columns if name not in self._positions]
+        if not names:
+            return self
+        values = np.empty((len(self), len(self.columns) + len(names)),
+                          dtype=self.values.dtype, order="F")
+        values[:, :len(self.columns)] = self.values
+        for offset, name in enumerate(names, start=len(self.columns)):
+            values[:, offset] = new_columns[name]
+        return CohortMatrix(values, self.columns.append(pd.Index(names)),
+                            self.sample_ids, self.meta, dtype=self.values.dtype)
+
+    def to_frame(self):
+        """pandas view for code that still expects a DataFrame"""
+        return pd.DataFrame(self.values, columns=self.columns)
+
+
+class ConcentrationStore:
+    """Индекс концентраций образец x метаболит для графиков, строится один раз на загрузку.
+
+    Parsed like the old per-file safe_parse_metabolite_data: " Results" is
+    stripped from headers, decimal commas are accepted and missing or
+    unparseable values become 0. Text columns (id, group) stay labels.
+    Lookups by sample id or position are O(1); columns are contiguous views.
+    """
+
+    __slots__ = ("cohort", "_samples")
+
+    def __init__(self, cohort):
+        self.cohort = cohort
+        self._samples = {}
+        for position, sample_id in enumerate(cohort.sample_ids):
+            self._samples.setdefault(sample_id, position)
+
+    @classmethod
+    def from_frame(cls, df, id_column=ID_COLUMN):
+        columns, labels = {}, {}
+        for name in df.columns:
+            column = df[name]
+            clean_name = str(name).replace(" Results", "").strip()
+            if pd.api.types.is_numeric_dtype(column):
+                values = column.to_numpy(dtype=np.float64)
+            else:
+                values = pd.to_numeric(
+                    column.astype(str).str.replace(",", "."), errors="coerce"
+                ).to_numpy(dtype=np.float64)
+                if np.isnan(values).all() and column.notna().any():
+                    labels[clean_name] = column.to_numpy(dtype=object)
+                    continue
+            columns[clean_name] = np.where(np.isnan(values), 0.0, values)
+
+        sample_ids = labels.get(id_column, np.arange(len(df)))
+        values = np.column_stack(list(columns.values())) if columns else np.empty((len(df), 0))
+        cohort = CohortMatrix(values, list(columns), sample_ids,
+                              meta={"labels": labels}, dtype=np.float64)
+        return cls(cohort)
+
+    def __len__(self):
+        return len(self.cohort)
+
+    def __contains__(self, sample_id):
+        return sample_id in self._samples
+
+    @property
+    def sample_ids(self):
+        return self.cohort.sample_ids
+
+    def position(self, sample_id):
+        """Position of the first sample with this id"""
+        return self._samples[sample_id]
+
+    def row(self, position):
+        """Concentrations of one sample by position, as a read-only mapping"""
+        return self.cohort.row(position)
+
+    def sample(self, sample_id):
+        """Concentrations of one sample by id, as a read-only mapping"""
+        return self.cohort.row(self._samples[sample_id])
+
+    def column(self, name):
+        """One metabolite across all samples (a view)"""
+        return self.cohort[name]
+
+    def concentrations(self, position, names):
+        """name -> value for the names present, e.g. the metabolites of one chart panel"""
+        row = self.cohort.values[position]
+        return {
+            name: float(row[self.cohort.position(name)])
+            for name in names if name in self.cohort
+        }
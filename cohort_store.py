@@ -0,0 +1,156 @@
+"""Когорта на диске: memory-mapped матрица для повторных расчетов.
+
+A one-off import reads an archive (CSV, Excel or Parquet) chunk by chunk,
+computes the ratios and writes the ratio-augmented cohort into a directory
+(``<archive>.cohort``): ``values.npy`` holds the samples x columns matrix in
+column-major order, ``meta.json`` the column names, sample ids and text
+labels. ``open_cohort`` maps the matrix read-only into a CohortMatrix without
+reading it, so repeated scoring runs with other Ref.xlsx parameters, z-score
+recalculations and threshold sweeps start at once and the OS page cache
+serves every pass after the first.
+
+Usage:
+    python cohort_store.py archive.csv [--out archive.cohort] [--dtype float64]
+    python archive_scoring.py archive.cohort --ref Ref_v2.xlsx --out scores_v2
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from cohort import CohortMatrix
+
+STORE_SUFFIX = ".cohort"
+FORMAT_VERSION = 1
+VALUES_NAME = "values.npy"
+META_NAME = "meta.json"
+
+# Samples read, converted and copied at a time during import
+IMPORT_CHUNK_ROWS = 10000
+
+
+def store_path(archive_path):
+    """Default store directory of an archive file"""
+    return os.path.splitext(archive_path)[0] + STORE_SUFFIX
+
+
+def is_cohort_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_NAME))
+
+
+def values_path(path):
+    return os.path.join(path, VALUES_NAME)
+
+
+def _json_value(value):
+    """Sample ids and labels as JSON: numpy scalars unwrapped, NaN -> null"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def import_cohort(archive_path, out_dir=None, dtype=np.float32, chunk_rows=IMPORT_CHUNK_ROWS):
+    """Convert an archive into a cohort store; returns the store directory.
+
+    Ratios are computed in float64 per chunk, as archive_scoring does, and
+    stored as dtype. Columns come from the first chunk; a later chunk missing
+    one of them gets NaN there.
+    """
+    from archive_scoring import read_chunks
+    from scoring_core import calculate_cohort_ratios
+
+    out_dir = out_dir or store_path(archive_path)
+    dtype = np.dtype(dtype)
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    # Rows are appended row-major first: the number of samples is only known at the end
+    rows_path = os.path.join(tmp_dir, "rows.raw")
+    columns, sample_ids, labels = None, [], {}
+    n_samples = 0
+    with open(rows_path, "wb") as rows_file:
+        for frame in read_chunks(archive_path, chunk_rows):
+            cohort = calculate_cohort_ratios(CohortMatrix.from_frame(frame, dtype=np.float64))
+            if columns is None:
+                columns = cohort.columns
+                labels = {name: [] for name in cohort.meta.get("labels", {})}
+            rows_file.write(np.ascontiguousarray(cohort.take(columns), dtype=dtype).tobytes())
+            sample_ids.extend(map(_json_value, cohort.sample_ids))
+            chunk_labels = cohort.meta.get("labels", {})
+            for name, values in labels.items():
+                values.extend(map(_json_value, chunk_labels.get(name, [None] * len(cohort))))
+            n_samples += len(cohort)
+
+    if columns is None:
+        shutil.rmtree(tmp_dir)
+        raise ValueError(f"Archive {archive_path} has no samples")
+
+    # Column-major copy, so that every marker column is contiguous on disk
+    shape = (n_samples, len(columns))
+    rows = np.memmap(rows_path, dtype=dtype, mode="r", shape=shape)
+    values = np.lib.format.open_memmap(
+        values_path(tmp_dir), mode="w+", dtype=dtype, shape=shape, fortran_order=True)
+    for start in range(0, n_samples, chunk_rows):
+        values[start:start + chunk_rows] = rows[start:start + chunk_rows]
+    values.flush()
+    del values, rows
+    os.remove(rows_path)
+
+    stat = os.stat(archive_path)
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "source": {"path": os.path.abspath(archive_path), "size": stat.st_size, "mtime": stat.st_mtime},
+        "dtype": dtype.name,
+        "shape": list(shape),
+        "columns": [str(name) for name in columns],
+        "sample_ids": sample_ids,
+        "labels": labels,
+    }
+    with open(os.path.join(tmp_dir, META_NAME), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def open_cohort(path, mmap_mode="r"):
+    """CohortMatrix over the memory-mapped matrix of a store directory"""
+    with open(os.path.join(path, META_NAME), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported cohort store format {meta.get('format_version')} in {path}")
+    values = np.load(values_path(path), mmap_mode=mmap_mode)
+    labels = {name: np.asarray(column, dtype=object) for name, column in meta["labels"].items()}
+    return CohortMatrix(values, meta["columns"], meta["sample_ids"],
+                        meta={"labels": labels, "store": path}, dtype=values.dtype)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import an archive into a memory-mapped cohort store")
+    parser.add_argument("archive", help="CSV, Excel or Parquet file, one sample per row")
+    parser.add_argument("--out", help="Store directory (default: <archive>.cohort)")
+    parser.add_argument("--dtype", choices=("float32", "float64"), default="float32")
+    parser.add_argument("--chunk-rows", type=int, default=IMPORT_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    out_dir = import_cohort(args.archive, args.out, dtype=args.dtype, chunk_rows=args.chunk_rows)
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cohort = open_cohort(out_dir)
+    opened = time.perf_counter() - start
+    size_mb = os.path.getsize(values_path(out_dir)) / 2**20
+    print(f"Imported {cohort.shape[0]} samples x {cohort.shape[1]} columns into {out_dir} "
+          f"({size_mb:.1f} MB) in {elapsed:.1f}s; opens in {opened * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Измерение копирования данных между расчетом соотношений и моделями.
+
+Reports, per sample, the bytes copied when the ratio-augmented cohort is
+turned into model input: the cohort store itself (one float32 copy of the
+upload) and the input of every disease model, once with gathered copies
+(ZERO_COPY_INPUT off, the former behaviour) and once with FeatureView inputs.
+Allocations are traced with tracemalloc; the peak and the time of a full
+run_pipelines pass are shown for both modes.
+
+Usage:
+    python copy_budget.py data.xlsx
+    python copy_budget.py archive.csv --rows 2000
+"""
+import argparse
+import io
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+from cohort import CohortMatrix
+from models.base_pipeline import BaseDiseasePipeline
+from models.registry import registry
+from models.scheduler import run_pipelines
+from scoring_core import calculate_cohort_ratios
+
+
+def traced(func):
+    """(result, bytes still allocated, peak bytes) of a call"""
+    tracemalloc.start()
+    try:
+        result = func()
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, size, peak
+
+
+def load_cohort(path, rows=None):
+    """Ratio-augmented CohortMatrix of an upload and the bytes the store copy took"""
+    frame = pd.read_csv(path, nrows=rows) if path.lower().endswith(".csv") else pd.read_excel(path, nrows=rows)
+    cohort, size, _ = traced(lambda: calculate_cohort_ratios(CohortMatrix.from_frame(frame)))
+    return cohort, size
+
+
+def model_input_bytes(cohort, zero_copy):
+    """Bytes held by the inputs of every pipeline model for the whole cohort"""
+    BaseDiseasePipeline.ZERO_COPY_INPUT = zero_copy
+    total = 0
+    for disease_name in registry.specs():
+        pipeline = registry.get(disease_name)
+        for model in pipeline.models.values():
+            features = model.feature_names_in_
+            pipeline.feature_plan(features, cohort.columns)  # plans are cached, not per call
+            inputs, size, _ = traced(lambda: pipeline.preprocess_cohort(cohort, features))
+            total += size
+            del inputs
+    return total
+
+
+def pipelines_run(cohort, zero_copy):
+    """(peak traced bytes, seconds) of scoring the cohort with every pipeline"""
+    BaseDiseasePipeline.ZERO_COPY_INPUT = zero_copy
+    start = time.perf_counter()
+    _, _, peak = traced(lambda: run_pipelines(registry.factories(), cohort))
+    return peak, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure bytes copied per sample on the way to the models")
+    parser.add_argument("data", help="Upload (Excel) or archive (CSV), one sample per row")
+    parser.add_argument("--rows", type=int, help="Only the first N samples")
+    args = parser.parse_args()
+
+    with redirect_stdout(io.StringIO()):
+        for disease_name in registry.specs():
+            registry.get(disease_name)
+    cohort, store_bytes = load_cohort(args.data, args.rows)
+    n = len(cohort)
+    print(f"{n} samples x {cohort.shape[1]} columns, cohort store {store_bytes / n:,.0f} B/sample")
+
+    zero_copy = BaseDiseasePipeline.ZERO_COPY_INPUT
+    try:
+        for label, mode in (("gathered copies", False), ("feature views", True)):
+            input_bytes = model_input_bytes(cohort, mode)
+            with redirect_stdout(io.StringIO()):
+                peak, elapsed = pipelines_run(cohort, mode)
+            print(f"{label:>16}: model inputs {input_bytes / n:8,.0f} B/sample, "
+                  f"pipelines peak {peak / n:10,.0f} B/sample, {elapsed:.2f}s")
+    finally:
+        BaseDiseasePipeline.ZERO_COPY_INPUT = zero_copy
+
+
+if __name__ == "__main__":
+    main()
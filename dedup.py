@@ -0,0 +1,121 @@
+"""Поиск повторных образцов в когорте.
+
+QC plates and re-injections contain identical or nearly identical rows.
+``find_duplicates`` groups samples by their sanitised measurement row (ids and
+text labels are ignored), so the batch engine scores each unique row once and
+fans the result back out to every duplicate.
+
+Exact mode compares row bytes after the same clean-up the ratio step does
+(negatives -> 0) with NaN and -0.0 canonicalised. With ``rtol``/``atol`` set,
+a row within the tolerance of an earlier representative on every column
+(NaN and inf only matching themselves) is merged into its group as a technical replicate.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class DuplicateIndex:
+    """Representative sample per group and the group of every sample"""
+    representatives: np.ndarray  # positions of the samples that are scored, first-seen order
+    inverse: np.ndarray          # group of each sample, index into representatives
+
+    @property
+    def n_samples(self):
+        return len(self.inverse)
+
+    @property
+    def n_unique(self):
+        return len(self.representatives)
+
+    @property
+    def n_saved(self):
+        return self.n_samples - self.n_unique
+
+    def expand(self, values):
+        """Per-group rows (axis 0) back to one row per sample"""
+        return np.asarray(values)[self.inverse]
+
+    def summary(self):
+        share = self.n_saved / self.n_samples if self.n_samples else 0
+        return (f"{self.n_unique} unique of {self.n_samples} samples, "
+                f"{self.n_saved} duplicates scored once ({share:.0%} less scoring work)")
+
+
+def sanitized_values(cohort):
+    """Row-major copy of the measurements as they are scored, with canonical NaN and zero"""
+    values = np.maximum(cohort.values, 0) + 0.0  # negatives -> 0, -0.0 -> 0.0
+    values[np.isnan(values)] = np.nan
+    return np.ascontiguousarray(values)
+
+
+def _first_seen_order(first_positions, inverse):
+    """Renumber groups so that they follow the position of their first sample"""
+    order = np.argsort(first_positions, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return order, rank[inverse]
+
+
+def _exact_groups(values):
+    n_samples, n_columns = values.shape
+    if n_columns == 0:
+        return np.zeros(min(n_samples, 1), dtype=np.intp), np.zeros(n_samples, dtype=np.intp)
+    rows = values.view(np.dtype((np.void, values.dtype.itemsize * n_columns))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    order, inverse = _first_seen_order(first, inverse.ravel())
+    return first[order], inverse
+
+
+def _near_groups(values, rtol, atol):
+    """Greedy grouping in order of the row sum.
+
+    Rows within tolerance have row sums within n_columns*atol + rtol*sum|rep|,
+    so only representatives inside that window of the sorted sums are checked.
+    """
+    n_samples, n_columns = values.shape
+    # Non-finite cells (NaN, +inf, -inf from ratios) must match exactly
+    kind = np.select([np.isnan(values), values == np.inf, values == -np.inf], [1, 2, 3], 0)
+    filled = np.where(kind > 0, 0, values)
+    projection = filled.sum(axis=1)
+    abs_sum = np.abs(filled).sum(axis=1)
+
+    rep_positions = np.empty(n_samples, dtype=np.intp)
+    rep_projection = np.empty(n_samples)
+    n_reps = 0
+    group = np.empty(n_samples, dtype=np.intp)
+    max_abs_sum = 0.0
+    for i in np.argsort(projection, kind="stable"):
+        window = n_columns * atol + rtol * max(max_abs_sum, abs_sum[i])
+        start = np.searchsorted(rep_projection[:n_reps], projection[i] - window)
+        candidates = rep_positions[start:n_reps]
+        if len(candidates):
+            reps = filled[candidates]
+            close = (
+                (np.abs(filled[i] - reps) <= atol + rtol * np.abs(reps))
+                & (kind[i] == kind[candidates])
+            ).all(axis=1)
+            if close.any():
+                group[i] = start + np.flatnonzero(close)[0]
+                continue
+        group[i] = n_reps
+        rep_positions[n_reps] = i
+        rep_projection[n_reps] = projection[i]
+        n_reps += 1
+        max_abs_sum = max(max_abs_sum, abs_sum[i])
+
+    first = np.full(n_reps, n_samples, dtype=np.intp)
+    np.minimum.at(first, group, np.arange(n_samples))
+    order, inverse = _first_seen_order(first, group)
+    return rep_positions[:n_reps][order], inverse
+
+
+def find_duplicates(cohort, rtol=None, atol=0.0):
+    """DuplicateIndex of a CohortMatrix; exact byte-identical rows unless rtol/atol is given"""
+    values = sanitized_values(cohort)
+    if rtol is None and not atol:
+        representatives, inverse = _exact_groups(values)
+    else:
+        representatives, inverse = _near_groups(values, rtol or 0.0, atol)
+    return DuplicateIndex(representatives, inverse)
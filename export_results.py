@@ -0,0 +1,152 @@
+"""Выгрузка результатов когорты в Excel.
+
+Writes a multi-sheet workbook (risk scores, category scores, per-marker
+z-scores, legacy method) through openpyxl's write-only mode, which streams
+rows to disk instead of building the whole sheet in memory. CSV and Parquet
+companions are optional (Parquet needs pyarrow).
+
+Usage:
+    python export_results.py data.xlsx --ref Ref.xlsx --out results.xlsx [--csv] [--parquet]
+    python export_results.py --benchmark 10000
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from cohort import ID_COLUMN
+
+# Sheet name -> key of the score_cohort result
+SHEETS = {
+    "Риск-скор": "risk_scores",
+    "Категории (z-score)": "category_scores",
+    "Z-scores": "zscores",
+    "Старый метод": "legacy_scores",
+    "Дубликаты": "duplicates",
+}
+
+# Rows converted to Python objects at a time; bounds the extra memory per sheet
+CHUNK_ROWS = 2000
+
+
+def _sheet_frame(df):
+    """Wide tables keep their sample index as the first column"""
+    if df.index.name is not None:
+        return df.reset_index()
+    return df
+
+
+def _iter_rows(df, chunk_rows=CHUNK_ROWS):
+    """Rows as tuples with NaN/inf as empty cells, converted chunk by chunk"""
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].replace([np.inf, -np.inf], np.nan)
+        values = chunk.to_numpy(dtype=object)
+        values[chunk.isna().to_numpy()] = None
+        yield from map(tuple, values)
+
+
+def write_workbook(results, path):
+    """Stream all result sheets into one xlsx file"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for sheet_name, key in SHEETS.items():
+        if key not in results:
+            continue
+        df = _sheet_frame(results[key])
+        sheet = workbook.create_sheet(title=sheet_name)
+        sheet.append([str(column) for column in df.columns])
+        for row in _iter_rows(df):
+            sheet.append(row)
+    workbook.save(path)
+    return path
+
+
+def write_companions(results, path, csv=False, parquet=False):
+    """CSV/Parquet file per sheet next to the workbook"""
+    base = os.path.splitext(path)[0]
+    written = []
+    for key in SHEETS.values():
+        if key not in results:
+            continue
+        df = _sheet_frame(results[key])
+        if csv:
+            written.append(f"{base}_{key}.csv")
+            df.to_csv(written[-1], index=False)
+        if parquet:
+            written.append(f"{base}_{key}.parquet")
+            df.rename(columns=str).to_parquet(written[-1], index=False)
+    return written
+
+
+def export_results(results, path, csv=False, parquet=False):
+    """Workbook plus optional companions; returns (written paths, seconds)"""
+    start = time.perf_counter()
+    written = [write_workbook(results, path)]
+    written += write_companions(results, path, csv=csv, parquet=parquet)
+    return written, time.perf_counter() - start
+
+
+def synthetic_results(n_samples, n_groups=13, n_categories=34, n_markers=80, seed=0):
+    """Result tables of realistic shape for benchmarking the exporter"""
+    rng = np.random.default_rng(seed)
+    sample_ids = pd.Index([f"S{i:06d}" for i in range(n_samples)], name=ID_COLUMN)
+    risk_scores = pd.DataFrame({
+        ID_COLUMN: np.repeat(sample_ids.to_numpy(), n_groups),
+        "Группа риска": np.tile([f"Группа {j}" for j in range(n_groups)], n_samples),
+        "Риск-скор": rng.integers(0, 11, n_samples * n_groups).astype(float),
+        "Метод оценки": np.tile(["ML модель", "Параметры"], n_samples * n_groups // 2 + 1)[:n_samples * n_groups],
+    })
+
+    def wide(n_columns, prefix, scale):
+        values = rng.normal(0, scale, (n_samples, n_columns))
+        values[rng.random(values.shape) < 0.01] = np.nan
+        return pd.DataFrame(values, index=sample_ids, columns=[f"{prefix} {j}" for j in range(n_columns)])
+
+    return {
+        "risk_scores": risk_scores,
+        "category_scores": wide(n_categories, "Категория", 30),
+        "zscores": wide(n_markers, "Маркер", 1.5),
+        "legacy_scores": wide(n_categories, "Категория", 30),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export cohort results to Excel")
+    parser.add_argument("data", nargs="?", help="Metabolomic data (Excel), one sample per row, or a cohort store")
+    parser.add_argument("--ref", default="Ref.xlsx", help="Reference workbook (Params_metaboscan, Ref_stats)")
+    parser.add_argument("--out", default="results.xlsx")
+    parser.add_argument("--csv", action="store_true", help="Also write one CSV per sheet")
+    parser.add_argument("--parquet", action="store_true", help="Also write one Parquet file per sheet")
+    parser.add_argument("--dedupe", action="store_true", help="Score identical sample rows once")
+    parser.add_argument("--rtol", type=float, help="Also merge replicates within this relative tolerance")
+    parser.add_argument("--intervals", action="store_true",
+                        help="Add tree-vote probability and score intervals to the ML risk scores")
+    parser.add_argument("--benchmark", type=int, metavar="N", help="Export N synthetic samples and report the time")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        results = synthetic_results(args.benchmark)
+    elif args.data:
+        from cohort_store import is_cohort_store, open_cohort
+        from scoring_core import calculate_metabolite_ratios, read_ref_stats, score_cohort
+
+        data = open_cohort(args.data) if is_cohort_store(args.data) else calculate_metabolite_ratios(args.data)
+        risk_params = pd.read_excel(args.ref, sheet_name="Params_metaboscan")
+        ref_stats = read_ref_stats(args.ref, sheet_name="Ref_stats")
+        results = score_cohort(data, risk_params, ref_stats, dedupe=args.dedupe, rtol=args.rtol,
+                               intervals=args.intervals)
+    else:
+        parser.error("either a data file or --benchmark is required")
+
+    written, elapsed = export_results(results, args.out, csv=args.csv, parquet=args.parquet)
+    n_samples = len(results["zscores"])
+    print(f"Exported {n_samples} samples in {elapsed:.2f}s ({n_samples / elapsed:.0f} samples/s)")
+    for path in written:
+        print(f"  {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Измерение времени импорта ядра расчетов.
+
+Imports each core module in a fresh interpreter, reports the wall time and
+fails if it exceeds the budget or drags in plotting/UI packages.
+
+Usage:
+    python import_budget.py [--budget SECONDS] [--repeat N]
+"""
+import argparse
+import subprocess
+import sys
+
+# Modules that make up the scoring core
+CORE_MODULES = ["scoring_core", "models.base_pipeline"]
+
+# Packages the core must never import
+FORBIDDEN_MODULES = ["matplotlib", "seaborn", "streamlit"]
+
+# Import-time budget for the whole core, seconds (numpy + pandas dominate)
+IMPORT_BUDGET_SECONDS = 1.5
+
+_PROBE = """
+import sys, time
+start = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - start
+loaded = [m for m in {forbidden!r} if m in sys.modules]
+print(elapsed)
+print(",".join(loaded))
+"""
+
+
+def measure_import(modules=CORE_MODULES):
+    """Import time (s) of the modules in a fresh interpreter and forbidden packages it pulled in"""
+    probe = _PROBE.format(
+        imports="\n".join(f"import {module}" for module in modules),
+        forbidden=FORBIDDEN_MODULES,
+    )
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", probe],
+        check=True, capture_output=True, text=True,
+    ).stdout.splitlines()
+    loaded = [m for m in output[1].split(",") if m] if len(output) > 1 else []
+    return float(output[0]), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the scoring core import-time budget")
+    parser.add_argument("--budget", type=float, default=IMPORT_BUDGET_SECONDS)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    timings = []
+    loaded = []
+    for _ in range(args.repeat):
+        elapsed, loaded = measure_import()
+        timings.append(elapsed)
+    best = min(timings)
+
+    print(f"Core import time: best {best:.3f}s of {args.repeat}, budget {args.budget:.3f}s")
+    if loaded:
+        print(f"FAIL: core imported forbidden modules: {', '.join(loaded)}")
+        sys.exit(1)
+    if best > args.budget:
+        print("FAIL: import-time budget exceeded")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
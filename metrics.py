@@ -0,0 +1,260 @@
+"""Метрики расчетов в текстовом формате Prometheus.
+
+Counters, gauges and latency histograms kept in process memory: samples
+scored, scoring and ratio time, per-pipeline inference time, model load time,
+chart render time and cache hits/misses. ``render()`` produces the Prometheus
+text exposition format; it is served on a local HTTP endpoint
+(``start_http_server``) and/or written to a file periodically for the node
+exporter textfile collector (``start_textfile_writer``). Both are switched on
+by METABOSCAN_METRICS_PORT / METABOSCAN_METRICS_FILE via
+``configure_from_env``.
+
+Only the standard library is used, so the scoring core can import this module.
+Metrics are per process: renders in patient_report worker processes are not
+counted.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import ContextDecorator
+
+PREFIX = "metaboscan_"
+# Latency buckets, seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TEXTFILE_INTERVAL = 15.0
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels_text(self.labelnames, key)} {_number(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class _Timer(ContextDecorator):
+    """Observes the elapsed time of a with-block or a decorated call"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self._starts = threading.local()
+
+    def __enter__(self):
+        stack = getattr(self._starts, "stack", None)
+        if stack is None:
+            stack = self._starts.stack = []
+        stack.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self._starts.stack.pop(), **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Context manager / decorator timing a block into this histogram"""
+        return _Timer(self, labels)
+
+    def lines(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = _labels_text(self.labelnames, key, [("le", _number(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.setdefault(metric.name, metric)
+            return self._metrics[metric.name]
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.header() + metric.lines()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+SAMPLES_SCORED = REGISTRY.register(Counter(
+    "samples_scored_total", "Samples scored by score_cohort"))
+SCORING_SECONDS = REGISTRY.register(Histogram(
+    "score_cohort_seconds", "Wall time of one score_cohort call"))
+RATIO_SECONDS = REGISTRY.register(Histogram(
+    "ratio_seconds", "Ratio computation time per call", ("input",)))
+PIPELINE_SECONDS = REGISTRY.register(Histogram(
+    "pipeline_inference_seconds", "Inference time of one disease pipeline over a cohort", ("disease",)))
+MODEL_LOAD_SECONDS = REGISTRY.register(Histogram(
+    "model_load_seconds", "Time to create a pipeline instance and load its models", ("disease",)))
+CHART_RENDER_SECONDS = REGISTRY.register(Histogram(
+    "chart_render_seconds", "Chart drawing and PNG encoding time", ("stage",)))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "cache_requests_total", "Cache lookups by cache and result (hit/miss)", ("cache", "result")))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "watch_queue_depth", "Exports waiting in the watched folder"))
+
+
+def render():
+    return REGISTRY.render()
+
+
+def cache_lookup(cache, hit):
+    """Count one cache lookup; returns hit for chaining"""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+    return hit
+
+
+def write_textfile(path):
+    """Write the current metrics atomically (node exporter textfile collector)"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+    return path
+
+
+_started = {}
+_started_lock = threading.Lock()
+
+
+def start_textfile_writer(path, interval=TEXTFILE_INTERVAL):
+    """Rewrite the metrics file every interval seconds from a daemon thread (once per path)"""
+    with _started_lock:
+        if ("file", path) in _started:
+            return _started[("file", path)]
+
+        def loop():
+            while True:
+                try:
+                    write_textfile(path)
+                except OSError as e:
+                    print(f"Error writing metrics to {path}: {str(e)}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=loop, name="metrics-textfile", daemon=True)
+        thread.start()
+        _started[("file", path)] = thread
+        return thread
+
+
+def start_http_server(port, addr="127.0.0.1"):
+    """Serve GET /metrics on a local port from a daemon thread (once per port)"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    with _started_lock:
+        if ("http", port) in _started:
+            return _started[("http", port)]
+        server = ThreadingHTTPServer((addr, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+        thread.start()
+        _started[("http", port)] = server
+        return server
+
+
+def configure_from_env():
+    """Start the exporters requested by METABOSCAN_METRICS_PORT / METABOSCAN_METRICS_FILE"""
+    port = os.environ.get("METABOSCAN_METRICS_PORT")
+    path = os.environ.get("METABOSCAN_METRICS_FILE")
+    if port:
+        start_http_server(int(port))
+    if path:
+        start_textfile_writer(path)
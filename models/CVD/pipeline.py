@@ -2,6 +2,7 @@ from models.base_pipeline import BaseDiseasePipeline
 
 class CVDPipeline(BaseDiseasePipeline):
     DISEASE_NAME = "CVD"
+    RISK_GROUP = "Состояние сердечно-сосудистой системы"
     DEFAULT_THRESHOLD = 0.541
     
     def calculate_risk(self, row):
@@ -12,7 +13,7 @@ class CVDPipeline(BaseDiseasePipeline):
         pred_proba = model.predict_proba(X)[0][1]
         
         return {
-            "Группа риска": "Состояние сердечно-сосудистой системы",
+            "Группа риска": self.RISK_GROUP,
             "Риск-скор": self.probability_to_score(pred_proba, self.DEFAULT_THRESHOLD),
             "Метод оценки": "ML модель",
-        }
\ No newline at end of file
+        }
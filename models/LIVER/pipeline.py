@@ -2,6 +2,7 @@ from models.base_pipeline import BaseDiseasePipeline
 
 class LIVERPipeline(BaseDiseasePipeline):
     DISEASE_NAME = "LIVER"
+    RISK_GROUP = "Состояние функции печени"
     DEFAULT_THRESHOLD = 0.65
     
     def calculate_risk(self, row):
@@ -12,7 +13,7 @@ class LIVERPipeline(BaseDiseasePipeline):
         pred_proba = model.predict_proba(X)[0][1]
         
         return {
-            "Группа риска": "Состояние функции печени",
+            "Группа риска": self.RISK_GROUP,
             "Риск-скор": self.probability_to_score(pred_proba, self.DEFAULT_THRESHOLD),
             "Метод оценки": "ML модель",
-        }
\ No newline at end of file
+        }
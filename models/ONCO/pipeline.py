@@ -1,14 +1,20 @@
 from models.base_pipeline import BaseDiseasePipeline
+from models.explain import Contributions, forest_explainer
+from models.uncertainty import INTERVAL_PERCENTILES, interval_columns, tree_probabilities
+import numpy as np
 import os
-import glob
-import joblib
 
 class ONCOPipeline(BaseDiseasePipeline):
     DISEASE_NAME = "ONCO"
+    RISK_GROUP = "Оценка пролиферативных процессов"
+    ONCO_THRESHOLD = 0.62
+    LIVER_THRESHOLD = 0.64
+    # The liver model only sees samples at or above the onco threshold
+    THRESHOLD_GATES = {"LIVER_THRESHOLD": "ONCO_THRESHOLD"}
     
     def __init__(self):
-        self.onco_threshold = 0.62
-        self.liver_threshold = 0.64
+        self.onco_threshold = self.ONCO_THRESHOLD
+        self.liver_threshold = self.LIVER_THRESHOLD
         super().__init__()
     
     def load_models(self):
@@ -22,7 +28,7 @@ class ONCOPipeline(BaseDiseasePipeline):
                 f"Current working directory: {os.getcwd()}"
             )
         
-        model_files = glob.glob(os.path.join(model_dir, "*.pkl"))
+        model_files = self.model_files
         
         # Debug found files
         print(f"Found model files in {model_dir}: {model_files}")
@@ -42,10 +48,10 @@ class ONCOPipeline(BaseDiseasePipeline):
             try:
                 model_name = os.path.basename(model_file).lower()
                 if 'liver' in model_name:
-                    liver_model = joblib.load(model_file)
+                    liver_model = self.load_model_file(model_file)
                     print(f"Loaded liver model: {model_file}")
                 else:
-                    control_model = joblib.load(model_file)
+                    control_model = self.load_model_file(model_file)
                     print(f"Loaded control model: {model_file}")
             except Exception as e:
                 print(f"Error loading model {model_file}: {str(e)}")
@@ -62,6 +68,78 @@ class ONCOPipeline(BaseDiseasePipeline):
             'liver': liver_model
         }
     
+    def threshold_probabilities(self, cohort, per_tree=False):
+        """Both stages for every sample; the liver probability matters only past the onco threshold"""
+        control_model = self.models['control']
+        liver_model = self.models['liver']
+        X_control = self.preprocess_cohort(cohort, control_model.feature_names_in_)
+        X_liver = self.preprocess_cohort(cohort, liver_model.feature_names_in_)
+        if per_tree:
+            return {
+                "ONCO_THRESHOLD": tree_probabilities(control_model, X_control)[:, :, 0],
+                "LIVER_THRESHOLD": tree_probabilities(liver_model, X_liver)[:, :, 0],
+            }
+        return {
+            "ONCO_THRESHOLD": control_model.predict_proba(X_control)[:, 0],
+            "LIVER_THRESHOLD": liver_model.predict_proba(X_liver)[:, 0],
+        }
+    
+    def threshold_contributions(self, cohort):
+        control_model = self.models['control']
+        liver_model = self.models['liver']
+        X_control = self.preprocess_cohort(cohort, control_model.feature_names_in_)
+        X_liver = self.preprocess_cohort(cohort, liver_model.feature_names_in_)
+        return {
+            "ONCO_THRESHOLD": forest_explainer(control_model, 0).explain(X_control),
+            "LIVER_THRESHOLD": forest_explainer(liver_model, 0).explain(X_liver),
+        }
+    
+    def risk_contributions(self, cohort):
+        """Contributions of the stage that scores each sample, over the features of both models"""
+        contributions = self.threshold_contributions(cohort)
+        control = contributions["ONCO_THRESHOLD"]
+        liver = contributions["LIVER_THRESHOLD"]
+        control_model = self.models['control']
+        X_control = self.preprocess_cohort(cohort, control_model.feature_names_in_)
+        control_proba = control_model.predict_proba(X_control)[:, 0]
+        to_liver = ~(control_proba < self.onco_threshold)
+        
+        features = list(control.features) + [name for name in liver.features if name not in set(control.features)]
+        positions = {name: j for j, name in enumerate(features)}
+        values = np.zeros((len(to_liver), len(features)))
+        values[:, [positions[name] for name in control.features]] = control.values
+        values[to_liver] = 0
+        values[np.ix_(to_liver, [positions[name] for name in liver.features])] = liver.values[to_liver]
+        return Contributions(
+            features=np.asarray(features, dtype=object),
+            base=np.where(to_liver, liver.base, control.base),
+            values=values,
+        )
+    
+    def risk_intervals(self, cohort, percentiles=INTERVAL_PERCENTILES, method="bootstrap"):
+        """Interval of the stage that scores the sample: onco-control below the onco threshold, liver above"""
+        trees = self.threshold_probabilities(cohort, per_tree=True)
+        control = interval_columns(trees["ONCO_THRESHOLD"], self.score_mapping(self.onco_threshold),
+                                   percentiles, method)
+        liver = interval_columns(trees["LIVER_THRESHOLD"], self.score_mapping(self.liver_threshold),
+                                 percentiles, method)
+        to_liver = ~(control["Вероятность"] < self.onco_threshold)
+        columns = {name: np.where(to_liver, liver[name], control[name]) for name in control}
+        scores = np.where(
+            to_liver,
+            self.probability_to_score(liver["Вероятность"], self.liver_threshold),
+            self.probability_to_score(control["Вероятность"], self.onco_threshold),
+        )
+        return [
+            {
+                "Группа риска": self.RISK_GROUP,
+                "Риск-скор": score,
+                "Метод оценки": "onco-liver модель" if liver_stage else "onco-control модель",
+                **{name: values[i] for name, values in columns.items()},
+            }
+            for i, (score, liver_stage) in enumerate(zip(scores, to_liver))
+        ]
+    
     def calculate_risk(self, row):
         try:
             # First stage - control model
@@ -71,7 +149,7 @@ class ONCOPipeline(BaseDiseasePipeline):
             
             if control_proba < self.onco_threshold:
                 return {
-                    "Группа риска": "Оценка пролиферативных процессов",
+                    "Группа риска": self.RISK_GROUP,
                     "Риск-скор": self.probability_to_score(control_proba, self.onco_threshold),
                     "Метод оценки": "onco-control модель",
                 }
@@ -83,7 +161,7 @@ class ONCOPipeline(BaseDiseasePipeline):
             liver_proba = liver_model.predict_proba(X_liver)[0][0]
             
             return {
-                "Группа риска": "Оценка пролиферативных процессов",
+                "Группа риска": self.RISK_GROUP,
                 "Риск-скор": self.probability_to_score(liver_proba, self.liver_threshold),
                 "Метод оценки": "onco-liver модель",
             }
@@ -91,7 +169,31 @@ class ONCOPipeline(BaseDiseasePipeline):
         except Exception as e:
             print(f"Prediction error: {str(e)}")
             return {
-                "Группа риска": "Оценка пролиферативных процессов",
+                "Группа риска": self.RISK_GROUP,
                 "Риск-скор": None,
                 "Метод оценки": f"ML модель (ошибка: {str(e)})",
             }
+    
+    def calculate_risk_batch(self, cohort):
+        # First stage - control model for every sample
+        control_model = self.models['control']
+        X_control = self.preprocess_cohort(cohort, control_model.feature_names_in_)
+        control_proba = control_model.predict_proba(X_control)[:, 0]
+        scores = self.probability_to_score(control_proba, self.onco_threshold)
+        to_liver = ~(control_proba < self.onco_threshold)
+        
+        # Second stage - liver model only for samples above the onco threshold
+        if to_liver.any():
+            liver_model = self.models['liver']
+            X_liver = self.preprocess_cohort(cohort, liver_model.feature_names_in_)[to_liver]
+            liver_proba = liver_model.predict_proba(X_liver)[:, 0]
+            scores[to_liver] = self.probability_to_score(liver_proba, self.liver_threshold)
+        
+        return [
+            {
+                "Группа риска": self.RISK_GROUP,
+                "Риск-скор": score,
+                "Метод оценки": "onco-liver модель" if liver else "onco-control модель",
+            }
+            for score, liver in zip(scores, to_liver)
+        ]
\ No newline at end of file
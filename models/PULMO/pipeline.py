@@ -2,6 +2,7 @@ from models.base_pipeline import BaseDiseasePipeline
 
 class PULMOPipeline(BaseDiseasePipeline):
     DISEASE_NAME = "PULMO"
+    RISK_GROUP = "Состояние дыхательной системы"
     DEFAULT_THRESHOLD = 0.64
     
     def calculate_risk(self, row):
@@ -12,7 +13,7 @@ class PULMOPipeline(BaseDiseasePipeline):
         pred_proba = model.predict_proba(X)[0][1]
         
         return {
-            "Группа риска": "Состояние дыхательной системы",
+            "Группа риска": self.RISK_GROUP,
             "Риск-скор": self.probability_to_score(pred_proba, self.DEFAULT_THRESHOLD),
             "Метод оценки": "ML модель",
-        }
\ No newline at end of file
+        }
@@ -2,6 +2,7 @@ from models.base_pipeline import BaseDiseasePipeline
 
 class RAPipeline(BaseDiseasePipeline):
     DISEASE_NAME = "RA"
+    RISK_GROUP = "Состояние иммунного метаболического баланса"
     DEFAULT_THRESHOLD = 0.61
     
     def calculate_risk(self, row):
@@ -12,7 +13,7 @@ class RAPipeline(BaseDiseasePipeline):
         pred_proba = model.predict_proba(X)[0][1]
         
         return {
-            "Группа риска": "Состояние иммунного метаболического баланса",
+            "Группа риска": self.RISK_GROUP,
             "Риск-скор": self.probability_to_score(pred_proba, self.DEFAULT_THRESHOLD),
             "Метод оценки": "ML модель",
-        }
\ No newline at end of file
+        }
@@ -0,0 +1,228 @@
+"""Плоский формат артефактов моделей для memory-mapped загрузки.
+
+Each RandomForest pickle is converted into a directory next to it
+(``<model>.forest``) holding flat tree arrays as ``.npy`` files and a
+``meta.json`` with ``feature_names_in_``, classes and the pipeline thresholds.
+Format 2 adds the node cover (weighted training samples per node) that the
+TreeSHAP explanations need (models/explain.py); older artifacts are skipped
+in favour of the pickle until they are converted again. The size and mtime
+of the source pickle are recorded too: a retrained model dropped in under
+the same name is loaded from the pickle until it is converted.
+``FlatForest.open`` maps the arrays read-only, so cold start does not unpickle
+anything and the pages are shared by the OS between worker processes.
+
+Usage:
+    python -m models.artifact                 # convert every models/*/*.pkl
+    python -m models.artifact path/to/model.pkl
+"""
+import argparse
+import glob
+import json
+import os
+
+import joblib
+import numpy as np
+
+from models.features import FeatureView
+from models.registry import registry
+
+ARTIFACT_SUFFIX = ".forest"
+FORMAT_VERSION = 2
+
+ARRAY_NAMES = ("children_left", "children_right", "feature", "threshold", "value", "cover", "roots")
+
+
+def artifact_path(model_file):
+    """Directory of the flat artifact for a given .pkl file"""
+    return os.path.splitext(model_file)[0] + ARTIFACT_SUFFIX
+
+
+def source_stamp(model_file):
+    """Size and mtime of a model pickle, recorded in meta.json at conversion"""
+    stat = os.stat(model_file)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+class FlatForest:
+    """Read-only RandomForest predictor over flat (memory-mapped) tree arrays.
+
+    Mirrors the parts of ``RandomForestClassifier`` the pipelines use:
+    ``feature_names_in_``, ``classes_``, ``n_features_in_`` and ``predict_proba``.
+    """
+
+    def __init__(self, arrays, meta):
+        self.children_left = arrays["children_left"]
+        self.children_right = arrays["children_right"]
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"]
+        self.value = arrays["value"]
+        self.cover = arrays["cover"]
+        self.roots = arrays["roots"]
+        self.meta = meta
+        self.feature_names_in_ = np.asarray(meta["feature_names_in"], dtype=object)
+        self.classes_ = np.asarray(meta["classes"])
+        self.n_features_in_ = len(self.feature_names_in_)
+        self.n_estimators = len(self.roots)
+        self.max_depth = meta["max_depth"]
+
+    @classmethod
+    def open(cls, path, mmap_mode="r", model_file=None):
+        """Open an artifact directory, memory-mapping the arrays read-only.
+
+        With model_file, the artifact must have been converted from that very pickle.
+        """
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported artifact format {meta.get('format_version')} in {path}"
+            )
+        if model_file is not None and meta.get("source_stamp") != source_stamp(model_file):
+            raise ValueError(
+                f"Artifact {path} was converted from another {os.path.basename(model_file)}"
+            )
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ARRAY_NAMES
+        }
+        return cls(arrays, meta)
+
+    @classmethod
+    def from_model(cls, model):
+        """In-memory flat copy of a fitted sklearn forest (for pickles without an artifact)"""
+        arrays, max_depth = flatten_forest(model)
+        return cls(arrays, {
+            "feature_names_in": [str(name) for name in model.feature_names_in_],
+            "classes": np.asarray(model.classes_).tolist(),
+            "max_depth": int(max_depth),
+        })
+
+    def apply(self, X):
+        """Global leaf index reached by every sample in every tree, shape (n_samples, n_trees).
+
+        X is an array or a FeatureView; a view is read in place, cell by cell.
+        """
+        if isinstance(X, FeatureView):
+            # Tree features as cohort column positions, once per call
+            feature = X.positions[self.feature]
+            values_at = X.cells
+        else:
+            X = np.asarray(X, dtype=np.float32)
+            rows = np.arange(X.shape[0])[:, None]
+            feature = self.feature
+            values_at = lambda features: X[rows, features]
+        nodes = np.broadcast_to(self.roots, (len(X), self.n_estimators)).copy()
+        for _ in range(self.max_depth):
+            left = self.children_left[nodes]
+            is_leaf = left == -1
+            if is_leaf.all():
+                break
+            go_left = values_at(feature[nodes]) <= self.threshold[nodes]
+            nodes = np.where(
+                is_leaf, nodes, np.where(go_left, left, self.children_right[nodes])
+            )
+        return nodes
+
+    def tree_proba(self, X):
+        """Class probabilities of every tree, shape (n_samples, n_trees, n_classes)"""
+        return self.value[self.apply(X)]
+
+    def predict_proba(self, X):
+        """Average of per-tree class probabilities, same as sklearn"""
+        return self.tree_proba(X).mean(axis=1)
+
+
+_flat_models = {}  # id(model) -> (model, FlatForest); the model is kept so its id stays unique
+
+
+def flat_forest(model):
+    """The model itself if it is a FlatForest, otherwise its flat copy, built once per model"""
+    if isinstance(model, FlatForest):
+        return model
+    entry = _flat_models.get(id(model))
+    if entry is None or entry[0] is not model:
+        entry = _flat_models[id(model)] = (model, FlatForest.from_model(model))
+    return entry[1]
+
+
+def flatten_forest(model):
+    """Concatenate the trees of a fitted forest into flat global-index arrays"""
+    lefts, rights, features, thresholds, values, covers, roots = [], [], [], [], [], [], []
+    offset = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        left = tree.children_left.astype(np.int64)
+        right = tree.children_right.astype(np.int64)
+        lefts.append(np.where(left == -1, -1, left + offset))
+        rights.append(np.where(right == -1, -1, right + offset))
+        features.append(tree.feature)
+        thresholds.append(tree.threshold)
+        # Normalise leaf values to class probabilities, as DecisionTree.predict_proba does
+        value = tree.value[:, 0, :].astype(np.float64)
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0] = 1
+        values.append(value / normalizer)
+        covers.append(tree.weighted_n_node_samples)
+        roots.append(offset)
+        offset += tree.node_count
+
+    arrays = {
+        "children_left": np.concatenate(lefts).astype(np.int32),
+        "children_right": np.concatenate(rights).astype(np.int32),
+        "feature": np.concatenate(features).astype(np.int32),
+        "threshold": np.concatenate(thresholds).astype(np.float64),
+        "value": np.concatenate(values),
+        "cover": np.concatenate(covers).astype(np.float64),
+        "roots": np.asarray(roots, dtype=np.int32),
+    }
+    max_depth = max(estimator.tree_.max_depth for estimator in model.estimators_)
+    return arrays, max_depth
+
+
+def pipeline_thresholds(disease_name):
+    """Threshold constants declared on the pipeline class of a disease folder"""
+    spec = registry.specs().get(disease_name)
+    return dict(spec.thresholds) if spec else {}
+
+
+def convert_model(model_file, out_dir=None):
+    """Convert one pickled forest into a flat artifact directory"""
+    model = joblib.load(model_file)
+    arrays, max_depth = flatten_forest(model)
+    out_dir = out_dir or artifact_path(model_file)
+    os.makedirs(out_dir, exist_ok=True)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(out_dir, f"{name}.npy"), np.ascontiguousarray(array))
+
+    disease_name = os.path.basename(os.path.dirname(os.path.abspath(model_file)))
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "source": os.path.basename(model_file),
+        "source_stamp": source_stamp(model_file),
+        "feature_names_in": [str(name) for name in model.feature_names_in_],
+        "classes": np.asarray(model.classes_).tolist(),
+        "n_estimators": len(model.estimators_),
+        "max_depth": int(max_depth),
+        "thresholds": pipeline_thresholds(disease_name),
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return out_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert .pkl forests to memory-mappable artifacts")
+    parser.add_argument("models", nargs="*", help="Model .pkl files (default: all under models/)")
+    args = parser.parse_args()
+
+    model_files = args.models or sorted(
+        glob.glob(os.path.join(os.path.dirname(__file__), "*", "*.pkl"))
+    )
+    for model_file in model_files:
+        out_dir = convert_model(model_file)
+        print(f"Converted {model_file} -> {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,50 @@
 from abc import ABC, abstractmethod
-import pandas as pd
-import numpy as np
 import joblib
-import glob
 import os
+import warnings
+
+from models.artifact import FlatForest, artifact_path
+from models.explain import forest_explainer
+from models.features import FeaturePlan, validate_features
+from models.registry import registry
+from models.scoring import ScoreMapping, probabilities_to_scores
+from models.uncertainty import INTERVAL_PERCENTILES, interval_columns, tree_probabilities
+
+# Model input is a positional float32 array (or a FeatureView of the cohort)
+# built by FeaturePlan, column order is guaranteed by the plan; only this
+# sklearn warning is ignored, installed once at import
+warnings.filterwarnings("ignore", message="X does not have valid feature names", category=UserWarning)
 
 class BaseDiseasePipeline(ABC):
     """Основной класс для всех пайплайнов"""
     
     DISEASE_NAME = None
+    RISK_GROUP = None
     DEFAULT_THRESHOLD = 0.5
+    # Probability -> score mapping: slopes below/above the threshold, rounding
+    SCORE_SLOPES = (4, 4)
+    SCORE_DECIMALS = 0
+    # Prefer flat memory-mapped artifacts (see models/artifact.py) over pickles
+    USE_ARTIFACTS = True
+    # Hand models a FeatureView of the cohort matrix instead of a gathered copy
+    ZERO_COPY_INPUT = True
+    # Two-stage pipelines: threshold -> threshold whose flagged samples reach that stage
+    THRESHOLD_GATES = {}
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        registry.register(cls)
     
     def __init__(self):
         self.models = {}
+        self.feature_plans = {}
         self.model_files = self.discover_model_files()
         self.load_models()
+        self.validate_models()
     
     def discover_model_files(self):
-        """Discover all .pkl files in the disease directory"""
-        model_dir = os.path.join(os.path.dirname(__file__), self.DISEASE_NAME)
-        return glob.glob(os.path.join(model_dir, "*.pkl"))
+        """All .pkl files in the disease directory, globbed once at registration"""
+        return registry.model_files(self.DISEASE_NAME)
     
     def load_models(self):
         """Load all discovered models"""
@@ -30,24 +55,112 @@ class BaseDiseasePipeline(ABC):
         
         for model_file in self.model_files:
             key = os.path.basename(model_file)
-            self.models[key] = joblib.load(model_file)
+            self.models[key] = self.load_model_file(model_file)
+    
+    def load_model_file(self, model_file):
+        """Open the flat artifact of a model if it exists, otherwise unpickle it"""
+        forest_dir = artifact_path(model_file)
+        if self.USE_ARTIFACTS and os.path.isdir(forest_dir):
+            try:
+                return FlatForest.open(forest_dir, model_file=model_file)
+            except ValueError as e:
+                print(f"{str(e)}; loading the pickle, run python -m models.artifact to convert again")
+        return joblib.load(model_file)
+    
+    def validate_models(self):
+        """Validate model feature lists once, at startup"""
+        for key, model in self.models.items():
+            validate_features(
+                model.feature_names_in_, getattr(model, "n_features_in_", None),
+                name=f"{self.DISEASE_NAME}/{key}",
+            )
+    
+    def feature_plan(self, features, columns):
+        """Gather plan of the features in a column layout, built once per layout"""
+        plan = self.feature_plans.get(id(features))
+        if plan is None or not plan.matches(columns):
+            plan = FeaturePlan(features, columns)
+            self.feature_plans[id(features)] = plan
+        return plan
     
     def preprocess_data(self, row, features):
         """Предварительная обработка"""
-        X = pd.DataFrame([row[features]], columns=features)
-        X = X.replace([np.inf, -np.inf], np.nan).fillna(0).clip(-1e10, 1e10)
-        return X.astype(np.float32)
+        plan = self.feature_plan(features, row.index)
+        return plan.gather(row.to_numpy())
+    
+    def preprocess_cohort(self, cohort, features):
+        """Model input for every sample of a CohortMatrix: a zero-copy view, or one gather"""
+        plan = self.feature_plan(features, cohort.columns)
+        if self.ZERO_COPY_INPUT:
+            return plan.view(cohort.values)
+        return plan.gather(cohort.values)
+    
+    def threshold_probabilities(self, cohort, per_tree=False):
+        """Threshold constant -> model probability compared with it, for every sample of a cohort.
+
+        With per_tree, every tree's probability: arrays of shape (n_samples, n_trees).
+        """
+        model_name, model = next(iter(self.models.items()))
+        X = self.preprocess_cohort(cohort, model.feature_names_in_)
+        if per_tree:
+            return {"DEFAULT_THRESHOLD": tree_probabilities(model, X)[:, :, 1]}
+        return {"DEFAULT_THRESHOLD": model.predict_proba(X)[:, 1]}
+    
+    def threshold_contributions(self, cohort):
+        """Threshold constant -> exact TreeSHAP Contributions (models/explain.py) of the probability compared with it"""
+        model_name, model = next(iter(self.models.items()))
+        X = self.preprocess_cohort(cohort, model.feature_names_in_)
+        return {"DEFAULT_THRESHOLD": forest_explainer(model, 1).explain(X)}
+    
+    def risk_contributions(self, cohort):
+        """Contributions behind the ML score of every sample"""
+        return self.threshold_contributions(cohort)["DEFAULT_THRESHOLD"]
+    
+    def risk_intervals(self, cohort, percentiles=INTERVAL_PERCENTILES, method="bootstrap"):
+        """calculate_risk_batch results plus probability and score intervals (models/uncertainty.py)"""
+        trees = self.threshold_probabilities(cohort, per_tree=True)["DEFAULT_THRESHOLD"]
+        columns = interval_columns(trees, self.score_mapping(), percentiles, method)
+        scores = self.probability_to_score(columns["Вероятность"], self.DEFAULT_THRESHOLD)
+        return [
+            {
+                "Группа риска": self.RISK_GROUP,
+                "Риск-скор": score,
+                "Метод оценки": "ML модель",
+                **{name: values[i] for name, values in columns.items()},
+            }
+            for i, score in enumerate(scores)
+        ]
     
     @abstractmethod
     def calculate_risk(self, row):
         """Рассчитываем риски"""
         pass
     
-    @staticmethod
-    def probability_to_score(prob, threshold):
-        prob = min(max(prob, 0), 1)
-        if prob < threshold:
-            score = 4 * prob / threshold
-        else:
-            score = 4 + 4 * (prob - threshold) / (1 - threshold)
-        return 10- round(score, 0)
\ No newline at end of file
+    def calculate_risk_batch(self, cohort):
+        """Риски для всех образцов когорты: one model call, scores mapped as an array"""
+        pred_proba = self.threshold_probabilities(cohort)["DEFAULT_THRESHOLD"]
+        scores = probabilities_to_scores(pred_proba, self.score_mapping())
+        
+        return [
+            {
+                "Группа риска": self.RISK_GROUP,
+                "Риск-скор": score,
+                "Метод оценки": "ML модель",
+            }
+            for score in scores
+        ]
+    
+    @classmethod
+    def score_mapping(cls, threshold=None):
+        low_slope, high_slope = cls.SCORE_SLOPES
+        return ScoreMapping(
+            threshold=cls.DEFAULT_THRESHOLD if threshold is None else threshold,
+            low_slope=low_slope,
+            high_slope=high_slope,
+            decimals=cls.SCORE_DECIMALS,
+        )
+    
+    @classmethod
+    def probability_to_score(cls, prob, threshold):
+        """Score for one probability or a whole array of them"""
+        return probabilities_to_scores(prob, cls.score_mapping(threshold))
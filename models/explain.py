@@ -0,0 +1,167 @@
+"""Вклад признаков в вероятность модели: точный TreeSHAP на плоских массивах.
+
+Path-dependent TreeSHAP (the ``tree_path_dependent`` definition of the shap
+package) on FlatForest arrays, for a whole batch at once. Take a leaf with
+value v. For every feature on its root path, s_j(x) is 1 if x satisfies all
+of that feature's splits on the path. r_j is the product of cover ratios
+(child cover / parent cover) along those splits. The expected output given
+the feature subset S is then a product over the path features: s_j for
+features in S, r_j for the others. For such a product game the Shapley value
+of path feature i is
+
+    phi_i = v * (s_i - r_i) * sum over M (satisfied path features without i)
+            of |M|! (D - |M| - 1)! / D! * prod of r_j over path features neither in M nor i
+
+Paths are padded to D = max_depth slots with null players (s = r = 1).
+Null players do not change Shapley values, so the weights are the same for
+every leaf. Only the bitmask of satisfied slots depends on the sample. The
+sum is therefore tabulated once per leaf, slot and bitmask (2**D entries),
+so forests deeper than MAX_EXPLAIN_DEPTH are refused.
+Explaining a batch becomes one comparison per path split, one table lookup
+per leaf slot and one scatter into the features, without Python loops over
+samples or trees. The contributions plus the expected value equal
+predict_proba exactly, up to float rounding.
+"""
+from dataclasses import dataclass
+from math import factorial
+
+import numpy as np
+
+from models.artifact import flat_forest
+
+# Samples explained at a time; temporaries are n_rows x leaves x max_depth
+EXPLAIN_CHUNK_ROWS = 128
+# The tables hold leaves x depth x 2**depth weights; deeper forests are not explained
+MAX_EXPLAIN_DEPTH = 10
+
+
+@dataclass(frozen=True)
+class Contributions:
+    """Per-sample additive explanation: base + values.sum(axis=1) = model probability"""
+    features: np.ndarray  # feature names, feature_names_in_ order
+    base: np.ndarray      # expected value, per sample
+    values: np.ndarray    # samples x features
+
+
+class TreeExplainer:
+    """Leaf path tables of one forest for one class, built once per model"""
+
+    def __init__(self, forest, class_index=1):
+        forest = flat_forest(forest)
+        if forest.max_depth > MAX_EXPLAIN_DEPTH:
+            raise ValueError(
+                f"Forest depth {forest.max_depth} exceeds MAX_EXPLAIN_DEPTH={MAX_EXPLAIN_DEPTH}, "
+                f"contributions are not computed for it"
+            )
+        self.forest = forest
+        self.class_index = class_index
+        self.depth = max(int(forest.max_depth), 1)
+        self._build_paths()
+        self._build_tables()
+
+    def _build_paths(self):
+        forest, depth = self.forest, self.depth
+        leaves, edges = [], []
+        for root in forest.roots:
+            stack = [(int(root), [])]
+            while stack:
+                node, path = stack.pop()
+                left = int(forest.children_left[node])
+                if left == -1:
+                    leaves.append(node)
+                    edges.append(path)
+                    continue
+                right = int(forest.children_right[node])
+                split = (int(forest.feature[node]), float(forest.threshold[node]))
+                cover = float(forest.cover[node])
+                stack.append((left, path + [(*split, True, forest.cover[left] / cover)]))
+                stack.append((right, path + [(*split, False, forest.cover[right] / cover)]))
+
+        n_leaves = len(leaves)
+        self.leaf_value = forest.value[np.asarray(leaves), self.class_index].astype(np.float64)
+        # Path splits, padded with always-true splits
+        self.edge_feature = np.zeros((n_leaves, depth), dtype=np.int64)
+        self.edge_threshold = np.full((n_leaves, depth), np.inf)
+        self.edge_left = np.ones((n_leaves, depth), dtype=bool)
+        self.edge_slot = np.zeros((n_leaves, depth), dtype=np.int64)
+        self.edge_pad = np.ones((n_leaves, depth), dtype=bool)
+        # Slots: unique path features with their cover fraction, padded with null players
+        self.slot_feature = np.full((n_leaves, depth), -1, dtype=np.int64)
+        self.slot_fraction = np.ones((n_leaves, depth))
+        for l, path in enumerate(edges):
+            slots = {}
+            for d, (feature, threshold, go_left, fraction) in enumerate(path):
+                slot = slots.setdefault(feature, len(slots))
+                self.edge_feature[l, d] = feature
+                self.edge_threshold[l, d] = threshold
+                self.edge_left[l, d] = go_left
+                self.edge_slot[l, d] = slot
+                self.edge_pad[l, d] = False
+                self.slot_feature[l, slot] = feature
+                self.slot_fraction[l, slot] *= fraction
+
+    def _build_tables(self):
+        depth = self.depth
+        n_masks = 2 ** depth
+        weights = np.array([factorial(m) * factorial(depth - m - 1) / factorial(depth) for m in range(depth)])
+        r = self.slot_fraction
+        # table[l, i, M]: Shapley weight of coalition M times the r of the absent other slots
+        table = np.zeros((len(r), depth, n_masks))
+        for i in range(depth):
+            for mask in range(n_masks):
+                if mask >> i & 1:
+                    continue
+                absent = [j for j in range(depth) if j != i and not mask >> j & 1]
+                table[:, i, mask] = weights[bin(mask).count("1")] * np.prod(r[:, absent], axis=1)
+        # Sum over every coalition contained in the satisfied-slot bitmask (subset-sum transform)
+        for bit in range(depth):
+            shaped = table.reshape(len(r), depth, -1, 2, 2 ** bit)
+            shaped[:, :, :, 1, :] += shaped[:, :, :, 0, :]
+        self.table = table.reshape(len(r), depth * n_masks)
+        # Features of all leaf slots sorted once, for the scatter into features
+        flat_feature = self.slot_feature.ravel()
+        order = np.argsort(flat_feature, kind="stable")
+        order = order[flat_feature[order] >= 0]
+        self._order = order
+        self._features, self._starts = np.unique(flat_feature[order], return_index=True)
+        self.expected_value = float(
+            (self.leaf_value * np.prod(r, axis=1)).sum() / self.forest.n_estimators)
+
+    def _explain_rows(self, X):
+        n_leaves, depth = self.slot_fraction.shape
+        cond = (X[:, self.edge_feature] <= self.edge_threshold) == self.edge_left
+        cond |= self.edge_pad
+        failed = np.bitwise_or.reduce(np.where(cond, 0, 1 << self.edge_slot), axis=2)
+        satisfied = (2 ** depth - 1) ^ failed                                  # n x leaves
+        bits = (satisfied[:, :, None] >> np.arange(depth)) & 1                 # n x leaves x slots
+        lookup = np.arange(depth) * 2 ** depth + satisfied[:, :, None]
+        weight = self.table[np.arange(n_leaves)[None, :, None], lookup]
+        contributions = self.leaf_value[:, None] * (bits - self.slot_fraction) * weight
+        contributions = contributions.reshape(len(X), -1)[:, self._order]
+        values = np.zeros((len(X), self.forest.n_features_in_))
+        values[:, self._features] = np.add.reduceat(contributions, self._starts, axis=1)
+        return values / self.forest.n_estimators
+
+    def explain(self, X):
+        """Contributions of every feature for every sample of X (array or FeatureView)"""
+        X = np.asarray(X, dtype=np.float32)
+        values = np.zeros((len(X), self.forest.n_features_in_))
+        for start in range(0, len(X), EXPLAIN_CHUNK_ROWS):
+            values[start:start + EXPLAIN_CHUNK_ROWS] = self._explain_rows(X[start:start + EXPLAIN_CHUNK_ROWS])
+        return Contributions(
+            features=np.asarray(self.forest.feature_names_in_, dtype=object),
+            base=np.full(len(X), self.expected_value),
+            values=values,
+        )
+
+
+_explainers = {}  # (id(model), class) -> (model, explainer); the model is kept so its id stays unique
+
+
+def forest_explainer(model, class_index=1):
+    """Explainer of a model, built on first use and kept for the process"""
+    key = (id(model), class_index)
+    entry = _explainers.get(key)
+    if entry is None or entry[0] is not model:
+        entry = _explainers[key] = (model, TreeExplainer(model, class_index))
+    return entry[1]
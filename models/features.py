@@ -0,0 +1,157 @@
+"""Предрасчитанные планы выборки признаков для моделей.
+
+A FeaturePlan maps a model's ``feature_names_in_`` to integer positions in a
+fixed column layout (the ratio-augmented patient table), so preparing model
+input is one ``np.take`` into a preallocated buffer instead of building a
+one-row DataFrame per prediction.
+
+For a whole cohort, ``FeaturePlan.view`` hands the model a FeatureView: the
+cohort matrix plus the feature positions, no copy. FlatForest reads the
+feature values it needs straight from the cohort columns while walking the
+trees; any other model gets the gathered array through ``__array__``.
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Same bounds as the former DataFrame-based preprocess_data
+CLIP_MIN = -1e10
+CLIP_MAX = 1e10
+
+
+def validate_features(features, n_features=None, name="model"):
+    """Check a model feature list once, at load time"""
+    features = pd.Index(features)
+    if len(features) == 0:
+        raise ValueError(f"{name}: empty feature list")
+    if not features.is_unique:
+        duplicated = list(features[features.duplicated()])
+        raise ValueError(f"{name}: duplicated features {duplicated}")
+    if n_features is not None and len(features) != n_features:
+        raise ValueError(
+            f"{name}: {len(features)} feature names for {n_features} model inputs"
+        )
+
+
+def sanitize(values):
+    """In-place NaN/inf handling: inf -> NaN -> 0, then clip to +-1e10"""
+    np.nan_to_num(values, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+    np.clip(values, CLIP_MIN, CLIP_MAX, out=values)
+    return values
+
+
+def gather_block(values, positions, rows=None):
+    """Sanitised float32 samples x features copy of a 2-D block"""
+    if rows is None:
+        block = np.take(values, positions, axis=1)
+    else:
+        block = values[np.ix_(rows, positions)]
+    if block.dtype == np.float32:
+        return sanitize(block)
+    return sanitize(block.astype(np.float64)).astype(np.float32)
+
+
+class FeaturePlan:
+    """Integer gather plan of model features within one column layout"""
+
+    def __init__(self, features, columns):
+        self.features = pd.Index(features)
+        self.columns = pd.Index(columns)
+        if not self.columns.is_unique:
+            raise ValueError("Column layout has duplicated names")
+
+        positions = self.columns.get_indexer(self.features)
+        if (positions < 0).any():
+            missing = list(self.features[positions < 0])
+            raise KeyError(f"{missing} not in index")
+        self.positions = positions.astype(np.intp)
+
+        # Buffers are per thread: pipeline instances are shared between sessions
+        self._local = threading.local()
+
+    def _buffers(self):
+        """Preallocated (float64 scratch, float32 model input) buffers of the calling thread"""
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            # Sanitising happens in float64 so clipping matches the old pandas path,
+            # the result is then cast into the float32 buffer handed to the model
+            buffers = (
+                np.empty((1, len(self.positions)), dtype=np.float64),
+                np.empty((1, len(self.positions)), dtype=np.float32),
+            )
+            self._local.buffers = buffers
+        return buffers
+
+    def matches(self, columns):
+        return columns is self.columns or self.columns.equals(columns)
+
+    def gather(self, values):
+        """Model input for a 1-D row (reuses the thread's buffer) or a 2-D block of rows"""
+        values = np.asarray(values)
+        if values.ndim == 1:
+            scratch, buffer = self._buffers()
+            if values.dtype == np.float32:
+                # Already float32 (CohortMatrix rows): sanitise in the model buffer directly
+                np.take(values, self.positions, out=buffer[0])
+                return sanitize(buffer)
+            if values.dtype not in (np.float64, object):
+                values = values.astype(np.float64)
+            np.take(values, self.positions, out=scratch[0])
+            sanitize(scratch)
+            buffer[...] = scratch
+            return buffer
+
+        return gather_block(values, self.positions)
+
+    def view(self, values):
+        """Zero-copy model input over a 2-D samples x columns block"""
+        return FeatureView(values, self.positions)
+
+
+class FeatureView:
+    """Model input as a view: cohort matrix, feature positions and selected rows.
+
+    ``cells`` gathers single cells with the same sanitising as ``gather``;
+    ``np.asarray(view)`` materialises the float32 samples x features array.
+    """
+
+    def __init__(self, values, positions, rows=None):
+        self.values = values
+        self.positions = positions
+        self.rows = np.arange(values.shape[0]) if rows is None else rows
+        self._needs_sanitize = None
+
+    @property
+    def shape(self):
+        return (len(self.rows), len(self.positions))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, rows):
+        """Row selection (mask or positions), still a view"""
+        return FeatureView(self.values, self.positions, self.rows[rows])
+
+    def __array__(self, dtype=None, copy=None):
+        array = gather_block(self.values, self.positions, self.rows)
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    @property
+    def needs_sanitize(self):
+        """Whether any feature column holds NaN, inf or values beyond the clip bounds"""
+        if self._needs_sanitize is None:
+            self._needs_sanitize = any(
+                not (np.isfinite(column).all() and np.abs(column).max(initial=0) <= CLIP_MAX)
+                for column in (self.values[:, position] for position in np.unique(self.positions))
+            )
+        return self._needs_sanitize
+
+    def cells(self, columns):
+        """float32 inputs at (n_rows, k) cohort column positions, one row of positions per view row"""
+        cells = self.values[self.rows[:, None], columns]
+        if self.needs_sanitize:
+            if cells.dtype != np.float32:
+                cells = cells.astype(np.float64, copy=False)
+            sanitize(cells)
+        return cells.astype(np.float32, copy=False)
@@ -0,0 +1,137 @@
+"""Реестр пайплайнов заболеваний.
+
+Every ``BaseDiseasePipeline`` subclass registers itself through
+``__init_subclass__``. ``discover`` imports ``models/<DISEASE>/pipeline.py`` for
+each disease folder once, so a new folder is picked up without code changes.
+The registry records each pipeline's risk group, thresholds and model files and
+hands out one ready (loaded) instance per pipeline. Threshold constants can be
+overridden by ``models/<DISEASE>/thresholds.json`` (written by
+threshold_sweep.py); the file is applied to the class when it registers.
+"""
+import glob
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from importlib import import_module
+
+from metrics import MODEL_LOAD_SECONDS
+
+MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+THRESHOLDS_FILE = "thresholds.json"
+
+
+@dataclass(frozen=True)
+class PipelineSpec:
+    """What the registry knows about a pipeline without instantiating it"""
+    disease_name: str
+    pipeline_class: type
+    risk_group: str
+    thresholds: dict = field(default_factory=dict)
+    model_files: tuple = ()
+
+
+def class_thresholds(pipeline_class):
+    """Threshold constants declared on the class itself (names ending with THRESHOLD)"""
+    return {
+        name: value for name, value in vars(pipeline_class).items()
+        if name.endswith("THRESHOLD") and isinstance(value, float)
+    }
+
+
+def thresholds_path(model_dir):
+    return os.path.join(model_dir, THRESHOLDS_FILE)
+
+
+def apply_threshold_config(pipeline_class, model_dir):
+    """Set the class threshold constants from the disease folder's thresholds.json, if any"""
+    path = thresholds_path(model_dir)
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    except Exception as e:
+        print(f"Error reading {path}: {str(e)}")
+        return
+    declared = class_thresholds(pipeline_class)
+    for name, value in config.get("thresholds", {}).items():
+        if name not in declared:
+            print(f"Unknown threshold {name} in {path}, ignored")
+            continue
+        setattr(pipeline_class, name, float(value))
+
+
+class PipelineRegistry:
+    def __init__(self, models_dir=MODELS_DIR):
+        self.models_dir = models_dir
+        self._specs = {}
+        self._instances = {}
+        self._discovered = False
+        self._lock = threading.RLock()
+
+    def register(self, pipeline_class):
+        """Record a pipeline class; called from BaseDiseasePipeline.__init_subclass__"""
+        disease_name = pipeline_class.DISEASE_NAME
+        if not disease_name:
+            return
+        model_dir = os.path.join(self.models_dir, disease_name)
+        apply_threshold_config(pipeline_class, model_dir)
+        model_files = tuple(sorted(glob.glob(os.path.join(model_dir, "*.pkl"))))
+        with self._lock:
+            self._specs[disease_name] = PipelineSpec(
+                disease_name=disease_name,
+                pipeline_class=pipeline_class,
+                risk_group=pipeline_class.RISK_GROUP or disease_name,
+                thresholds=class_thresholds(pipeline_class),
+                model_files=model_files,
+            )
+            self._instances.pop(disease_name, None)
+
+    def discover(self):
+        """Import every models/<DISEASE>/pipeline.py once"""
+        with self._lock:
+            if self._discovered:
+                return
+            for pipeline_file in sorted(glob.glob(os.path.join(self.models_dir, "*", "pipeline.py"))):
+                folder = os.path.basename(os.path.dirname(pipeline_file))
+                try:
+                    import_module(f"models.{folder}.pipeline")
+                except Exception as e:
+                    print(f"Error importing pipeline {folder}: {str(e)}")
+            self._discovered = True
+
+    def specs(self):
+        self.discover()
+        return dict(sorted(self._specs.items()))
+
+    def spec(self, disease_name):
+        self.discover()
+        return self._specs[disease_name]
+
+    def model_files(self, disease_name):
+        spec = self._specs.get(disease_name)
+        return list(spec.model_files) if spec else []
+
+    def get(self, disease_name):
+        """Loaded pipeline instance, created on first request and reused afterwards"""
+        instance = self._instances.get(disease_name)
+        if instance is not None:
+            return instance
+        with self._lock:
+            instance = self._instances.get(disease_name)
+            if instance is None:
+                with MODEL_LOAD_SECONDS.time(disease=disease_name):
+                    instance = self.spec(disease_name).pipeline_class()
+                self._instances[disease_name] = instance
+        return instance
+
+    def factories(self):
+        """disease name -> callable returning the shared instance, for the scheduler"""
+        return {
+            disease_name: (lambda name=disease_name: self.get(name))
+            for disease_name in self.specs()
+        }
+
+
+registry = PipelineRegistry()
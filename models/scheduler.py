@@ -0,0 +1,98 @@
+"""Параллельный запуск независимых пайплайнов заболеваний.
+
+The disease pipelines do not depend on each other, and tree prediction spends
+most of its time in NumPy/sklearn code that releases the GIL, so each pipeline
+runs as one task on a shared thread pool. A task scores the whole cohort with
+the pipeline's vectorised calculate_risk_batch (row by row, with the error
+printed, if that fails), and the results are merged back in the same
+row-major, pipeline order as the old sequential loop. With intervals, the
+task calls risk_intervals instead, which returns the same results plus the
+tree-vote intervals (models/uncertainty.py); the row-by-row fallback leaves
+the interval columns NaN.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import PIPELINE_SECONDS
+from models.uncertainty import INTERVAL_COLUMNS
+
+# Worker threads for pipeline tasks; one per pipeline is enough
+MAX_WORKERS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Shared thread pool reserved for pipeline tasks"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix="pipeline"
+            )
+    return _executor
+
+
+def error_result(disease_name, error):
+    """Result row recorded when a pipeline fails, same as the sequential loop"""
+    return {
+        "Группа риска": disease_name,
+        "Риск-скор": None,
+        "Метод оценки": f"ML модель (ошибка: {str(error)})"
+    }
+
+
+def run_pipeline(disease_name, factory, cohort, intervals=False):
+    """Build one pipeline and score every sample; failures are isolated per row"""
+    try:
+        pipeline = factory()
+    except Exception as e:
+        print(f"Error processing {disease_name}: {str(e)}")
+        return [error_result(disease_name, e) for _ in range(len(cohort))]
+
+    with PIPELINE_SECONDS.time(disease=disease_name):
+        return _score_cohort(disease_name, pipeline, cohort, intervals)
+
+
+def _score_cohort(disease_name, pipeline, cohort, intervals=False):
+    # Whole cohort in one vectorised call; on failure fall back to row by row
+    try:
+        if intervals:
+            return pipeline.risk_intervals(cohort)
+        return pipeline.calculate_risk_batch(cohort)
+    except Exception as e:
+        print(f"Error processing {disease_name}: {str(e)}; scoring row by row")
+
+    results = []
+    for row in cohort.rows():
+        try:
+            results.append(pipeline.calculate_risk(row))
+        except Exception as e:
+            print(f"Error processing {disease_name}: {str(e)}")
+            results.append(error_result(disease_name, e))
+    if intervals:
+        # The row path has no intervals; keep the columns so every result has the same layout
+        missing = float("nan")
+        results = [{**result, **{column: result.get(column, missing) for column in INTERVAL_COLUMNS}}
+                   for result in results]
+    return results
+
+
+def run_pipelines(factories, cohort, executor=None, intervals=False):
+    """Run pipelines concurrently and merge results in deterministic order.
+
+    factories maps disease name -> callable returning a pipeline instance.
+    Returns one result per (sample, pipeline), samples outer, pipelines in mapping order.
+    """
+    executor = executor or get_executor()
+    futures = [
+        executor.submit(run_pipeline, disease_name, factory, cohort, intervals)
+        for disease_name, factory in factories.items()
+    ]
+    per_pipeline = [future.result() for future in futures]
+    return [
+        per_pipeline[j][i]
+        for i in range(len(cohort))
+        for j in range(len(per_pipeline))
+    ]
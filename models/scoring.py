@@ -0,0 +1,33 @@
+"""Перевод вероятностей моделей в баллы 0–10.
+
+The piecewise-linear mapping: below the threshold the probability is scaled
+onto ``[0, low_slope]``, above it onto ``[low_slope, low_slope + high_slope]``,
+the result is rounded and subtracted from 10 (higher score = lower risk).
+Works on scalars and on whole arrays of probabilities.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+MAX_SCORE = 10
+
+
+@dataclass(frozen=True)
+class ScoreMapping:
+    threshold: float
+    low_slope: float = 4
+    high_slope: float = 4
+    decimals: int = 0
+
+
+def probabilities_to_scores(probs, mapping):
+    """Vectorised probability -> score; returns an array for array input, a float for a scalar"""
+    prob = np.clip(np.asarray(probs, dtype=np.float64), 0, 1)
+    threshold = mapping.threshold
+    score = np.where(
+        prob < threshold,
+        mapping.low_slope * prob / threshold,
+        mapping.low_slope + mapping.high_slope * (prob - threshold) / (1 - threshold),
+    )
+    scores = MAX_SCORE - np.round(score, mapping.decimals)
+    return scores[()] if scores.ndim == 0 else scores
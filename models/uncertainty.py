@@ -0,0 +1,68 @@
+"""Интервалы неопределенности ML-оценок по голосам деревьев.
+
+A forest probability is the mean of its trees' leaf probabilities. All
+trees are evaluated for the whole batch in one pass (FlatForest.tree_proba,
+the same leaf lookup as predict_proba; a pickled model is flattened once). Two intervals are available:
+
+``bootstrap`` (default): a percentile interval of the forest probability
+itself. The trees are resampled with replacement BOOTSTRAP_RESAMPLES times,
+and all resampled means are one matrix product.
+
+``trees``: percentiles of the per-tree probabilities, i.e. how much the
+individual trees disagree. With fully grown trees most leaves are pure, so
+this interval is much wider.
+
+The probability bounds are mapped to 0-10 scores with the pipeline mapping.
+The mapping decreases with probability, so the lower score bound comes from
+the upper probability bound.
+"""
+import numpy as np
+
+from models.artifact import flat_forest
+from models.scoring import probabilities_to_scores
+
+INTERVAL_PERCENTILES = (5, 95)
+INTERVAL_METHODS = ("bootstrap", "trees")
+BOOTSTRAP_RESAMPLES = 200
+# Fixed resampling, so the same patient always gets the same interval
+BOOTSTRAP_SEED = 0
+
+INTERVAL_COLUMNS = ("Вероятность", "Вероятность (нижняя)", "Вероятность (верхняя)",
+                    "Риск-скор (нижний)", "Риск-скор (верхний)")
+
+
+def tree_probabilities(model, X):
+    """Per-tree class probabilities, shape (n_samples, n_trees, n_classes)"""
+    # A pickled sklearn forest (no artifact) is flattened once and evaluated the same way
+    return flat_forest(model).tree_proba(X)
+
+
+def bootstrap_weights(n_trees, resamples=BOOTSTRAP_RESAMPLES, seed=BOOTSTRAP_SEED):
+    """(n_trees, resamples) matrix: column b averages the trees drawn in resample b"""
+    draws = np.random.default_rng(seed).integers(0, n_trees, size=(resamples, n_trees))
+    counts = np.zeros((resamples, n_trees))
+    np.add.at(counts, (np.repeat(np.arange(resamples), n_trees), draws.ravel()), 1)
+    return counts.T / n_trees
+
+
+def probability_interval(trees, percentiles=INTERVAL_PERCENTILES, method="bootstrap"):
+    """(low, high) probability bounds per sample from (n_samples, n_trees) tree probabilities"""
+    if method not in INTERVAL_METHODS:
+        raise ValueError(f"Unknown interval method {method!r}, expected one of {INTERVAL_METHODS}")
+    trees = np.asarray(trees, dtype=np.float64)
+    if method == "bootstrap":
+        trees = trees @ bootstrap_weights(trees.shape[1])
+    low, high = np.percentile(trees, percentiles, axis=1)
+    return low, high
+
+
+def interval_columns(trees, mapping, percentiles=INTERVAL_PERCENTILES, method="bootstrap"):
+    """INTERVAL_COLUMNS -> array per sample; the probability is the forest mean, as predict_proba"""
+    low, high = probability_interval(trees, percentiles, method)
+    return dict(zip(INTERVAL_COLUMNS, (
+        np.asarray(trees, dtype=np.float64).mean(axis=1),
+        low,
+        high,
+        probabilities_to_scores(high, mapping),
+        probabilities_to_scores(low, mapping),
+    )))
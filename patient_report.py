@@ -0,0 +1,261 @@
+"""Пакетная генерация отчетов по пациентам.
+
+One self-contained report per sample: an HTML page with the charts embedded
+as PNG data URIs, or a multi-page PDF through matplotlib's PDF backend. The
+panels are the same as in the app (chart_panels.json, group cards of both
+methods, ML scores with their strongest TreeSHAP contributions). The cohort
+is scored and explained and the chart z-scores are evaluated once in the
+parent; drawing, which dominates the time, is fanned out across a process
+pool.
+
+Usage:
+    python patient_report.py data.xlsx --ref Ref.xlsx --out reports [--format pdf] [--workers N]
+"""
+import argparse
+import html
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+from chart_panels import evaluate_panels
+from cohort import ID_COLUMN, ConcentrationStore
+from plot_utilit import (
+    get_color_under_normal_dist,
+    group_card_summary,
+    group_cards_html,
+    panel_figure,
+    plot_panel_z_scores,
+)
+
+GROUP_COLUMN = "Группа"
+FORMATS = ("html", "pdf")
+
+# Card sections of a report: title -> key of the score_cohort result
+CARD_SECTIONS = {
+    "Старый метод": "legacy_scores",
+    "Z-score": "category_scores",
+}
+
+
+def category_table(risk_params, category_scores):
+    """Группа риска / категория / Subgroup_score одного образца; категории без оценки пропускаются"""
+    table = risk_params[['Группа_риска', 'Категория']].drop_duplicates()
+    table = table.assign(Subgroup_score=table['Категория'].map(category_scores))
+    return table.dropna(subset=['Subgroup_score'])
+
+
+def report_filename(position, sample_id, fmt):
+    """Plate position keeps names unique and ordered; the id is made filesystem-safe"""
+    safe_id = re.sub(r"[^\w.-]+", "_", str(sample_id)).strip("_") or "sample"
+    return f"{position + 1:03d}_{safe_id}.{fmt}"
+
+
+def build_jobs(data, results, risk_params, chart_ref_stats, panels=None):
+    """One picklable job per sample: id, group, evaluated chart panels, risk table, cards"""
+    sample_ids = results["zscores"].index
+    groups = data[GROUP_COLUMN].to_numpy() if GROUP_COLUMN in data else np.full(len(data), "-")
+
+    # Chart z-scores of every panel and sample in one pass
+    evaluated = evaluate_panels(ConcentrationStore.from_frame(data), chart_ref_stats, panels)
+
+    # By sample position (the risk_scores index): repeat injections share a code
+    risk_by_sample = {
+        position: frame.drop(columns=ID_COLUMN).sort_values(by="Метод оценки")
+        for position, frame in results["risk_scores"].groupby(level=0, sort=False)
+    }
+    empty_risks = results["risk_scores"].drop(columns=ID_COLUMN).iloc[:0]
+
+    jobs = []
+    for i, sample_id in enumerate(sample_ids):
+        jobs.append({
+            "position": i,
+            "sample_id": sample_id,
+            "group": groups[i],
+            "panels": [panel.sample(i) for panel in evaluated],
+            "risk_scores": risk_by_sample.get(i, empty_risks),
+            "cards": {
+                title: category_table(risk_params, results[key].iloc[i])
+                for title, key in CARD_SECTIONS.items()
+            },
+        })
+    return jobs
+
+
+def panel_figures(job):
+    """Figures of every chart panel of one sample, in panel order"""
+    for panel in job["panels"]:
+        yield panel_figure(panel)
+
+
+def report_html(job, chart_uris):
+    """Self-contained HTML page of one sample"""
+    risk_table = job["risk_scores"].to_html(
+        index=False, na_rep="-", float_format="{:.0f}".format, border=0, classes="risks")
+    cards = "".join(
+        f"<section><h2>{html.escape(title)}</h2>{group_cards_html(group_card_summary(table, job['risk_scores']))}</section>"
+        for title, table in job["cards"].items()
+    )
+    charts = "".join(f'<img src="{uri}" alt="">' for uri in chart_uris)
+    sample_id = html.escape(str(job["sample_id"]))
+    return f"""<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>Отчет Metaboscan — {sample_id}</title>
+<style>
+body {{ font-family: Calibri, Arial, sans-serif; margin: 24px; color: #262730; }}
+.columns {{ display: grid; grid-template-columns: 1fr 1fr 1fr; gap: 24px; }}
+.charts {{ display: grid; grid-template-columns: 1fr 1fr; gap: 12px; margin-top: 24px; }}
+.charts img {{ width: 100%; }}
+table.risks {{ border-collapse: collapse; width: 100%; }}
+table.risks th, table.risks td {{ padding: 4px 8px; border-bottom: 1px solid #e9ecef; text-align: left; }}
+@media print {{ .charts img {{ break-inside: avoid; }} }}
+</style>
+</head>
+<body>
+<p><b>Код пациента:</b> {sample_id}<br><b>Группа:</b> {html.escape(str(job["group"]))}</p>
+<div class="columns">
+<section><h2>Риск-скор</h2>{risk_table}</section>
+{cards}
+</div>
+<div class="charts">{charts}</div>
+</body>
+</html>
+"""
+
+
+def summary_figure(job):
+    """First PDF page: risk score table and category deviations of both methods"""
+    from matplotlib import pyplot as plt
+
+    sections = list(job["cards"].items())
+    fig, axes = plt.subplots(
+        1, 1 + len(sections), figsize=(8.27 * (1 + len(sections)) / 2, 11.69),
+        gridspec_kw={"width_ratios": [1.2] + [1] * len(sections)})
+    fig.suptitle(f"Код пациента: {job['sample_id']}    Группа: {job['group']}", fontsize=14)
+
+    risks = job["risk_scores"]
+    axes[0].axis("off")
+    axes[0].set_title("Риск-скор")
+    if len(risks):
+        cells = [
+            [group, "-" if pd.isna(score) else f"{score:.0f}", method]
+            for group, score, method in zip(risks["Группа риска"], risks["Риск-скор"], risks["Метод оценки"])
+        ]
+        table = axes[0].table(cellText=cells, colLabels=["Группа риска", "Балл", "Метод"], loc="upper center")
+        table.auto_set_font_size(False)
+        table.set_fontsize(7)
+
+    for ax, (title, cards) in zip(axes[1:], sections):
+        scores = cards["Subgroup_score"].to_numpy(dtype=np.float64)
+        positions = np.arange(len(scores))
+        ax.barh(positions, scores, color=[get_color_under_normal_dist(score) for score in scores])
+        ax.set_yticks(positions, cards["Категория"], fontsize=6)
+        ax.invert_yaxis()
+        ax.set_xlim(0, 100)
+        ax.set_title(f"{title}, % отклонения")
+    fig.tight_layout()
+    return fig
+
+
+def write_html_report(job, path):
+    # Charts come from the shared disk cache when another session or worker rendered them
+    chart_uris = [plot_panel_z_scores(panel) for panel in job["panels"]]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(report_html(job, chart_uris))
+    return path
+
+
+def write_pdf_report(job, path):
+    from matplotlib import pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    with PdfPages(path) as pdf:
+        for fig in [summary_figure(job), *panel_figures(job)]:
+            pdf.savefig(fig)
+            plt.close(fig)
+    return path
+
+
+def render_report(job, out_dir, fmt="html"):
+    """Write the report of one sample; returns its path"""
+    path = os.path.join(out_dir, report_filename(job["position"], job["sample_id"], fmt))
+    if fmt == "pdf":
+        return write_pdf_report(job, path)
+    return write_html_report(job, path)
+
+
+# Per-process rendering context, set once by the pool initializer
+_worker_context = {}
+
+
+def _init_worker(out_dir, fmt):
+    import matplotlib
+    matplotlib.use("Agg")
+    _worker_context.update(out_dir=out_dir, fmt=fmt)
+
+
+def _render_in_worker(job):
+    return render_report(job, **_worker_context)
+
+
+def render_reports(jobs, out_dir, fmt="html", workers=None):
+    """Render all jobs, in a process pool unless workers == 1; returns paths in job order"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown report format {fmt!r}, expected one of {FORMATS}")
+    os.makedirs(out_dir, exist_ok=True)
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+
+    if workers == 1:
+        _init_worker(out_dir, fmt)
+        return [_render_in_worker(job) for job in jobs]
+
+    # spawn: the parent may hold pipeline threads, forking them is not safe
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(out_dir, fmt),
+    ) as executor:
+        return list(executor.map(_render_in_worker, jobs))
+
+
+def generate_reports(data, risk_params, ref_stats, chart_ref_stats, out_dir, fmt="html", workers=None):
+    """Score the cohort once and write one report per sample; returns (paths, seconds)"""
+    from scoring_core import score_cohort
+
+    start = time.perf_counter()
+    results = score_cohort(data, risk_params, ref_stats, explain=True)
+    jobs = build_jobs(data, results, risk_params, chart_ref_stats)
+    paths = render_reports(jobs, out_dir, fmt=fmt, workers=workers)
+    return paths, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate one printable report per patient")
+    parser.add_argument("data", help="Metabolomic data (Excel), one sample per row")
+    parser.add_argument("--ref", default="Ref.xlsx", help="Reference workbook (Params_metaboscan, Ref_stats)")
+    parser.add_argument("--out", default="reports", help="Output directory")
+    parser.add_argument("--format", choices=FORMATS, default="html")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: CPU count, 1 = serial)")
+    args = parser.parse_args()
+
+    from scoring_core import calculate_metabolite_ratios, create_ref_stats_from_excel, read_ref_stats
+
+    data = calculate_metabolite_ratios(args.data)
+    risk_params = pd.read_excel(args.ref, sheet_name="Params_metaboscan")
+    ref_stats = read_ref_stats(args.ref, sheet_name="Ref_stats")
+    chart_ref_stats = create_ref_stats_from_excel(args.ref, sheet_name="Ref_stats")
+
+    paths, elapsed = generate_reports(
+        data, risk_params, ref_stats, chart_ref_stats, args.out, fmt=args.format, workers=args.workers)
+    print(f"Wrote {len(paths)} reports to {args.out} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+"""Plotting helpers for the report.
+
+matplotlib is imported on first use only, so importing this module (or the
+streamlit_utilit facade) stays cheap for code paths that never draw. Chart
+PNGs are served from the shared disk cache (chart_cache.py) when the same
+chart was rendered before by any session or report worker.
+"""
+import base64
+from functools import lru_cache
+from importlib.metadata import version
+from io import BytesIO
+import numpy as np
+import pandas as pd
+
+from chart_cache import content_key, default_cache
+from chart_panels import compile_reference, zscore_arrays
+from metrics import CHART_RENDER_SECONDS
+
+
+# Part of every chart cache key: bump when draw_z_scores or the PNG export changes the picture
+CHART_STYLE_VERSION = 1
+CHART_DPI = 300
+
+
+@lru_cache(maxsize=None)
+def _matplotlib_version():
+    return version("matplotlib")
+
+
+def _matplotlib():
+    """Lazy import of matplotlib and pyplot"""
+    import matplotlib as mpl
+    from matplotlib import pyplot as plt
+    return mpl, plt
+
+
+def get_color_under_normal_dist(n):
+    if n <= 0:
+        return '#10b981'
+    if n <= 10:
+        return '#10b962'  # Light green (similar to 9-10)
+    elif n <= 20:
+        return '#50c150'  # Light yellow (similar to 7-8)
+    elif n <= 30:
+        return '#9fd047'  # Light orange (similar to 5-6)
+    elif n <= 40:
+        return '#feb61d'  # Light orange (similar to 5-6)
+    elif n <= 50:
+        return '#fe991d'  # Light orange (similar to 5-6)
+    elif n <= 60:
+        return '#f25708'  # Light orange (similar to 5-6)
+    elif n <= 70:
+        return "#f23b08"  # Light orange (similar to 5-6)
+    elif n <= 80:
+        return '#f21e08'  # Light orange (similar to 5-6)
+    else:
+        return '#c90909'  # Orange-red (similar to 3-4)
+
+
+# Шкала цвета отклонения: верхние границы интервалов (%) и цвета, как в get_color_under_normal_dist
+DEVIATION_BOUNDS = np.array([0, 10, 20, 30, 40, 50, 60, 70, 80])
+DEVIATION_COLORS = np.array([
+    '#10b981', '#10b962', '#50c150', '#9fd047', '#feb61d',
+    '#fe991d', '#f25708', '#f23b08', '#f21e08', '#c90909',
+], dtype=object)
+
+GROUP_HEADER_HTML = (
+    '<div style="border-left: 5px solid {color}; padding: 10px; margin: 10px 0 5px 0; '
+    'background-color: #f0f2f6; border-radius: 5px; font-weight: bold;">'
+    '<div style="display: flex; justify-content: space-between;">'
+    '<span>{name}</span><span>Балл: {score:.0f}/10</span></div></div>'
+)
+CATEGORY_CARD_HTML = (
+    '<div style="border-left: 3px solid {color}; padding: 8px; margin: 2px 0 2px 15px; '
+    'background-color: #f8f9fa; border-radius: 3px;">'
+    '<div style="display: flex; justify-content: space-between;">'
+    '<span>{name}</span><span>{score:.1f}%</span></div>'
+    '<div style="height: 6px; background: #e9ecef; margin-top: 5px; border-radius: 3px;">'
+    '<div style="width: {width}%; height: 100%; background-color: {color}; border-radius: 3px;">'
+    '</div></div></div>'
+)
+
+
+def deviation_colors(values):
+    """Vectorised get_color_under_normal_dist (NaN gets the last colour, as there)"""
+    return DEVIATION_COLORS[np.searchsorted(DEVIATION_BOUNDS, np.asarray(values, dtype=np.float64))]
+
+
+def group_card_summary(risk_params_df, risk_scores):
+    """Одна строка на карточку категории, группы по алфавиту, с баллом и цветами группы"""
+    cards = (
+        risk_params_df[['Группа_риска', 'Категория', 'Subgroup_score']]
+        .dropna(subset=['Группа_риска'])
+        .drop_duplicates()
+        .sort_values('Группа_риска', kind='stable')
+    )
+    group_scores = (
+        pd.to_numeric(risk_scores['Риск-скор'], errors='coerce')
+        .groupby(risk_scores['Группа риска']).mean()
+    )
+    group_score = cards['Группа_риска'].map(group_scores).to_numpy(dtype=np.float64)
+    score = cards['Subgroup_score'].to_numpy(dtype=np.float64)
+    return pd.DataFrame({
+        'group': cards['Группа_риска'].to_numpy(),
+        'group_score': group_score,
+        'group_color': deviation_colors(100 - group_score * 10),
+        'category': cards['Категория'].to_numpy(),
+        'score': score,
+        'color': deviation_colors(score),
+        'width': 100 - score,
+    })
+
+
+def group_cards_html(summary):
+    """Все карточки групп риска и категорий одним HTML-блоком"""
+    parts = []
+    previous_group = None
+    for row in summary.itertuples(index=False):
+        if row.group != previous_group:
+            parts.append(GROUP_HEADER_HTML.format(
+                color=row.group_color, name=row.group, score=row.group_score))
+            previous_group = row.group
+        parts.append(CATEGORY_CARD_HTML.format(
+            color=row.color, name=row.category, score=row.score, width=row.width))
+    return "<div>" + "".join(parts) + "</div>"
+
+
+@CHART_RENDER_SECONDS.time(stage="draw")
+def draw_z_scores(group_title, display_names, values, colors, highlighted=(), missing_names=(),
+                  norm_ref=(-1, 1)):
+    """Bar chart of precomputed z-scores for one panel and one sample; returns the figure"""
+    mpl, plt = _matplotlib()
+
+    # Set font to Calibri
+    mpl.rcParams['font.family'] = 'Calibri'
+
+    values = [float(value) for value in values]
+    highlighted = list(highlighted) or [False] * len(values)
+
+    # Create figure - show empty plot if no valid data
+    fig, ax = plt.subplots(figsize=(8, 6), dpi=300)
+    if not values:
+        ax.text(
+            0.5,
+            0.5,
+            "No valid reference data available\nfor these metabolites",
+            ha='center',
+            va='center',
+            fontsize=14,
+            color='#6B7280',
+        )
+        ax.set_title(group_title, fontsize=20, pad=20, color='#404547', fontweight='bold')
+        for spine in ['top', 'right', 'bottom', 'left']:
+            ax.spines[spine].set_visible(False)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        plt.tight_layout()
+        return fig
+
+    # Create bars using display names
+    bars = ax.bar(
+        list(display_names),
+        values,
+        color=list(colors),
+        edgecolor='white',
+        linewidth=1,
+    )
+
+    # Add value labels on top of bars
+    for bar, height, is_highlighted in zip(bars, values, highlighted):
+        va = 'bottom' if height >= 0 else 'top'
+        y = height + 0.05 if height >= 0 else height - 0.05
+
+        # Determine text color - green if in highlight list, otherwise black
+        text_color = '#10b981' if is_highlighted else 'black'
+
+        # Adjust fontsize based on number of labels
+        fontsize = 11 if len(values) > 15 else 14
+
+        ax.text(
+            bar.get_x() + bar.get_width() / 2.0,
+            y,
+            f'{height:.2f}',
+            ha='center',
+            va=va,
+            fontsize=fontsize,
+            fontweight='bold',
+            color=text_color,
+        )
+
+    # Add horizontal lines
+    ax.axhline(0, color='#374151', linewidth=1)
+    ax.axhline(norm_ref[1], color='#6B7280', linestyle='--', linewidth=1)
+    ax.axhline(norm_ref[0], color='#6B7280', linestyle='--', linewidth=1)
+    ax.axhline(2, color='#6B7280', linestyle=':', linewidth=1, alpha=0.5)
+    ax.axhline(-2, color='#6B7280', linestyle=':', linewidth=1, alpha=0.5)
+
+    # Set title and labels
+    ax.set_title(group_title, fontsize=22, pad=20, color='#404547', fontweight='bold')
+    ax.set_ylabel(
+        f"Отклонение от состояния ЗДОРОВЫЙ, норма от {norm_ref[0]} до {norm_ref[1]}",
+        fontsize=14,
+        labelpad=15,
+    )
+
+    # Set y-axis scale with appropriate steps
+    y_min = round(min(-1.5, min(values)) - 0.2, 1)
+    y_max = round(max(1.5, max(values)) + 0.2, 1)
+    ax.set_ylim(y_min, y_max)
+
+    y_range = max(abs(y_min), abs(y_max))
+    step = (
+        5.0
+        if y_range > 15
+        else 2.5
+        if y_range > 12
+        else 2.0
+        if y_range > 10
+        else 1.0 
+        if y_range > 7 
+        else 0.75 
+        if y_range > 5 
+        else 0.5
+    )
+    ax.set_yticks(np.arange(np.floor(y_min), np.ceil(y_max) + step, step))
+
+    # Customize axes
+    for spine in ['top', 'right', 'bottom', 'left']:
+        ax.spines[spine].set_visible(False)
+    ax.xaxis.set_tick_params(length=0)
+    ax.yaxis.set_tick_params(length=0)
+    plt.yticks(fontsize=13)
+
+    # Adjust x-axis labels
+    xticklabels = ax.get_xticklabels()
+    for label in xticklabels:
+        display_name = label.get_text()
+        fontsize = 13.5 if len(display_name) > 20 else 15 if len(display_name) > 12 else 15.5
+        label.set_fontsize(fontsize)
+        label.set_rotation(45)
+        label.set_ha('right')
+
+    # Add warning about missing metabolites if needed
+    if missing_names:
+        missing_display_names = list(missing_names)
+        warning_text = f"Missing data for:\n{', '.join(missing_display_names[:3])}" + (
+            "..." if len(missing_display_names) > 3 else ""
+        )
+
+        ax.text(
+            1.02,
+            0.95,
+            warning_text,
+            transform=ax.transAxes,
+            fontsize=10,
+            color='#dc2626',
+            ha='left',
+            va='top',
+            bbox=dict(facecolor='white', alpha=0.8, edgecolor='#fecaca', pad=4),
+        )
+
+    plt.tight_layout()
+    return fig
+
+
+def metabolite_z_scores_figure(metabolite_concentrations, group_title, norm_ref=[-1, 1], ref_stats={}):
+    """Figure for an ad-hoc {metabolite: concentration} dict of one sample"""
+    return draw_z_scores(*metabolite_chart_args(metabolite_concentrations, group_title, norm_ref, ref_stats))
+
+
+def metabolite_chart_args(metabolite_concentrations, group_title, norm_ref=(-1, 1), ref_stats={}):
+    """draw_z_scores arguments for an ad-hoc {metabolite: concentration} dict of one sample"""
+    names = list(metabolite_concentrations)
+    concentrations = []
+    for name in names:
+        try:
+            concentrations.append(float(metabolite_concentrations[name]))
+        except (TypeError, ValueError):
+            concentrations.append(None)
+    reference = compile_reference(names, ref_stats)
+    numeric = np.array([conc is not None for conc in concentrations], dtype=bool)
+    shown = reference.has_reference & numeric
+    z_scores, colors, highlighted = zscore_arrays(
+        np.array([[np.nan if conc is None else conc for conc in concentrations]]), reference)
+    return (
+        group_title,
+        [name for name, keep in zip(reference.display_names, shown) if keep],
+        z_scores[0, shown],
+        colors[0, shown],
+        highlighted[0, shown],
+        [name for name, keep in zip(reference.missing_names, shown) if not keep],
+        norm_ref,
+    )
+
+
+def plot_metabolite_z_scores(metabolite_concentrations, group_title, norm_ref=[-1, 1], ref_stats={}):
+    return cached_chart_uri(*metabolite_chart_args(metabolite_concentrations, group_title, norm_ref, ref_stats))
+
+
+def panel_chart_args(panel_z_scores, position=0):
+    """draw_z_scores arguments of one evaluated panel (chart_panels.evaluate_panels) for one sample"""
+    return (
+        panel_z_scores.panel.title,
+        panel_z_scores.display_names,
+        panel_z_scores.z_scores[position],
+        panel_z_scores.colors[position],
+        panel_z_scores.highlighted[position],
+        panel_z_scores.missing_names,
+        panel_z_scores.panel.norm,
+    )
+
+
+def panel_figure(panel_z_scores, position=0):
+    """Figure of one evaluated panel for one sample"""
+    return draw_z_scores(*panel_chart_args(panel_z_scores, position))
+
+
+def plot_panel_z_scores(panel_z_scores, position=0):
+    """PNG data URI of one evaluated panel for one sample"""
+    return cached_chart_uri(*panel_chart_args(panel_z_scores, position))
+
+
+def chart_cache_key(group_title, display_names, values, colors, highlighted=(), missing_names=(),
+                    norm_ref=(-1, 1)):
+    """Content key of a chart: everything draw_z_scores and the PNG export depend on"""
+    return content_key({
+        "style": CHART_STYLE_VERSION,
+        "dpi": CHART_DPI,
+        "matplotlib": _matplotlib_version(),
+        "title": str(group_title),
+        "names": [str(name) for name in display_names],
+        "values": [repr(float(value)) for value in values],
+        "colors": [str(color) for color in colors],
+        "highlighted": [bool(flag) for flag in highlighted],
+        "missing": [str(name) for name in missing_names],
+        "norm": [float(bound) for bound in norm_ref],
+    })
+
+
+def cached_chart_uri(*draw_args):
+    """PNG data URI of a draw_z_scores chart, rendered only on a disk cache miss"""
+    cache = default_cache()
+    if cache is None:
+        return fig_to_uri(draw_z_scores(*draw_args))
+    key = chart_cache_key(*draw_args)
+    png = cache.get(key)
+    if png is None:
+        png = fig_to_png(draw_z_scores(*draw_args))
+        try:
+            cache.put(key, png)
+        except OSError as e:
+            print(f"Chart cache write failed: {e}")
+    return png_to_uri(png)
+
+
+@CHART_RENDER_SECONDS.time(stage="encode")
+def fig_to_png(fig):
+    """PNG bytes of a matplotlib figure; the figure is closed"""
+    _, plt = _matplotlib()
+    buf = BytesIO()
+    fig.savefig(buf, format="png", dpi=CHART_DPI, bbox_inches='tight')
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def png_to_uri(png):
+    return f"data:image/png;base64,{base64.b64encode(png).decode('ascii')}"
+
+
+def fig_to_uri(fig):
+    """Convert matplotlib figure to data URI"""
+    return png_to_uri(fig_to_png(fig))
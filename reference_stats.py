@@ -0,0 +1,383 @@
+"""Референсные статистики (лист Ref_stats) из образцов здоровых контролей.
+
+Control samples (a folder of exports, an archive or a cohort store) are read
+chunk by chunk, ratios are added as in calculate_metabolite_ratios, and every
+marker column goes into a one-pass accumulator: count, mean and the sum of
+squared deviations are merged per chunk with the Welford/Chan update, and a
+log-binned histogram with 1% relative accuracy gives the reference interval
+(2.5th-97.5th percentile) without keeping the samples. The accumulator is saved
+in a state file together with the SHA-256 of every source already counted;
+the next run adds only new controls and never rescans the history.
+
+Definitions: mean and sd are the plain sample mean and standard deviation
+(n - 1 denominator) of every finite value, zeros included, without outlier
+exclusion. ref_min/ref_max are the 2.5th and 97.5th percentiles (the value of
+rank q * (n - 1), lower neighbour), read from the histogram within 1%,
+clipped to the observed range and rounded to 3 significant digits.
+
+These are not the definitions behind the bundled Ref.xlsx. On its Controls
+sheet the means agree (162 of 164 exactly), but the sd come out about 1.3x
+larger (no common robust, trimmed or clipped SD reproduces them), and
+ref_min/ref_max are laboratory limits rather than control percentiles. Every run therefore
+writes a per-marker comparison with the base Ref_stats (<out>_compare.csv)
+and prints a summary; --rows replaces only some rows, e.g. --rows mean sd.
+
+The output is a copy of the base reference workbook with the new rows in
+Ref_stats, ready for --ref or the app's upload.
+Markers with fewer than --min-controls values keep their base values. The
+state is saved only after the workbook has been written; --rebuild writes it
+again from the saved state (e.g. for another --base or --min-controls).
+
+Usage:
+    python reference_stats.py controls/ --state controls.refstate.json --base Ref.xlsx --out Ref_v2.xlsx
+    python reference_stats.py new_controls.csv --state controls.refstate.json --out Ref_v3.xlsx
+    python reference_stats.py --state controls.refstate.json --rebuild --base Ref_lab.xlsx --out Ref_lab_v3.xlsx
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from archive_scoring import read_chunks
+from cohort import CohortMatrix
+from cohort_store import STORE_SUFFIX, is_cohort_store, values_path
+from scoring_core import calculate_cohort_ratios
+
+STATE_FORMAT_VERSION = 1
+CONTROL_EXTENSIONS = (".csv", ".xlsx", ".xlsm", ".parquet")
+READ_CHUNK_ROWS = 10000
+
+REF_QUANTILES = (0.025, 0.975)
+DEFAULT_MIN_CONTROLS = 20
+# Relative accuracy of the percentile histogram
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# Histogram key = column * BIN_SPAN + BIN_OFFSET + bin; bin -BIN_OFFSET holds zeros
+BIN_OFFSET = 2**20
+BIN_SPAN = 2**21
+
+STAT_ROWS = ("mean", "sd", "ref_min", "ref_max")
+# ref_min/ref_max are shown as the norm on the charts; the histogram is 1% accurate anyway
+LIMIT_SIGNIFICANT_DIGITS = 3
+# Relative change against the base Ref_stats reported in the run summary
+COMPARE_THRESHOLD = 0.1
+
+
+class ReferenceAccumulator:
+    """Streaming per-column count/mean/M2/min/max and percentile histogram"""
+
+    def __init__(self):
+        self.columns = []
+        self._positions = {}
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+        self.bins = pd.Series(dtype=np.int64)  # histogram key -> count
+
+    def _extend(self, columns):
+        new = [name for name in columns if name not in self._positions]
+        if not new:
+            return
+        for name in new:
+            self._positions[name] = len(self.columns)
+            self.columns.append(name)
+        self.count = np.concatenate([self.count, np.zeros(len(new), dtype=np.int64)])
+        self.mean = np.concatenate([self.mean, np.zeros(len(new))])
+        self.m2 = np.concatenate([self.m2, np.zeros(len(new))])
+        self.min = np.concatenate([self.min, np.full(len(new), np.nan)])
+        self.max = np.concatenate([self.max, np.full(len(new), np.nan)])
+
+    def update(self, cohort):
+        """Add every sample of a ratio-augmented CohortMatrix"""
+        self._extend(cohort.columns)
+        positions = np.array([self._positions[name] for name in cohort.columns], dtype=np.int64)
+        values = np.asarray(cohort.values, dtype=np.float64)
+        valid = np.isfinite(values)
+
+        count = valid.sum(axis=0)
+        has = count > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(has, np.where(valid, values, 0).sum(axis=0) / count, 0.0)
+        m2 = np.where(valid, (values - mean) ** 2, 0).sum(axis=0)
+
+        # Chan et al. merge of (count, mean, M2) of the history and of the chunk
+        total = self.count[positions] + count
+        delta = mean - self.mean[positions]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            share = np.where(total > 0, count / total, 0.0)
+        self.m2[positions] += m2 + delta ** 2 * self.count[positions] * share
+        self.mean[positions] += delta * share
+        self.count[positions] = total
+
+        low = np.where(has, np.where(valid, values, np.inf).min(axis=0), np.nan)
+        high = np.where(has, np.where(valid, values, -np.inf).max(axis=0), np.nan)
+        self.min[positions] = np.fmin(self.min[positions], low)
+        self.max[positions] = np.fmax(self.max[positions], high)
+
+        rows, cols = np.nonzero(valid)
+        self._add_bins(positions[cols], values[rows, cols])
+
+    def _add_bins(self, positions, values):
+        with np.errstate(divide="ignore"):
+            bins = np.where(values > 0, np.ceil(np.log(values) / np.log(SKETCH_GAMMA)), -BIN_OFFSET)
+        keys = positions * BIN_SPAN + BIN_OFFSET + bins.astype(np.int64)
+        keys, counts = np.unique(keys, return_counts=True)
+        self.bins = self.bins.add(pd.Series(counts, index=keys), fill_value=0).astype(np.int64)
+
+    def quantiles(self, name, quantiles=REF_QUANTILES):
+        """Histogram estimate of the quantiles of one column, within 1% relative error"""
+        position = self._positions[name]
+        keys = self.bins.index.to_numpy()
+        column = self.bins[(keys >= position * BIN_SPAN) & (keys < (position + 1) * BIN_SPAN)].sort_index()
+        if column.empty:
+            return [np.nan] * len(quantiles)
+        bins = column.index.to_numpy() - position * BIN_SPAN - BIN_OFFSET
+        ranks = np.cumsum(column.to_numpy())
+        found = np.searchsorted(ranks, np.asarray(quantiles) * (ranks[-1] - 1), side="right")
+        centres = np.where(bins > -BIN_OFFSET, 2 * SKETCH_GAMMA ** bins.astype(np.float64) / (SKETCH_GAMMA + 1), 0.0)
+        return np.clip(centres[found], self.min[position], self.max[position]).tolist()
+
+    def stats(self):
+        """Columns x (n, mean, sd, ref_min, ref_max)"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sd = np.sqrt(np.where(self.count > 1, self.m2 / (self.count - 1), np.nan))
+        table = pd.DataFrame({
+            "n": self.count,
+            "mean": np.where(self.count > 0, self.mean, np.nan),
+            "sd": sd,
+        }, index=pd.Index(self.columns, name="metabolite"))
+        limits = [self.quantiles(name) for name in self.columns]
+        table["ref_min"] = [low for low, _ in limits]
+        table["ref_max"] = [high for _, high in limits]
+        return table
+
+    def to_state(self):
+        return {
+            "columns": self.columns,
+            "count": self.count.tolist(),
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "bin_keys": self.bins.index.tolist(),
+            "bin_counts": self.bins.tolist(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        accumulator = cls()
+        accumulator._extend(state["columns"])
+        accumulator.count = np.asarray(state["count"], dtype=np.int64)
+        accumulator.mean = np.asarray(state["mean"], dtype=np.float64)
+        accumulator.m2 = np.asarray(state["m2"], dtype=np.float64)
+        accumulator.min = np.asarray(state["min"], dtype=np.float64)
+        accumulator.max = np.asarray(state["max"], dtype=np.float64)
+        accumulator.bins = pd.Series(state["bin_counts"], index=state["bin_keys"], dtype=np.int64)
+        return accumulator
+
+
+def control_sources(paths):
+    """Files and cohort stores to read; folders are expanded one level"""
+    sources = []
+    for path in paths:
+        if os.path.isdir(path) and not is_cohort_store(path):
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                lower = entry.name.lower()
+                if entry.name.startswith(("~$", ".")):
+                    continue
+                if (entry.is_file() and lower.endswith(CONTROL_EXTENSIONS)) or (
+                        lower.endswith(STORE_SUFFIX) and is_cohort_store(entry.path)):
+                    sources.append(entry.path)
+        else:
+            sources.append(path)
+    return sources
+
+
+def source_digest(path):
+    """SHA-256 of the file (of values.npy for a cohort store): the same controls are counted once"""
+    digest = hashlib.sha256()
+    with open(values_path(path) if is_cohort_store(path) else path, "rb") as f:
+        while block := f.read(2**20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def control_chunks(path, chunk_rows=READ_CHUNK_ROWS):
+    """Ratio-augmented CohortMatrix chunks of one source"""
+    for chunk in read_chunks(path, chunk_rows):
+        if isinstance(chunk, CohortMatrix):
+            yield chunk  # a cohort store already holds the ratios
+        else:
+            yield calculate_cohort_ratios(CohortMatrix.from_frame(chunk, dtype=np.float64))
+
+
+def load_state(path):
+    """(accumulator, state) from a state file; an empty accumulator if there is none"""
+    if path is None or not os.path.exists(path):
+        return ReferenceAccumulator(), {"format_version": STATE_FORMAT_VERSION, "version": 0, "sources": []}
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("format_version") != STATE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported reference state format in {path}")
+    return ReferenceAccumulator.from_state(state["accumulator"]), state
+
+
+def save_state(path, accumulator, state):
+    state = dict(state, accumulator=accumulator.to_state())
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def add_controls(accumulator, state, paths):
+    """Count every source not seen before; returns the number of new samples"""
+    seen = {source["sha256"] for source in state["sources"]}
+    added = 0
+    for path in control_sources(paths):
+        digest = source_digest(path)
+        if digest in seen:
+            print(f"{os.path.basename(path)}: already counted, skipped")
+            continue
+        samples = 0
+        for cohort in control_chunks(path):
+            accumulator.update(cohort)
+            samples += len(cohort)
+        state["sources"].append({
+            "name": os.path.basename(path.rstrip(os.sep)),
+            "sha256": digest,
+            "samples": samples,
+            "added": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+        seen.add(digest)
+        added += samples
+        print(f"{os.path.basename(path.rstrip(os.sep))}: {samples} controls")
+    return added
+
+
+def reference_sheet(base_sheet, stats, min_controls=DEFAULT_MIN_CONTROLS, stat_rows=STAT_ROWS):
+    """Ref_stats sheet (raw layout, header=None) with new statistics for markers with enough controls.
+
+    Only stat_rows are replaced. Returns the sheet and the list of markers that kept their base values.
+    """
+    sheet = base_sheet.copy()
+    rows = {name: i for i, name in enumerate(sheet.iloc[:, 0])}
+    kept = []
+    for j in range(1, sheet.shape[1]):
+        marker = sheet.iat[0, j]
+        if marker not in stats.index or stats.at[marker, "n"] < min_controls:
+            kept.append(marker)
+            continue
+        for stat in stat_rows:
+            value = stats.at[marker, stat]
+            if stat in ("ref_min", "ref_max") and np.isfinite(value):
+                value = float(f"{value:.{LIMIT_SIGNIFICANT_DIGITS}g}")
+            sheet.iat[rows[stat], j] = value
+    return sheet, kept
+
+
+def compare_reference(base_sheet, ref_sheet, stats):
+    """Per marker: n, base and new value of every stat row and the relative change"""
+    def stat_table(sheet):
+        rows = sheet.set_index(0).loc[list(STAT_ROWS)]
+        return pd.DataFrame(rows.to_numpy(dtype=np.float64).T, columns=STAT_ROWS,
+                            index=pd.Index(sheet.iloc[0, 1:], name="metabolite"))
+
+    base, new = stat_table(base_sheet), stat_table(ref_sheet)
+    table = pd.DataFrame({"n": stats["n"].reindex(base.index).fillna(0).astype(np.int64)})
+    for stat in STAT_ROWS:
+        table[f"{stat}_base"] = base[stat]
+        table[f"{stat}_new"] = new[stat]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            table[f"{stat}_change"] = new[stat] / base[stat] - 1
+    return table
+
+
+def comparison_summary(comparison, threshold=COMPARE_THRESHOLD):
+    """One line per stat row: how many markers changed by more than threshold"""
+    lines = []
+    for stat in STAT_ROWS:
+        change = comparison[f"{stat}_change"].abs()
+        changed = int((change > threshold).sum())
+        lines.append(f"{stat}: median change {change.median():.1%}, "
+                     f"{changed} of {change.notna().sum()} markers changed by more than {threshold:.0%}")
+    return lines
+
+
+def write_reference(base_path, stats, out_path, min_controls=DEFAULT_MIN_CONTROLS, stat_rows=STAT_ROWS):
+    """Copy of the base workbook with Ref_stats replaced.
+
+    Returns the markers that kept base values and the comparison with the base Ref_stats.
+    """
+    sheets = pd.read_excel(base_path, sheet_name=None)
+    base_sheet = pd.read_excel(base_path, sheet_name="Ref_stats", header=None)
+    ref_sheet, kept = reference_sheet(base_sheet, stats, min_controls, stat_rows)
+    tmp_path = out_path[:-len(".xlsx")] + ".tmp.xlsx"
+    with pd.ExcelWriter(tmp_path) as writer:
+        for sheet_name, frame in sheets.items():
+            if sheet_name == "Ref_stats":
+                ref_sheet.to_excel(writer, sheet_name=sheet_name, header=False, index=False)
+            else:
+                frame.to_excel(writer, sheet_name=sheet_name, index=False)
+    os.replace(tmp_path, out_path)
+    return kept, compare_reference(base_sheet, ref_sheet, stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the Ref_stats sheet from healthy-control samples")
+    parser.add_argument("controls", nargs="*", help="Control exports, folders of them, archives or cohort stores")
+    parser.add_argument("--state", required=True, help="Accumulator state file, created on the first run")
+    parser.add_argument("--base", default="Ref.xlsx", help="Reference workbook to copy the other sheets from")
+    parser.add_argument("--out", help="New reference workbook (default: Ref_v<version>.xlsx next to the state)")
+    parser.add_argument("--min-controls", type=int, default=DEFAULT_MIN_CONTROLS,
+                        help="Markers with fewer values keep their base statistics")
+    parser.add_argument("--rows", nargs="+", choices=STAT_ROWS, default=list(STAT_ROWS),
+                        help="Ref_stats rows to replace, e.g. --rows mean sd to keep the base limits")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Write the workbook from the saved state even without new controls")
+    args = parser.parse_args()
+
+    accumulator, state = load_state(args.state)
+    start = time.perf_counter()
+    added = add_controls(accumulator, state, args.controls)
+    total = sum(source["samples"] for source in state["sources"])
+    print(f"Added {added} controls in {time.perf_counter() - start:.1f}s, {total} in total")
+    if not added and not args.rebuild:
+        print("No new controls, reference unchanged (--rebuild writes it again from the state)")
+        return
+    if not total:
+        print("No controls counted yet, nothing to write")
+        return
+
+    # The state is saved only after the workbook is written, so a failed write can be rerun
+    version = state["version"] + 1 if added else state["version"]
+    out_path = args.out or os.path.join(os.path.dirname(os.path.abspath(args.state)),
+                                        f"Ref_v{version}.xlsx")
+    try:
+        kept, comparison = write_reference(args.base, accumulator.stats(), out_path,
+                                           args.min_controls, args.rows)
+    except Exception as e:
+        print(f"Error writing reference {out_path}: {e}")
+        print("State not updated, fix the error and run again")
+        return
+    if added:
+        state["version"] = version
+        save_state(args.state, accumulator, state)
+    compare_path = out_path[:-len(".xlsx")] + "_compare.csv"
+    comparison.to_csv(compare_path, encoding="utf-8-sig")
+    print(f"Changes against {args.base} (per marker in {compare_path}):")
+    for line in comparison_summary(comparison):
+        print("  " + line)
+    if kept:
+        print(f"{len(kept)} markers with fewer than {args.min_controls} controls kept base values: "
+              + ", ".join(map(str, kept)))
+    print(f"Reference version {version} written to {out_path}")
+
+if __name__ == "__main__":
+    main()
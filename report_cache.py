@@ -0,0 +1,78 @@
+"""Рассчитанные отчеты между перезапусками Streamlit.
+
+Every widget interaction reruns the app script from the top. A computed
+report (risk tables, card summaries, rendered chart images) is kept in
+``st.session_state`` under a key made from the upload bytes and the edited
+reference sheets, so a rerun with the same inputs re-displays it without
+recomputation. ``ReportCache`` bounds the memory held this way and evicts
+the least recently shown reports first.
+"""
+import hashlib
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from metrics import cache_lookup
+
+DEFAULT_MAX_MB = 256
+
+
+def report_key(upload_bytes, ref_sheets):
+    """Hash of the uploaded file and a fingerprint of every reference sheet"""
+    digest = hashlib.sha256(upload_bytes)
+    for sheet_name in sorted(ref_sheets):
+        frame = ref_sheets[sheet_name]
+        digest.update(str(sheet_name).encode())
+        digest.update("\x1f".join(map(str, frame.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def report_nbytes(value):
+    """Approximate memory held by a report: tables, arrays, strings and containers of them"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(report_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(report_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class ReportCache:
+    """Reports by key, least recently used first; the newest report is always kept"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_MB * 2**20):
+        self.max_bytes = max_bytes
+        self._reports = OrderedDict()  # key -> (report, nbytes)
+
+    def __contains__(self, key):
+        return key in self._reports
+
+    def __len__(self):
+        return len(self._reports)
+
+    @property
+    def nbytes(self):
+        return sum(nbytes for _, nbytes in self._reports.values())
+
+    def get(self, key):
+        """The report, marked as most recently used; None if absent or evicted"""
+        if not cache_lookup("reports", key in self._reports):
+            return None
+        self._reports.move_to_end(key)
+        return self._reports[key][0]
+
+    def put(self, key, report):
+        """Store a report and evict older ones over the cap; returns the evicted keys"""
+        self._reports[key] = (report, report_nbytes(report))
+        self._reports.move_to_end(key)
+        evicted = []
+        while len(self._reports) > 1 and self.nbytes > self.max_bytes:
+            old_key, _ = self._reports.popitem(last=False)
+            evicted.append(old_key)
+        return evicted
@@ -0,0 +1,686 @@
+"""Scoring core: ratios, z-scores, banding and disease pipelines.
+
+Imports only numpy/pandas/joblib so batch and service code can use it without
+pulling in matplotlib or Streamlit. Plotting lives in plot_utilit.py.
+"""
+import os
+import time
+import pandas as pd
+import numpy as np
+
+from cohort import ID_COLUMN, CohortMatrix, ConcentrationStore
+from dedup import find_duplicates
+from metrics import RATIO_SECONDS, SAMPLES_SCORED, SCORING_SECONDS
+from models.registry import registry
+from models.scheduler import run_pipelines
+from models.scoring import ScoreMapping, probabilities_to_scores
+from models.uncertainty import INTERVAL_COLUMNS
+
+# Группы, для которых используем только ML модели
+ML_ONLY_GROUPS = {
+    "Состояние сердечно-сосудистой системы",
+    "Состояние функции печени",
+    "Оценка пролиферативных процессов",
+}
+
+# Features listed per ML score when explanations are requested
+EXPLAIN_TOP = 3
+DRIVERS_COLUMN = "Основные факторы"
+
+def metabolite_ratio_columns(data):
+    """Ratio columns keyed by name; data is a DataFrame or a CohortMatrix"""
+    # Prepare all new columns in a dictionary first
+    new_columns = {}
+    
+    # Acylcarnitines
+    new_columns['(C2+C3)/C0'] = (data['C2'] + data['C3']) / data['C0']
+    new_columns['CACT Deficiency (NBS)'] = data['C0'] / (data['C16'] + data['C18'])
+    new_columns['CPT-1 Deficiency (NBS)'] = (data['C16'] + data['C18']) / data['C0']
+    new_columns['CPT-2 Deficiency (NBS)'] = (data['C16'] + data['C18']) / data['C2']
+    new_columns['EMA (NBS)'] = data['C4'] / data['C8']
+    new_columns['IBD Deficiency (NBS)'] = data['C4'] / data['C2']
+    new_columns['IVA (NBS)'] = data['C5'] / data['C2']
+    new_columns['LCHAD Deficiency (NBS)'] = data['C16-OH'] / data['C16']
+    new_columns['MA (NBS)'] = data['C3'] / data['C2']
+    new_columns['MC Deficiency (NBS)'] = data['C16'] / data['C3']
+    new_columns['MCAD Deficiency (NBS)'] = data['C8'] / data['C2']
+    new_columns['MCKAT Deficiency (NBS)'] = data['C8'] / data['C10']
+    new_columns['MMA (NBS)'] = data['C3'] / data['C0']
+    new_columns['PA (NBS)'] = data['C3'] / data['C16']
+    new_columns['С2/С0'] = data['C2'] / data['C0']
+    new_columns['Ratio of Acetylcarnitine to Carnitine'] = data['C2'] / data['C0']
+    
+    # Calculate sums once to reuse
+    sum_AC_OHs = (data['C5-OH'] + data['C14-OH'] + data['C16-1-OH'] + 
+                 data['C16-OH'] + data['C18-1-OH'] + data['C18-OH'])
+    sum_ACs = (data['C0'] + data['C10'] + data['C10-1'] + data['C10-2'] + 
+              data['C12'] + data['C12-1'] + data['C14'] + data['C14-1'] + 
+              data['C14-2'] + data['C16'] + data['C16-1'] + data['C18'] + 
+              data['C18-1'] + data['C18-2'] + data['C2'] + data['C3'] + 
+              data['C4'] + data['C5'] + data['C5-1'] + data['C5-DC'] + 
+              data['C6'] + data['C6-DC'] + data['C8'] + data['C8-1'])
+    
+    new_columns['Ratio of AC-OHs to ACs'] = sum_AC_OHs / sum_ACs
+    
+    СДК = (data['C14'] + data['C14-1'] + data['C14-2'] + data['C14-OH'] + 
+           data['C16'] + data['C16-1'] + data['C16-1-OH'] + data['C16-OH'] + 
+           data['C18'] + data['C18-1'] + data['C18-1-OH'] + data['C18-2'] + 
+           data['C18-OH'])
+    ССК = (data['C6'] + data['C6-DC'] + data['C8'] + data['C8-1'] + 
+           data['C10'] + data['C10-1'] + data['C10-2'] + data['C12'] + 
+           data['C12-1'])
+    СКК = (data['C2'] + data['C3'] + data['C4'] + data['C5'] + data['C5-1'] + 
+           data['C5-DC'] + data['C5-OH'])
+    
+    new_columns['СДК'] = СДК
+    new_columns['ССК'] = ССК
+    new_columns['СКК'] = СКК
+    new_columns['Ratio of Medium-Chain to Long-Chain ACs'] = ССК / СДК
+    new_columns['Ratio of Short-Chain to Long-Chain ACs'] = СКК / СДК
+    new_columns['Ratio of Short-Chain to Medium-Chain ACs'] = СКК / ССК
+    new_columns['SBCAD Deficiency (NBS)'] = data['C5'] / data['C0']
+    new_columns['SCAD Deficiency (NBS)'] = data['C4'] / data['C3']
+    new_columns['Sum of ACs'] = sum_AC_OHs + sum_ACs - data['C0']  # Subtract C0 since it's included in sum_ACs
+    new_columns['Sum of ACs + С0'] = sum_AC_OHs + sum_ACs
+    new_columns['Sum of ACs/C0'] = (sum_AC_OHs + sum_ACs - data['C0']) / data['C0']
+    
+    new_columns['Sum of MUFA-ACs'] = (data['C16-1-OH'] + data['C18-1-OH'] + 
+                                    data['C10-1'] + data['C12-1'] + 
+                                    data['C14-1'] + data['C16-1'] + 
+                                    data['C18-1'] + data['C8-1'] + 
+                                    data['C5-1'])
+    new_columns['Sum of PUFA-ACs'] = data['C10-2'] + data['C14-2'] + data['C18-2']
+    new_columns['TFP Deficiency (NBS)'] = data['C16'] / data['C16-OH']
+    new_columns['VLCAD Deficiency (NBS)'] = data['C14-1'] / data['C16']
+    new_columns['(C6+C8+C10)/C2'] = (data['C6'] + data['C8'] + data['C10']) / data['C2']
+    new_columns['2MBG (NBS)'] = data['C5'] / data['C3']
+    new_columns['Carnitine Uptake Defect (NBS)'] = (data['C0'] + data['C2'] + data['C3'] + 
+                                                   data['C16'] + data['C18'] + 
+                                                   data['C18-1']) / data['Citrulline']
+
+    new_columns['C2 / C3'] = data['C2'] / data['C3']
+    # NO- and urea cycle
+    new_columns['GABR'] = data['Arginine'] / (data['Ornitine'] + data['Citrulline'])
+    new_columns['Orn Synthesis'] = data['Ornitine'] / data['Arginine']
+    new_columns['AOR'] = data['Arginine'] / data['Ornitine']
+    new_columns['ADMA/(Adenosin+Arginine)'] = data['ADMA'] / (data['Adenosin'] + data['Arginine'])
+    new_columns["Asymmetrical Arg Methylation"] = data['ADMA'] / data['Arginine']
+    new_columns['Symmetrical Arg Methylation'] = data['TotalDMA (SDMA)'] / data['Arginine']
+    new_columns['(Arg+HomoArg)/ADMA'] = (data['Arginine'] + data['Homoarginine']) / data['ADMA']
+    new_columns['ADMA / NMMA'] = data['ADMA'] / data['NMMA']
+    new_columns['NO-Synthase Activity'] = data['Citrulline'] / data['Arginine']
+    new_columns['OTC Deficiency (NBS)'] = data['Ornitine'] / data['Citrulline']
+    new_columns['Ratio of HArg to ADMA'] = data['Homoarginine'] / data['ADMA']
+    new_columns['Ratio of HArg to SDMA'] = data['Homoarginine'] / data['TotalDMA (SDMA)']
+    new_columns['Sum of Asym. and Sym. Arg Methylation'] = (data['TotalDMA (SDMA)'] + data['ADMA']) / data['Arginine']
+    new_columns['Sum of Dimethylated Arg'] = data['TotalDMA (SDMA)'] + data['ADMA']
+    new_columns['Cit Synthesis'] = data['Citrulline'] / data['Ornitine']
+    new_columns['CPS Deficiency (NBS)'] = data['Citrulline'] / data['Phenylalanine']
+    new_columns['HomoArg Synthesis'] = data['Homoarginine'] / (data['Arginine'] + data['Lysine'])
+    new_columns['Ratio of Pro to Cit'] = data['Proline'] / data['Citrulline']
+
+    # Tryptophan metabolism
+    new_columns['Kynurenine / Trp'] = data['Kynurenine'] / data['Tryptophan']
+    new_columns['Serotonin / Trp'] = data['Serotonin'] / data['Tryptophan']
+    new_columns['Trp/(Kyn+QA)'] = data['Tryptophan'] / (data['Kynurenine'] + data['Quinolinic acid'])
+    new_columns['Kyn/Quin'] = data['Kynurenine'] / data['Quinolinic acid']
+    new_columns['Quin/HIAA'] = data['Quinolinic acid'] / data['HIAA']
+    new_columns['Tryptamine / IAA'] = data['Tryptamine'] / data['Indole-3-acetic acid']
+    new_columns['Kynurenic acid / Kynurenine'] = data['Kynurenic acid'] / data['Kynurenine']
+
+    # Amino acids
+    new_columns['Asn Synthesis'] = data['Asparagine'] / data['Aspartic acid']
+    new_columns['Glutamine/Glutamate'] = data['Glutamine'] / data['Glutamic acid']
+    new_columns['Gly Synthesis'] = data['Glycine'] / data['Serine']
+    new_columns['GSG Index'] = data['Glutamic acid'] / (data['Serine'] + data['Glycine'])
+    new_columns['GSG_index'] = data['Glutamic acid'] / (data['Serine'] + data['Glycine'])
+    new_columns['Sum of Aromatic AAs'] = data['Phenylalanine'] + data['Tyrosin']
+    new_columns['BCAA'] = data['Summ Leu-Ile'] + data['Valine']
+    new_columns['BCAA/AAA'] = (data['Valine'] + data['Summ Leu-Ile']) / (data['Phenylalanine'] + data['Tyrosin'])
+    new_columns['Alanine / Valine'] = data['Alanine'] / data['Valine']
+    new_columns['DLD (NBS)'] = data['Proline'] / data['Phenylalanine']
+    new_columns['MTHFR Deficiency (NBS)'] = data['Methionine'] / data['Phenylalanine']
+    
+    # Calculate sums once for AA ratios
+    sum_non_essential = (data['Alanine'] + data['Arginine'] + data['Asparagine'] + 
+                       data['Aspartic acid'] + data['Glutamine'] + 
+                       data['Glutamic acid'] + data['Glycine'] + data['Proline'] + 
+                       data['Serine'] + data['Tyrosin'])
+    sum_essential = (data['Histidine'] + data['Summ Leu-Ile'] + data['Lysine'] + 
+                    data['Methionine'] + data['Phenylalanine'] + 
+                    data['Threonine'] + data['Tryptophan'] + data['Valine'])
+    
+    new_columns['Ratio of Non-Essential to Essential AAs'] = sum_non_essential / sum_essential
+    new_columns['Sum of AAs'] = sum_non_essential + sum_essential
+    new_columns['Sum of Essential Aas'] = sum_essential
+    new_columns['Sum of Non-Essential AAs'] = sum_non_essential
+    new_columns['Sum of Solely Glucogenic AAs'] = (data['Alanine'] + data['Arginine'] + 
+                                                 data['Asparagine'] + data['Aspartic acid'] + 
+                                                 data['Glutamine'] + data['Glutamic acid'] + 
+                                                 data['Glycine'] + data['Histidine'] + 
+                                                 data['Methionine'] + data['Proline'] + 
+                                                 data['Serine'] + data['Threonine'] + 
+                                                 data['Valine'])
+    new_columns['Sum of Solely Ketogenic AAs'] = data['Summ Leu-Ile'] + data['Lysine']
+    new_columns['Valinemia (NBS)'] = data['Valine'] / data['Phenylalanine']
+    new_columns['Carnosine Synthesis'] = data['Carnosine'] / data['Histidine']
+    new_columns['Histamine Synthesis'] = data['Histamine'] / data['Histidine']
+
+    # Betaine_choline metabolism
+    new_columns['Betaine/choline'] = data['Betaine'] / data['Choline']
+    new_columns['Methionine + Taurine'] = data['Methionine'] + data['Taurine']
+    new_columns['DMG / Choline'] = data['DMG'] / data['Choline']
+    new_columns['TMAO Synthesis'] = data['TMAO'] / (data['Betaine'] + data['C0'] + data['Choline'])
+    new_columns['TMAO Synthesis (direct)'] = data['TMAO'] / data['Choline']
+    new_columns['Met Oxidation'] = data['Methionine-Sulfoxide'] / data['Methionine']
+
+    # Vitamins
+    new_columns['Riboflavin / Pantothenic'] = data['Riboflavin'] / data['Pantothenic']
+
+    # ADDED: Oncology-specific ratios that were missing
+    new_columns['Arg/ADMA'] = data['Arginine'] / data['ADMA']
+    new_columns['Arg/Orn+Cit'] = data['Arginine'] / (data['Ornitine'] + data['Citrulline'])
+    new_columns['Glutamine/Glutamate'] = data['Glutamine'] / data['Glutamic acid']
+    new_columns['Pro/Cit'] = data['Proline'] / data['Citrulline']
+    new_columns['Kyn/Trp'] = data['Kynurenine'] / data['Tryptophan']
+    new_columns['Trp/Kyn'] = data['Tryptophan'] / data['Kynurenine']
+    
+    # Arthritis
+    new_columns['Phe/Tyr'] = data['Phenylalanine'] / data['Tyrosin']
+    new_columns['Glycine/Serine'] = data['Glycine'] / data['Serine']
+    # Lungs
+    new_columns['C4 / C2'] = data['C4'] / data['C2']
+    new_columns['Valine / Alanine'] = data['Valine'] / data['Alanine']
+    # Liver
+    new_columns['C0/(C16+C18)'] = data['C0'] / (data['C16'] + data['C18'])
+    new_columns['(Leu+IsL)/(C3+С5+С5-1+C5-DC)'] = (data['Summ Leu-Ile']) / (data['C3'] + data['C5'] + data['C5-1'] + data['C5-DC'])
+    new_columns['Val/C4'] = data['Valine'] / data['C4']
+    new_columns['(C16+C18)/C2'] = (data['C16'] + data['C18']) / data['C2']
+    new_columns['C3 / C0'] = data['C3'] / data['C0']
+
+    return new_columns
+
+
+@RATIO_SECONDS.time(input="frame")
+def calculate_metabolite_ratios(metabolomic_data):
+    """Calculate all metabolite ratios from raw metabolomic data"""
+    # Read data
+    data = pd.read_excel(metabolomic_data)
+    
+    # Replace all negative values with 0 in the entire DataFrame
+    data = data.map(lambda x: 0 if isinstance(x, (int, float)) and x < 0 else x)
+    
+    try:
+        # Convert the dictionary to a DataFrame
+        new_data = pd.DataFrame(metabolite_ratio_columns(data))
+
+        # Get columns that exist in both DataFrames
+        common_cols = data.columns.intersection(new_data.columns)
+
+        # For overlapping columns, fill NaN in original data with new_data values
+        for col in common_cols:
+            data[col] = data[col].fillna(new_data[col])
+
+        # Get columns that only exist in new_data
+        new_cols_only = new_data.columns.difference(data.columns)
+
+        # Add the new columns
+        data = pd.concat([data, new_data[new_cols_only]], axis=1)
+
+        # Drop Group column if it exists
+        if 'Group' in data.columns:
+            data = data.drop('Group', axis=1)
+
+        return data
+
+    except Exception as e:
+        print(f"Error calculating metabolite ratios: {str(e)}")
+        return None
+
+@RATIO_SECONDS.time(input="cohort")
+def calculate_cohort_ratios(cohort):
+    """Ratio-augmented CohortMatrix, same column rules as calculate_metabolite_ratios"""
+    values = np.maximum(cohort.values, 0)  # negatives -> 0, NaN stays NaN
+    base = CohortMatrix(values, cohort.columns, cohort.sample_ids, cohort.meta,
+                        dtype=cohort.values.dtype)
+    try:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_columns = metabolite_ratio_columns(base)
+    except Exception as e:
+        print(f"Error calculating metabolite ratios: {str(e)}")
+        return None
+
+    # For overlapping columns, fill NaN in original data with new values
+    common_cols = [col for col in new_columns if col in base]
+    if common_cols:
+        values = np.array(values, order="F")
+        for col in common_cols:
+            column = values[:, base.position(col)]
+            missing = np.isnan(column)
+            column[missing] = new_columns[col][missing]
+        base = CohortMatrix(values, base.columns, base.sample_ids, base.meta,
+                            dtype=values.dtype)
+
+    new_cols_only = pd.Index(list(new_columns)).difference(base.columns)
+    return base.with_columns({col: new_columns[col] for col in new_cols_only})
+
+
+def marker_values(cohort, markers):
+    """Samples x markers patient values: missing/NaN/inf -> NaN, negatives -> 0"""
+    values = cohort.take(markers).astype(np.float64)
+    values[~np.isfinite(values)] = np.nan
+    return np.maximum(values, 0)
+
+
+def cohort_zscores(cohort, markers, ref_stats):
+    """Patient values and z-scores (rounded to 2 decimals) for every sample and marker"""
+    values = marker_values(cohort, markers)
+    mean = ref_stats.loc['mean'].reindex(markers).to_numpy(dtype=np.float64)
+    sd = ref_stats.loc['sd'].reindex(markers).to_numpy(dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_scores = np.round((values - mean) / sd, 2)
+    z_scores[:, ~(sd > 0)] = np.nan
+    return values, z_scores
+
+
+def band_levels(patient_values, risk_params):
+    """Уровень отклонения 0/1/2 по коридорам norm/High_risk и типу метаболита"""
+    value = np.asarray(patient_values, dtype=np.float64)
+    norm_1 = risk_params['norm_1'].to_numpy(dtype=np.float64)
+    norm_2 = risk_params['norm_2'].to_numpy(dtype=np.float64)
+    risk_1 = risk_params['High_risk_1'].to_numpy(dtype=np.float64)
+    risk_2 = risk_params['High_risk_2'].to_numpy(dtype=np.float64)
+    metab_group = risk_params['Группа_метаб'].to_numpy()
+
+    # Two-sided corridor
+    both = np.select(
+        [(norm_1 <= value) & (value <= norm_2),
+         ((risk_1 <= value) & (value < norm_1)) | ((norm_2 < value) & (value <= risk_2))],
+        [0, 1], 2)
+    # Upper bound only
+    upper = np.select([value <= norm_2, (norm_2 < value) & (value <= risk_2)], [0, 1], 2)
+    # Lower bound only
+    lower = np.select([norm_1 <= value, (risk_1 <= value) & (value < norm_1)], [0, 1], 2)
+
+    return np.where(metab_group == 0, both, np.where(metab_group == 1, upper, lower))
+
+
+def zscore_band_levels(z_scores):
+    """Уровень отклонения 0/1/2 по |z|: <1.54, 1.54-1.96, >1.96; NaN для отсутствующих"""
+    value = np.abs(np.asarray(z_scores, dtype=np.float64))
+    return np.select([value < 1.54, value <= 1.96, value > 1.96], [0, 1, 2], np.nan)
+
+
+def weighted_band_score(levels, weights, groups, zero_weight_score=None):
+    """Sum of level*weight over the maximum possible (2*sum of weights), per group; NaN propagates"""
+    weights = pd.Series(np.asarray(weights, dtype=np.float64), index=groups.index)
+    weighted = weights * np.asarray(levels, dtype=np.float64)
+    total = weighted.groupby(groups, sort=False).sum()
+    total[weighted.isna().groupby(groups, sort=False).any()] = np.nan
+    max_score = weights.groupby(groups, sort=False).sum() * 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = total / max_score
+    if zero_weight_score is not None:
+        score[~(max_score > 0)] = zero_weight_score
+    return score
+
+
+def read_ref_stats(ref_data_path, sheet_name=0):
+    """Референсные статистики: строки mean/sd/..., столбцы — маркеры (десятичные запятые допускаются)"""
+    return (
+        pd.read_excel(ref_data_path, sheet_name=sheet_name, header=None)
+        .pipe(lambda df: df.set_axis(['stat'] + list(df.iloc[0, 1:]), axis=1)
+        .drop(0)
+        .set_index('stat')
+        .apply(lambda x: pd.to_numeric(x.astype(str).str.replace(',', '.'), errors='coerce'))
+        ))
+
+
+def prepare_final_dataframe_old(risk_params_data, metabolomic_data_with_ratios):
+    # Load the data
+    risk_params = pd.read_excel(risk_params_data)
+    cohort = CohortMatrix.from_frame(pd.read_excel(metabolomic_data_with_ratios))
+    
+    # Get values for each marker from the first sample
+    risk_params['Patient'] = marker_values(cohort, risk_params['Маркер / Соотношение'])[0]
+    
+    # Drop rows with infinite or NaN values in Patient column
+    risk_params = risk_params[~risk_params['Patient'].isin([np.inf, -np.inf]) & 
+                  ~risk_params['Patient'].isna()].copy()
+    
+    levels = band_levels(risk_params['Patient'], risk_params)
+    subgroup_scores = weighted_band_score(levels, risk_params['веса'], risk_params['Категория']) * 100
+    
+    risk_params['Subgroup_score'] = risk_params['Категория'].map(subgroup_scores)
+    return risk_params
+
+def prepare_final_dataframe_zscore(risk_params_data, metabolomic_data_with_ratios, ref_data_path):
+    """
+    Подготавливает итоговый датафрейм с расчетами метаболитов и оценками рисков
+    
+    Параметры:
+        risk_params_data - путь к файлу с параметрами рисков
+        metabolomic_data_with_ratios - путь к файлу с метаболическими данными
+        ref_data_path - путь к файлу с референсными значениями
+        
+    Возвращает:
+        Датафрейм с рассчитанными значениями и оценками
+    """
+    # Загрузка данных
+    risk_params = pd.read_excel(risk_params_data)
+    cohort = CohortMatrix.from_frame(pd.read_excel(metabolomic_data_with_ratios))
+    
+    # Загрузка и подготовка референсных данных
+    ref_stats = read_ref_stats(ref_data_path)
+    
+    # Значения и z-скор первого образца для всех маркеров сразу
+    values, z_scores = cohort_zscores(cohort, risk_params['Маркер / Соотношение'], ref_stats)
+    
+    # Добавляем результаты в датафрейм
+    risk_params = risk_params.assign(
+        Patient=values[0],
+        Z_score=z_scores[0]
+    ).copy()
+    
+    # Расчет групповых оценок
+    levels = zscore_band_levels(risk_params['Z_score'])
+    for _, row in risk_params[np.isnan(levels)].iterrows():
+        print(row['Маркер / Соотношение'], row['Z_score'])
+    subgroup_scores = weighted_band_score(
+        levels, risk_params['веса'], risk_params['Категория'], zero_weight_score=0) * 100
+    
+    # Добавляем оценки подгрупп
+    risk_params['Subgroup_score'] = risk_params['Категория'].map(subgroup_scores)
+    
+    return risk_params
+    
+def probability_to_score(prob, threshold):
+    """Score 0-10 with the 5/5 split; prob may be a scalar or an array"""
+    return probabilities_to_scores(prob, ScoreMapping(threshold, low_slope=5, high_slope=5))
+
+def calculate_risks(risk_params_data, metabolic_data_with_ratios):
+    """
+    Расчет комбинированных рисков с использованием:
+    - ML-моделей для определенных групп (Онко, ССЗ, Печень, Легкие, РА)
+    - Параметров рисков для остальных групп
+    Возвращает DataFrame с колонками: ['Группа риска', 'Риск-скор', 'Метод оценки']
+    """
+    # Группы, для которых используем только ML модели
+    ml_only_groups = ML_ONLY_GROUPS
+    
+    if not isinstance(metabolic_data_with_ratios, CohortMatrix):
+        metabolic_data_with_ratios = metabolic_data_with_ratios[~metabolic_data_with_ratios.index.duplicated()]
+    cohort = CohortMatrix.from_frame(metabolic_data_with_ratios)
+    risk_params_data = risk_params_data[~risk_params_data.index.duplicated()]
+    
+    # Pipelines come from the registry (discovered once, instances reused);
+    # they run concurrently, results come back row by row in registry order
+    results = run_pipelines(registry.factories(), cohort)
+       
+    # 2. Process other groups with parameter-based method
+    # Filter out ML-only groups
+    other_groups = set(risk_params_data['Группа_риска'].unique()) - ml_only_groups
+    
+    if other_groups:
+        # Prepare parameter risk_params_data (values of the last sample, as before)
+        risk_params_data['Patient'] = marker_values(cohort, risk_params_data['Маркер / Соотношение'])[-1]
+        risk_params_data = risk_params_data[~risk_params_data['Patient'].isin([np.inf, -np.inf]) & ~risk_params_data['Patient'].isna()].copy()
+        
+        # Calculate scores for remaining groups
+        levels = band_levels(risk_params_data['Patient'], risk_params_data)
+        group_scores = 10 - weighted_band_score(
+            levels, risk_params_data['веса'], risk_params_data['Группа_риска']) * 10
+        for risk_group in other_groups:
+            if risk_group not in group_scores.index:
+                continue
+            results.append({
+                "Группа риска": risk_group,
+                "Риск-скор": np.round(group_scores[risk_group], 0),
+                "Метод оценки": "Параметры"
+            })
+
+    # Create final DataFrame
+    result_df = pd.DataFrame(results)
+    
+    # Sort by risk score (descending) and group name
+    result_df.sort_values(['Группа риска'], ascending=True, inplace=True)
+    
+    return result_df[['Группа риска', 'Риск-скор', 'Метод оценки']].reset_index(drop=True)
+
+def group_indicator(labels):
+    """Unique labels (first-seen order) and a markers x groups 0/1 matrix"""
+    codes, uniques = pd.factorize(pd.Series(labels))
+    indicator = np.zeros((len(codes), len(uniques)))
+    valid = codes >= 0
+    indicator[np.flatnonzero(valid), codes[valid]] = 1
+    return pd.Index(uniques), indicator
+
+
+def grouped_band_scores(levels, weights, labels, valid=None, zero_weight_score=None):
+    """Samples x groups weighted band score as a share of the maximum (0-1).
+
+    With valid given, markers without a value are left out of both sums (legacy and
+    parameter methods); otherwise a NaN level makes its group NaN (z-score method).
+    """
+    groups, indicator = group_indicator(labels)
+    weights = np.asarray(weights, dtype=np.float64)
+    if valid is None:
+        total = np.nan_to_num(levels * weights) @ indicator
+        total[(np.isnan(levels) @ indicator) > 0] = np.nan
+        max_score = (weights @ indicator) * 2
+    else:
+        total = (np.where(valid, levels, 0) * weights) @ indicator
+        max_score = ((valid * weights) @ indicator) * 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = total / max_score
+    if zero_weight_score is not None:
+        scores[~(np.broadcast_to(max_score, scores.shape) > 0)] = zero_weight_score
+    return groups, scores
+
+
+def explain_cohort(cohort, top=EXPLAIN_TOP):
+    """Strongest TreeSHAP contributions to every ML probability: row, Группа риска, Маркер, Вклад.
+
+    row is the sample position in the cohort. Вклад is in probability units; the
+    probability is the one compared with the model threshold, so a positive
+    contribution lowers the 0-10 score.
+    """
+    cohort = CohortMatrix.from_frame(cohort)
+    parts = []
+    for disease_name, spec in registry.specs().items():
+        try:
+            contributions = registry.get(disease_name).risk_contributions(cohort)
+        except Exception as e:
+            print(f"Error explaining {disease_name}: {str(e)}")
+            continue
+        k = min(top, contributions.values.shape[1])
+        strongest = np.argsort(-np.abs(contributions.values), axis=1, kind="stable")[:, :k]
+        parts.append(pd.DataFrame({
+            "row": np.repeat(np.arange(len(cohort)), k),
+            "Группа риска": spec.risk_group,
+            "Маркер": contributions.features[strongest].ravel(),
+            "Вклад": np.take_along_axis(contributions.values, strongest, axis=1).ravel(),
+        }))
+    if not parts:
+        return pd.DataFrame(columns=["row", "Группа риска", "Маркер", "Вклад"])
+    return pd.concat(parts, ignore_index=True)
+
+
+def contribution_text(contributions):
+    """(row, Группа риска) -> 'Маркер +0.12, Маркер -0.05' of an explain_cohort table"""
+    labels = contributions["Маркер"].astype(str) + " " + contributions["Вклад"].map("{:+.2f}".format)
+    return labels.groupby([contributions["row"], contributions["Группа риска"]], sort=False).agg(", ".join).to_dict()
+
+
+def score_cohort(cohort, risk_params, ref_stats, dedupe=False, rtol=None, atol=0.0, intervals=False,
+                 explain=False):
+    """Все оценки для каждого образца когорты за один проход.
+
+    Returns a dict of DataFrames:
+        risk_scores      - long table: sample, risk group, score, method (ML and parameter groups);
+                           the unnamed index is the sample position, unique even when codes repeat
+        category_scores  - samples x categories, z-score method, %
+        zscores          - samples x markers
+        legacy_scores    - samples x categories, legacy (norm corridor) method, %
+        duplicates       - sample -> representative that was scored (only with dedupe/rtol/atol)
+
+    With dedupe, identical sample rows are scored once; rtol/atol also merge
+    technical replicates within that tolerance (see dedup.find_duplicates).
+    With intervals, ML rows of risk_scores also get the probability and a
+    5-95 percentile interval of probability and score from the tree votes
+    (models/uncertainty.py). With explain, they get the strongest TreeSHAP
+    contributions as text (Основные факторы), and the results hold a
+    contributions table (sample, risk group, marker, contribution).
+    """
+    start = time.perf_counter()
+    cohort = CohortMatrix.from_frame(cohort)
+    risk_params = risk_params[~risk_params.index.duplicated()]
+    markers = risk_params['Маркер / Соотношение']
+    sample_ids = pd.Index(cohort.sample_ids, name=ID_COLUMN)
+
+    # Score unique rows only, then fan the per-sample arrays back out
+    duplicates = None
+    groups = np.arange(len(cohort))
+    expand = lambda array: array
+    if dedupe or rtol is not None or atol:
+        duplicates = find_duplicates(cohort, rtol=rtol, atol=atol)
+        print(f"Duplicate samples: {duplicates.summary()}")
+        cohort = cohort.select_rows(duplicates.representatives)
+        groups = duplicates.inverse
+        expand = duplicates.expand
+
+    values, z_scores = cohort_zscores(cohort, markers, ref_stats)
+    valid = ~np.isnan(values)
+    weights = risk_params['веса'].to_numpy(dtype=np.float64)
+    corridor_levels = band_levels(values, risk_params)
+
+    # Category scores, both methods
+    categories, z_category = grouped_band_scores(
+        zscore_band_levels(z_scores), weights, risk_params['Категория'], zero_weight_score=0)
+    _, legacy_category = grouped_band_scores(
+        corridor_levels, weights, risk_params['Категория'], valid=valid)
+
+    # Parameter-based risk groups
+    other = ~risk_params['Группа_риска'].isin(ML_ONLY_GROUPS).to_numpy()
+    param_groups, param_share = grouped_band_scores(
+        corridor_levels[:, other], weights[other], risk_params['Группа_риска'][other],
+        valid=valid[:, other])
+    param_scores = np.round(10 - param_share * 10, 0)
+
+    # ML groups
+    ml_results = run_pipelines(registry.factories(), cohort, intervals=intervals)
+    contributions = explain_cohort(cohort) if explain else None
+    drivers = contribution_text(contributions) if explain else {}
+    per_sample = len(ml_results) // max(len(cohort), 1)
+
+    records, positions = [], []
+    for i, (sample_id, u) in enumerate(zip(sample_ids, groups)):
+        for result in ml_results[u * per_sample:(u + 1) * per_sample]:
+            records.append({ID_COLUMN: sample_id, **result,
+                            DRIVERS_COLUMN: drivers.get((u, result["Группа риска"]))})
+            positions.append(i)
+        for j, risk_group in enumerate(param_groups):
+            if np.isnan(param_share[u, j]):
+                continue
+            positions.append(i)
+            records.append({
+                ID_COLUMN: sample_id,
+                "Группа риска": risk_group,
+                "Риск-скор": param_scores[u, j],
+                "Метод оценки": "Параметры",
+            })
+
+    risk_columns = [ID_COLUMN, 'Группа риска', 'Риск-скор', 'Метод оценки']
+    if intervals:
+        risk_columns += list(INTERVAL_COLUMNS)
+    if explain:
+        risk_columns.append(DRIVERS_COLUMN)
+    marker_names = pd.Index(markers).drop_duplicates()
+    first = ~pd.Index(markers).duplicated()
+    results = {
+        "risk_scores": pd.DataFrame(records, columns=risk_columns, index=positions),
+        "category_scores": pd.DataFrame(expand(z_category) * 100, index=sample_ids, columns=categories),
+        "zscores": pd.DataFrame(expand(z_scores[:, first]), index=sample_ids, columns=marker_names),
+        "legacy_scores": pd.DataFrame(expand(legacy_category) * 100, index=sample_ids, columns=categories),
+    }
+    if explain:
+        rows = pd.DataFrame({ID_COLUMN: sample_ids, "row": groups})
+        results["contributions"] = rows.merge(contributions, on="row").drop(columns="row")
+    if duplicates is not None:
+        results["duplicates"] = pd.DataFrame(
+            {"Представитель": expand(cohort.sample_ids)}, index=sample_ids)
+    SAMPLES_SCORED.inc(len(sample_ids))
+    SCORING_SECONDS.observe(time.perf_counter() - start)
+    return results
+
+def create_ref_stats_from_excel(excel_path, sheet_name=0):
+    # Read Excel with explicit handling of decimal commas
+    df = pd.read_excel(excel_path, sheet_name=sheet_name)
+
+    # Transpose to metabolites-as-rows format
+    df = df.set_index('metabolite').T.reset_index()
+    df.columns.name = None
+
+    ref_stats = {}
+
+    def format_number(value):
+        """Format number to remove .0 for integers"""
+        try:
+            num = float(value)
+            if num.is_integer():
+                return int(num)
+            return num
+        except (ValueError, TypeError):
+            return value
+
+    for _, row in df.iterrows():
+        try:
+            metabolite = row['index']
+            data = {
+                'mean': float(str(row['mean']).replace(',', '.')),
+                'sd': float(str(row['sd']).replace(',', '.')),
+                'ref_min': (
+                    float(str(row['ref_min']).replace(',', '.'))
+                    if pd.notna(row['ref_min'])
+                    else None
+                ),
+                'ref_max': (
+                    float(str(row['ref_max']).replace(',', '.'))
+                    if pd.notna(row['ref_max'])
+                    else None
+                ),
+                'name_view': row['name_view'],
+                'name_short_view': row['name_short_view']
+            }
+
+            # Generate norm string with clean formatting
+            if data['ref_min'] is not None and data['ref_max'] is not None:
+                min_val = format_number(data['ref_min'])
+                max_val = format_number(data['ref_max'])
+                
+                if min_val == 0:
+                    data['norm'] = f"< {max_val}"
+                else:
+                    data['norm'] = f"{min_val} - {max_val}"
+
+            ref_stats[metabolite] = {k: v for k, v in data.items() if v is not None}
+
+        except Exception as e:
+            print(f"Error processing {row.get('index', 'unknown')}: {str(e)}")
+            continue
+    return ref_stats
+
+def safe_parse_metabolite_data(file_path):
+    """Concentrations of the first sample of a file (see ConcentrationStore for all samples)"""
+    if not os.path.exists(file_path):
+        print(f"Error: File not found - {file_path}")
+        return {}
+
+    try:
+        store = ConcentrationStore.from_frame(pd.read_excel(file_path))
+        if not len(store):
+            return {}
+        return {name: float(value) for name, value in store.row(0).items()}
+    except Exception as e:
+        print(f"Error processing file {file_path}: {str(e)}")
+        return {}
@@ -0,0 +1,163 @@
+"""Анализ чувствительности: какой маркер сдвинет риск-скор.
+
+For one patient, every measured metabolite and every ratio is scaled by each
+factor of a grid. Scaled metabolites go through the ratio step again, so the
+ratios that depend on them move with them; a scaled ratio changes only
+itself. The baseline and all perturbed samples form one CohortMatrix batch
+that score_cohort scores in a single vectorised pass (all disease pipelines,
+parameter groups and both category methods). The result is a table of score
+changes against the baseline, largest first.
+
+Usage:
+    python sensitivity.py patient.xlsx --ref Ref.xlsx [--row 0] [--factors 0.5 0.8 1.25 2] [--top 30]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from cohort import ID_COLUMN, CohortMatrix
+from scoring_core import calculate_cohort_ratios, score_cohort
+
+DEFAULT_FACTORS = (0.5, 0.8, 1.25, 2.0)
+BASELINE_ID = "baseline"
+
+METABOLITE = "метаболит"
+RATIO = "соотношение"
+
+# Full range of each score kind, so that risk scores (0-10) and categories (%) rank together
+RISK_SCORE_RANGE = 10.0
+CATEGORY_RANGE = 100.0
+
+TABLE_COLUMNS = ["Маркер", "Тип", "Множитель", "Оценка", "Базовое значение", "Значение", "Изменение",
+                 "Изменение, % шкалы"]
+
+
+def patient_cohort(patient, row=0):
+    """Raw (pre-ratio) float64 CohortMatrix of one patient from an upload table"""
+    cohort = CohortMatrix.from_frame(patient, dtype=np.float64)
+    return cohort.select_rows([row])
+
+
+def perturbation_batch(raw, factors=DEFAULT_FACTORS, targets=None):
+    """Baseline plus every (marker, factor) perturbation as one ratio-augmented float32 batch.
+
+    raw is a one-sample CohortMatrix before ratios. Markers with a zero or
+    missing value are skipped, scaling them changes nothing. Returns the batch
+    and the plan: one row per sample with Маркер, Тип, Множитель.
+    """
+    base = calculate_cohort_ratios(raw)
+    raw_values = np.maximum(raw.values[0], 0)
+    base_values = base.values[0]
+    kinds = {name: METABOLITE for name in raw.columns}
+    kinds.update({name: RATIO for name in base.columns if name not in kinds})
+    targets = list(kinds) if targets is None else [name for name in targets if name in kinds]
+
+    def scalable(value):
+        return np.isfinite(value) and value != 0
+
+    metabolites = [name for name in targets
+                   if kinds[name] == METABOLITE and scalable(raw_values[raw.position(name)])]
+    ratios = [name for name in targets
+              if kinds[name] == RATIO and scalable(base_values[base.position(name)])]
+    factors = np.asarray(factors, dtype=np.float64)
+
+    # Scaled metabolites: ratios recomputed for the whole block at once
+    raw_block = np.tile(raw_values, (len(metabolites) * len(factors), 1))
+    rows = np.arange(len(raw_block))
+    raw_block[rows, np.repeat(raw.positions(metabolites), len(factors))] *= np.tile(factors, len(metabolites))
+    metabolite_block = calculate_cohort_ratios(CohortMatrix(raw_block, raw.columns, dtype=np.float64))
+
+    # Scaled ratios: only the ratio itself changes
+    ratio_block = np.tile(base_values, (len(ratios) * len(factors), 1))
+    rows = np.arange(len(ratio_block))
+    ratio_block[rows, np.repeat(base.positions(ratios), len(factors))] *= np.tile(factors, len(ratios))
+
+    plan = pd.DataFrame({
+        "Маркер": [None] + [name for name in metabolites + ratios for _ in factors],
+        "Тип": [None] + [kinds[name] for name in metabolites + ratios for _ in factors],
+        "Множитель": np.concatenate([[1.0], np.tile(factors, len(metabolites) + len(ratios))]),
+    })
+    sample_ids = [BASELINE_ID] + [f"{name} x{factor:g}" for name, factor in
+                                  zip(plan["Маркер"][1:], plan["Множитель"][1:])]
+    values = np.vstack([base_values[None, :], metabolite_block.values, ratio_block])
+    batch = CohortMatrix(values, base.columns, sample_ids, dtype=np.float32)
+    return batch, plan.set_index(pd.Index(sample_ids, name=ID_COLUMN))
+
+
+def score_columns(results):
+    """Samples x scores: risk score per group and method kind, both category methods"""
+    risks = results["risk_scores"]
+    kind = np.where(risks["Метод оценки"] == "Параметры", "параметры", "ML")
+    risk_wide = (
+        risks.assign(
+            Оценка="Риск-скор: " + risks["Группа риска"].astype(str) + " (" + kind + ")",
+            **{"Риск-скор": pd.to_numeric(risks["Риск-скор"], errors="coerce")},
+        )
+        .pivot(index=ID_COLUMN, columns="Оценка", values="Риск-скор")
+        .reindex(results["zscores"].index)
+    )
+    return pd.concat([
+        risk_wide,
+        results["category_scores"].add_prefix("Категория (z-score): "),
+        results["legacy_scores"].add_prefix("Категория (старый метод): "),
+    ], axis=1)
+
+
+def sensitivity(raw, risk_params, ref_stats, factors=DEFAULT_FACTORS, targets=None):
+    """Score changes of every perturbation against the baseline, largest change (% of scale) first"""
+    batch, plan = perturbation_batch(raw, factors, targets)
+    scores = score_columns(score_cohort(batch, risk_params, ref_stats))
+    baseline = scores.loc[BASELINE_ID]
+    deltas = scores.drop(index=BASELINE_ID)
+
+    table = (
+        deltas.rename_axis(columns="Оценка").stack().rename("Значение").reset_index()
+        .merge(plan, left_on=ID_COLUMN, right_index=True)
+    )
+    table["Базовое значение"] = table["Оценка"].map(baseline)
+    table["Изменение"] = table["Значение"] - table["Базовое значение"]
+    table = table[table["Изменение"].abs() > 0]
+    score_range = np.where(table["Оценка"].str.startswith("Риск-скор"), RISK_SCORE_RANGE, CATEGORY_RANGE)
+    table["Изменение, % шкалы"] = table["Изменение"] / score_range * 100
+    order = table["Изменение, % шкалы"].abs().sort_values(ascending=False, kind="stable").index
+    return table.loc[order, TABLE_COLUMNS].reset_index(drop=True)
+
+
+def rank_markers(table):
+    """One row per marker, strongest first: the largest change it causes and on which score"""
+    if table.empty:
+        return table
+    strongest = table.loc[table["Изменение, % шкалы"].abs().groupby(table["Маркер"], sort=False).idxmax()]
+    return strongest.reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Which marker moves the risk scores of a patient")
+    parser.add_argument("data", help="Metabolomic data (Excel), one sample per row")
+    parser.add_argument("--ref", default="Ref.xlsx", help="Reference workbook (Params_metaboscan, Ref_stats)")
+    parser.add_argument("--row", type=int, default=0, help="Sample (row) of the upload")
+    parser.add_argument("--factors", type=float, nargs="+", default=list(DEFAULT_FACTORS))
+    parser.add_argument("--top", type=int, default=30, help="Rows to print")
+    parser.add_argument("--out", help="Write the full table to this CSV file")
+    args = parser.parse_args()
+
+    from scoring_core import read_ref_stats
+
+    raw = patient_cohort(pd.read_excel(args.data), args.row)
+    risk_params = pd.read_excel(args.ref, sheet_name="Params_metaboscan")
+    ref_stats = read_ref_stats(args.ref, sheet_name="Ref_stats")
+
+    start = time.perf_counter()
+    table = sensitivity(raw, risk_params, ref_stats, factors=args.factors)
+    elapsed = time.perf_counter() - start
+    print(f"Sample {raw.sample_ids[0]}: {len(table)} score changes in {elapsed:.2f}s")
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(rank_markers(table).head(args.top).to_string(index=False))
+    if args.out:
+        table.to_csv(args.out, index=False)
+
+
+if __name__ == "__main__":
+    main()
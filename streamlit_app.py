@@ -6,6 +6,11 @@ from datetime import datetime
 import logging
 
 from streamlit_utilit import *
+from metrics import configure_from_env
+from sensitivity import patient_cohort, rank_markers, sensitivity
+
+# Memory for computed reports kept in the session; older reports are evicted
+REPORT_CACHE_MAX_MB = 256
 
 def validate_inputs(name, file1):
     """Validate user inputs before processing"""
@@ -17,69 +22,207 @@ def validate_inputs(name, file1):
         return False
     return True
 
-def display_group_cards(risk_params_df, risk_scores):
-    # Group by risk group first
-    grouped = risk_params_df.groupby('Группа_риска')
-    
-    for group_name, group_df in grouped:
-        # Get unique categories within this risk group
-        categories = group_df[['Категория', 'Subgroup_score']].drop_duplicates()
-        
-        # Calculate average score for the risk group header
-        group_score = risk_scores['Риск-скор'][risk_scores['Группа риска'] == group_name].mean()
-        group_color = get_color_under_normal_dist(100 - group_score *10)
+def display_group_cards(card_summary):
+    # All cards of the patient as one HTML block: one frontend element instead of one per card
+    st.markdown(group_cards_html(card_summary), unsafe_allow_html=True)
+
+def score_patient(risk_params_exp, risk_scores, drivers):
+    """Risk table and group card summary of one method, as kept in the report.
+
+    drivers maps an ML risk group to its strongest model contributions (contribution_text).
+    """
+    ml_rows = risk_scores["Метод оценки"] != "Параметры"
+    risk_scores = risk_scores.assign(**{DRIVERS_COLUMN: risk_scores["Группа риска"].map(drivers).where(ml_rows)})
+    return {
+        "risk_scores": risk_scores.sort_values(by="Метод оценки", ascending=True),
+        "cards": group_card_summary(risk_params_exp, risk_scores),
+    }
+
+def compute_report(metabolomic_data, edited_ref):
+    """Scores, card summaries and chart images of an upload; plain data kept in session_state"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            # Save Params_metaboscan sheet as temporary file
+            risk_params_path = os.path.join(temp_dir, "risk_params.xlsx")
+            edited_ref['Params_metaboscan'].to_excel(risk_params_path, index=False)
+
+            # Save Ref_stats sheet as temporary file
+            ref_stats_path = os.path.join(temp_dir, "Ref_stats.xlsx")
+            edited_ref['Ref_stats'].to_excel(ref_stats_path, index=False)
+
+            # Process data
+            metabolomic_data_with_ratios = calculate_metabolite_ratios(metabolomic_data)
+            metabolomic_data_with_ratios_path = os.path.join(temp_dir, "metabolomic_data.xlsx")
+            metabolomic_data_with_ratios.to_excel(metabolomic_data_with_ratios_path, index=False)
+            
+            # Concentrations of every sample, indexed once per upload
+            concentration_store = ConcentrationStore.from_frame(metabolomic_data_with_ratios)
+            # Chart z-scores and colours of every panel for every sample, one pass
+            chart_panels = evaluate_panels(
+                concentration_store, create_ref_stats_from_excel(ref_stats_path), load_chart_panels())
+            # Strongest model contributions behind every ML score, whole upload at once
+            drivers = contribution_text(explain_cohort(CohortMatrix.from_frame(metabolomic_data_with_ratios)))
+            
+            def patient_drivers(idx):
+                return {group: text for (row, group), text in drivers.items() if row == idx}
+            
+            # Check if input file contains multiple patients (more than 1 row after header)
+            df_metabolomic = pd.read_excel(metabolomic_data)
+            multiple_patients = len(df_metabolomic) > 1
+            
+            patients = []
+            if multiple_patients:
+                # Get patient identifiers and groups from file
+                patient_ids = df_metabolomic.get('Код', [f"Пациент {i+1}" for i in range(len(df_metabolomic))])
+                patient_groups = df_metabolomic.get('Группа', ["-" for _ in range(len(df_metabolomic))])
+                
+                for idx in range(len(patient_ids)):
+                    with st.spinner(f"Расчет показателей для пациента {idx+1}/{len(patient_ids)}..."):
+                        # Get individual patient data
+                        patient_data = metabolomic_data_with_ratios.iloc[[idx]]
+                        patient_data_path = os.path.join(temp_dir, f"patient_data_{idx}.xlsx")
+                        patient_data.to_excel(patient_data_path, index=False)
+                        
+                        # Calculate risk parameters for this patient only
+                        patient_risk_params_exp = prepare_final_dataframe_zscore(risk_params_path, patient_data_path, ref_stats_path)
+                        patient_risk_params_exp_old = prepare_final_dataframe_old(risk_params_path, patient_data_path)
+                        
+                        # Calculate risk scores for this patient only
+                        patient_risk_scores = calculate_risks(patient_risk_params_exp, patient_data)
+                        patient_risk_scores_old = calculate_risks(patient_risk_params_exp_old, patient_data)
+                        
+                        patients.append({
+                            "id": patient_ids[idx],
+                            "group": patient_groups[idx],
+                            "charts": [plot_panel_z_scores(panel, idx) for panel in chart_panels],
+                            "old": score_patient(patient_risk_params_exp_old, patient_risk_scores_old, patient_drivers(idx)),
+                            "zscore": score_patient(patient_risk_params_exp, patient_risk_scores, patient_drivers(idx)),
+                        })
+
+            else:  # Single patient case (original behavior)
+                risk_params_exp_zscore = prepare_final_dataframe_zscore(risk_params_path, metabolomic_data_with_ratios_path, ref_stats_path)
+                risk_params_exp_old = prepare_final_dataframe_old(risk_params_path, metabolomic_data_with_ratios_path)
+                risk_params_exp_path = os.path.join(temp_dir, "risk_exp_params.xlsx")
+                risk_params_exp_old_path = os.path.join(temp_dir, "risk_exp_params_old.xlsx")
+                risk_params_exp_zscore.to_excel(risk_params_exp_path, index=False)
+                risk_params_exp_old.to_excel(risk_params_exp_old_path, index=False)
+                    
+                risk_scores = calculate_risks(risk_params_exp_zscore, metabolomic_data_with_ratios)
+                risk_scores_path = os.path.join(temp_dir, "risk_scores.xlsx")
+                risk_scores.to_excel(risk_scores_path, index=False)
+                
+                risk_scores_old = calculate_risks(risk_params_exp_old, metabolomic_data_with_ratios)
+                risk_scores_old_path = os.path.join(temp_dir, "risk_scores_old.xlsx")
+                risk_scores_old.to_excel(risk_scores_old_path, index=False)
+                
+                metrics_path = os.path.join(temp_dir, "metrics.xlsx")
+                edited_ref['metrics_ml_models'].to_excel(metrics_path, index=False)
+                patients.append({
+                    "charts": [plot_panel_z_scores(panel, 0) for panel in chart_panels],
+                    "old": score_patient(risk_params_exp_old, risk_scores_old, patient_drivers(0)),
+                    "zscore": score_patient(risk_params_exp_zscore, risk_scores, patient_drivers(0)),
+                })
+
+            return {
+                "multiple_patients": multiple_patients,
+                "patients": patients,
+                # Inputs of the what-if sweeps, run on demand from the report
+                "raw": df_metabolomic,
+                "risk_params": edited_ref['Params_metaboscan'],
+                "ref_stats": read_ref_stats(ref_stats_path),
+            }
+
+        except Exception as e:
+            st.error(f"An error occurred: {str(e)}")
+            logging.error(f"Error in report generation: {str(e)}")
+            return None
+
+def display_risk_table(scores):
+    st.dataframe(scores["risk_scores"], hide_index=True,column_order=('Риск-скор', 'Группа риска', 'Метод оценки', DRIVERS_COLUMN))
+    with st.expander("Показатели по группам:", expanded=True):
+        display_group_cards(scores["cards"])
+
+def display_sensitivity(report, idx):
+    """What-if sweep of one patient: computed on request, then kept in the cached report.
+
+    Returns True when the table was just added, so the report has to be measured again.
+    """
+    patient = report["patients"][idx]
+    added = False
+    with st.expander("Чувствительность: какой маркер сдвинет оценки", expanded="sensitivity" in patient):
+        if "sensitivity" not in patient:
+            if not st.button("Рассчитать чувствительность", key=f"sens_{idx}"):
+                return False
+            with st.spinner("Расчет чувствительности..."):
+                patient["sensitivity"] = sensitivity(
+                    patient_cohort(report["raw"], idx), report["risk_params"], report["ref_stats"])
+            added = True
+        table = patient["sensitivity"]
+        st.markdown("**Сильнейшее изменение по каждому маркеру:**")
+        st.dataframe(rank_markers(table), hide_index=True)
+        with st.expander("Все изменения"):
+            st.dataframe(table, hide_index=True)
+    return added
+
+def display_report(report):
+    """Show a computed report; reruns only call this, nothing is recomputed.
+
+    Returns True when a sensitivity table was added to the report.
+    """
+    changed = False
+    if report["multiple_patients"]:
+        st.info("Обнаружены данные для нескольких пациентов. Показаны результаты для всех пациентов.")
+        st.warning("Для генерации индивидуальных отчетов, пожалуйста, загружайте данные по одному пациенту за раз.")
         
-        # Display risk group header
-        st.markdown(f"""
-        <div style="
-            border-left: 5px solid {group_color};
-            padding: 10px;
-            margin: 10px 0 5px 0;
-            background-color: #f0f2f6;
-            border-radius: 5px;
-            font-weight: bold;
-        ">
-            <div style="display: flex; justify-content: space-between;">
-                <span>{group_name}</span>
-                <span>Балл: {group_score:.0f}/10</span>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        # Create tabs for each patient
+        tabs = st.tabs([f"Пациент {i+1}" for i in range(len(report["patients"]))])
         
-        # Display each category under this risk group
-        for _, row in categories.iterrows():
-            score = row['Subgroup_score']
-            color = get_color_under_normal_dist(score)
+        for idx, (patient, tab) in enumerate(zip(report["patients"], tabs)):
+            with tab:
+                st.markdown(f"**Код пациента:** {patient['id']}")
+                st.markdown(f"**Группа:** {patient['group']}")
+                st.markdown("---")
+                col2, col3, col4 = st.columns([1 , 1, 1])
+                    
+                with col2:
+                    with st.expander("Коридоры", expanded=True ):
+                        for chart in patient["charts"]:
+                            st.image(chart)
+                            
+                with col3:
+                    st.markdown("**Cтарый метод:**")
+                    display_risk_table(patient["old"])
+                
+                with col4:
+                    # Display individual risk scores
+                    st.markdown("**Z-scores:**")
+                    display_risk_table(patient["zscore"])
+
+                changed |= display_sensitivity(report, idx)
+
+    else:  # Single patient case (original behavior)
+        patient = report["patients"][0]
+        st.info("✅ Предварительный просмотр рассчитанных значений!")
+        cols = st.columns(3)
+        with cols[0]:
+            with st.expander("Коридоры", expanded=True ):
+                for chart in patient["charts"]:
+                    st.image(chart)
+        with cols[1]:
+            st.header("Старые риски:")
+            display_risk_table(patient["old"])
             
-            st.markdown(f"""
-            <div style="
-                border-left: 3px solid {color};
-                padding: 8px;
-                margin: 2px 0 2px 15px;
-                background-color: #f8f9fa;
-                border-radius: 3px;
-            ">
-                <div style="display: flex; justify-content: space-between;">
-                    <span>{row['Категория']}</span>
-                    <span>{score:.1f}%</span>
-                </div>
-                <div style="
-                    height: 6px;
-                    background: #e9ecef;
-                    margin-top: 5px;
-                    border-radius: 3px;
-                ">
-                    <div style="
-                        width: {100 - score}%;
-                        height: 100%;
-                        background-color: {color};
-                        border-radius: 3px;
-                    "></div>
-                </div>
-            </div>
-            """, unsafe_allow_html=True)
+        with cols[2]:
+            st.header("Z-score:")
+            display_risk_table(patient["zscore"])
+
+        changed = display_sensitivity(report, 0)
+    return changed
 
 def main():
+    # Prometheus endpoint/file if METABOSCAN_METRICS_PORT/_FILE are set; started once per process
+    configure_from_env()
+
     st.set_page_config(
         page_title="Отчет Metaboscan",
         page_icon="🏥",
@@ -179,6 +322,14 @@ def main():
             st.error(f"Файл параметров не найден: {REF_FILE}")
             st.session_state.edited_ref = None
     
+    # Computed reports survive reruns (expanders, tabs, editor changes) within the memory cap
+    if 'reports' not in st.session_state:
+        st.session_state.reports = ReportCache(REPORT_CACHE_MAX_MB * 2**20)
+    reports = st.session_state.reports
+    current_key = None
+    if metabolomic_data is not None and st.session_state.get('edited_ref'):
+        current_key = report_key(metabolomic_data.getvalue(), st.session_state.edited_ref)
+
     if submitted:
         if validate_inputs(name, metabolomic_data):
             if not os.path.exists(REF_FILE):
@@ -195,525 +346,28 @@ def main():
                     st.error(f"Required sheet '{sheet}' not found in reference file")
                     return
 
-            with st.spinner("🔬 Читаем данные и генерируем отчет. Это займет не больше минуты..."):
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    try:
-                        # Save Params_metaboscan sheet as temporary file
-                        risk_params_path = os.path.join(temp_dir, "risk_params.xlsx")
-                        st.session_state.edited_ref['Params_metaboscan'].to_excel(risk_params_path, index=False)
-
-                        # Save Ref_stats sheet as temporary file
-                        ref_stats_path = os.path.join(temp_dir, "Ref_stats.xlsx")
-                        st.session_state.edited_ref['Ref_stats'].to_excel(ref_stats_path, index=False)
-
-                        # Process data
-                        metabolomic_data_with_ratios = calculate_metabolite_ratios(metabolomic_data)
-                        metabolomic_data_with_ratios_path = os.path.join(temp_dir, "metabolomic_data.xlsx")
-                        metabolomic_data_with_ratios.to_excel(metabolomic_data_with_ratios_path, index=False)
-                        
-                        metabolite_data = safe_parse_metabolite_data(metabolomic_data_with_ratios_path)
-                        
-                        # Check if input file contains multiple patients (more than 1 row after header)
-                        df_metabolomic = pd.read_excel(metabolomic_data)
-                        multiple_patients = len(df_metabolomic) > 1
-                        
-                        if multiple_patients:
-                            st.info("Обнаружены данные для нескольких пациентов. Показаны результаты для всех пациентов.")
-                            st.warning("Для генерации индивидуальных отчетов, пожалуйста, загружайте данные по одному пациенту за раз.")
-                            
-                            # Get patient identifiers and groups from file
-                            patient_ids = df_metabolomic.get('Код', [f"Пациент {i+1}" for i in range(len(df_metabolomic))])
-                            patient_groups = df_metabolomic.get('Группа', ["-" for _ in range(len(df_metabolomic))])
-                            
-                            # Create tabs for each patient
-                            tabs = st.tabs([f"Пациент {i+1}" for i in range(len(patient_ids))])
-                            
-                            for idx, tab in enumerate(tabs):
-                                with tab:
-                                    with st.spinner(f"Расчет показателей для пациента {idx+1}/{len(patient_ids)}..."):
-                                        # Get individual patient data
-                                        patient_data = metabolomic_data_with_ratios.iloc[[idx]]
-                                        patient_data_path = os.path.join(temp_dir, f"patient_data_{idx}.xlsx")
-                                        patient_data.to_excel(patient_data_path, index=False)
-                                        
-                                        # Calculate risk parameters for this patient only
-                                        patient_risk_params_exp = prepare_final_dataframe_zscore(risk_params_path, patient_data_path, ref_stats_path)
-                                        patient_risk_params_exp_old = prepare_final_dataframe_old(risk_params_path, patient_data_path)
-                                        
-                                        
-                                        # Calculate risk scores for this patient only
-                                        patient_risk_scores = calculate_risks(patient_risk_params_exp, patient_data)
-                                        patient_risk_scores_old = calculate_risks(patient_risk_params_exp_old, patient_data)
-                                        # Display results
-                                        
-                                        
-                                        st.markdown(f"**Код пациента:** {patient_ids[idx]}")
-                                        st.markdown(f"**Группа:** {patient_groups[idx]}")
-                                        st.markdown("---")
-                                        col2, col3, col4 = st.columns([1 , 1, 1])
-                                            
-                                        with col2:
-                                            with st.expander("Коридоры", expanded=True ):
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Метаболизм фенилаланина",
-                                                        metabolite_concentrations= {
-                                                                "Phenylalanine": metabolite_data["Phenylalanine"],
-                                                                "Tyrosin": metabolite_data["Tyrosin"],
-                                                                "Summ Leu-Ile": metabolite_data["Summ Leu-Ile"],
-                                                                "Valine": metabolite_data["Valine"],
-                                                                "BCAA": metabolite_data["BCAA"],
-                                                                "BCAA/AAA": metabolite_data["BCAA/AAA"],
-                                                                "Phe/Tyr": metabolite_data["Phe/Tyr"],
-                                                                "Val/C4": metabolite_data["Val/C4"],
-                                                                "(Leu+IsL)/(C3+С5+С5-1+C5-DC)": metabolite_data[
-                                                                    "(Leu+IsL)/(C3+С5+С5-1+C5-DC)"
-                                                                ],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Метаболизм гистидина",
-                                                        metabolite_concentrations= {
-                                                                "Histidine": metabolite_data["Histidine"],
-                                                                "Methylhistidine": metabolite_data["Methylhistidine"],
-                                                                "Threonine": metabolite_data["Threonine"],
-                                                                "Glycine": metabolite_data["Glycine"],
-                                                                "DMG": metabolite_data["DMG"],
-                                                                "Serine": metabolite_data["Serine"],
-                                                                "Lysine": metabolite_data["Lysine"],
-                                                                "Glutamic acid": metabolite_data["Glutamic acid"],
-                                                                "Glutamine/Glutamate": metabolite_data["Glutamine"],
-                                                                "Glutamine/Glutamate": metabolite_data["Glutamine/Glutamate"],
-                                                                "Glycine/Serine": metabolite_data["Glycine/Serine"],
-                                                                "GSG Index": metabolite_data["GSG Index"],
-                                                                "Carnosine": metabolite_data["Carnosine"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Метаболизм метионина",
-                                                        metabolite_concentrations= {
-                                                                "Methionine": metabolite_data["Methionine"],
-                                                                "Methionine-Sulfoxide": metabolite_data["Methionine-Sulfoxide"],
-                                                                "Taurine": metabolite_data["Taurine"],
-                                                                "Betaine": metabolite_data["Betaine"],
-                                                                "Choline": metabolite_data["Choline"],
-                                                                "TMAO": metabolite_data["TMAO"],
-                                                                "Betaine/choline": metabolite_data["Betaine/choline"],
-                                                                "Methionine + Taurine": metabolite_data["Methionine + Taurine"],
-                                                                "Met Oxidation": metabolite_data["Met Oxidation"],
-                                                                "TMAO Synthesis": metabolite_data["TMAO Synthesis"],
-                                                                "DMG / Choline": metabolite_data["DMG / Choline"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Кинурениновый путь",
-                                                        metabolite_concentrations= {
-                                                                "Tryptophan": metabolite_data["Tryptophan"],
-                                                                "Kynurenine": metabolite_data["Kynurenine"],
-                                                                "Antranillic acid": metabolite_data["Antranillic acid"],
-                                                                "Quinolinic acid": metabolite_data["Quinolinic acid"],
-                                                                "Xanthurenic acid": metabolite_data["Xanthurenic acid"],
-                                                                "Kynurenic acid": metabolite_data["Kynurenic acid"],
-                                                                "Kyn/Trp": metabolite_data["Kyn/Trp"],
-                                                                "Trp/(Kyn+QA)": metabolite_data["Trp/(Kyn+QA)"],
-                                                                "Kyn/Quin": metabolite_data["Kyn/Quin"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Серотониновый путь",
-                                                        metabolite_concentrations= {
-                                                                "Serotonin": metabolite_data["Serotonin"],
-                                                                "HIAA": metabolite_data["HIAA"],
-                                                                "5-hydroxytryptophan": metabolite_data["5-hydroxytryptophan"],
-                                                                "Serotonin / Trp": metabolite_data["Serotonin / Trp"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Индоловый путь",
-                                                        metabolite_concentrations= {
-                                                                "Indole-3-acetic acid": metabolite_data["Indole-3-acetic acid"],
-                                                                "Indole-3-lactic acid": metabolite_data["Indole-3-lactic acid"],
-                                                                "Indole-3-carboxaldehyde": metabolite_data[
-                                                                    "Indole-3-carboxaldehyde"
-                                                                ],
-                                                                "Indole-3-propionic acid": metabolite_data[
-                                                                    "Indole-3-propionic acid"
-                                                                ],
-                                                                "Indole-3-butyric": metabolite_data["Indole-3-butyric"],
-                                                                "Tryptamine": metabolite_data["Tryptamine"],
-                                                                "Tryptamine / IAA": metabolite_data["Tryptamine / IAA"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Метаболизм аргинина",
-                                                        metabolite_concentrations= {
-                                                                "Proline": metabolite_data["Proline"],
-                                                                "Hydroxyproline": metabolite_data["Hydroxyproline"],
-                                                                "ADMA": metabolite_data["ADMA"],
-                                                                "NMMA": metabolite_data["NMMA"],
-                                                                "TotalDMA (SDMA)": metabolite_data["TotalDMA (SDMA)"],
-                                                                "Homoarginine": metabolite_data["Homoarginine"],
-                                                                "Arginine": metabolite_data["Arginine"],
-                                                                "Citrulline": metabolite_data["Citrulline"],
-                                                                "Ornitine": metabolite_data["Ornitine"],
-                                                                "Asparagine": metabolite_data["Asparagine"],
-                                                                "Aspartic acid": metabolite_data["Aspartic acid"],
-                                                                "Creatinine": metabolite_data["Creatinine"],
-                                                                "Arg/ADMA": metabolite_data["Arg/ADMA"],
-                                                                "(Arg+HomoArg)/ADMA": metabolite_data["(Arg+HomoArg)/ADMA"],
-                                                                "Arg/Orn+Cit": metabolite_data["Arg/Orn+Cit"],
-                                                                "ADMA/(Adenosin+Arginine)": metabolite_data[
-                                                                    "ADMA/(Adenosin+Arginine)"
-                                                                ],
-                                                                "Symmetrical Arg Methylation": metabolite_data[
-                                                                    "Symmetrical Arg Methylation"
-                                                                ],
-                                                                "Sum of Dimethylated Arg": metabolite_data[
-                                                                    "Sum of Dimethylated Arg"
-                                                                ],
-                                                                "Ratio of Pro to Cit": metabolite_data["Ratio of Pro to Cit"],
-                                                                "Cit Synthesis": metabolite_data["Cit Synthesis"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Метаболизм ацилкарнитинов (соотношения)",
-                                                        metabolite_concentrations= {
-                                                                "Alanine": metabolite_data["Alanine"],
-                                                                "C0": metabolite_data["C0"],
-                                                                "Ratio of AC-OHs to ACs": metabolite_data["Ratio of AC-OHs to ACs"],
-                                                                "СДК": metabolite_data["СДК"],
-                                                                "ССК": metabolite_data["ССК"],
-                                                                "СКК": metabolite_data["СКК"],
-                                                                "C0/(C16+C18)": metabolite_data["C0/(C16+C18)"],
-                                                                "CPT-2 Deficiency (NBS)": metabolite_data["CPT-2 Deficiency (NBS)"],
-                                                                "С2/С0": metabolite_data["С2/С0"],
-                                                                "Ratio of Short-Chain to Long-Chain ACs": metabolite_data[
-                                                                    "Ratio of Short-Chain to Long-Chain ACs"
-                                                                ],
-                                                                "Ratio of Medium-Chain to Long-Chain ACs": metabolite_data[
-                                                                    "Ratio of Medium-Chain to Long-Chain ACs"
-                                                                ],
-                                                                "Ratio of Short-Chain to Medium-Chain ACs": metabolite_data[
-                                                                    "Ratio of Short-Chain to Medium-Chain ACs"
-                                                                ],
-                                                                "Sum of ACs": metabolite_data["Sum of ACs"],
-                                                                "Sum of ACs + С0": metabolite_data["Sum of ACs + С0"],
-                                                                "Sum of ACs/C0": metabolite_data["Sum of ACs/C0"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Короткоцепочечные ацилкарнитины",
-                                                        metabolite_concentrations= {
-                                                                "C2": metabolite_data["C2"],
-                                                                "C3": metabolite_data["C3"],
-                                                                "C4": metabolite_data["C4"],
-                                                                "C5": metabolite_data["C5"],
-                                                                "C5-1": metabolite_data["C5-1"],
-                                                                "C5-DC": metabolite_data["C5-DC"],
-                                                                "C5-OH": metabolite_data["C5-OH"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Среднецепочечные ацилкарнитины",
-                                                        metabolite_concentrations= {
-                                                                "C6": metabolite_data["C6"],
-                                                                "C6-DC": metabolite_data["C6-DC"],
-                                                                "C8": metabolite_data["C8"],
-                                                                "C8-1": metabolite_data["C8-1"],
-                                                                "C10": metabolite_data["C10"],
-                                                                "C10-1": metabolite_data["C10-1"],
-                                                                "C10-2": metabolite_data["C10-2"],
-                                                                "C12": metabolite_data["C12"],
-                                                                "C12-1": metabolite_data["C12-1"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Длинноцепочечные ацилкарнитины",
-                                                        metabolite_concentrations= {
-                                                                "C14": metabolite_data["C14"],
-                                                                "C14-1": metabolite_data["C14-1"],
-                                                                "C14-2": metabolite_data["C14-2"],
-                                                                "C14-OH": metabolite_data["C14-OH"],
-                                                                "C16": metabolite_data["C16"],
-                                                                "C16-1": metabolite_data["C16-1"],
-                                                                "C16-1-OH": metabolite_data["C16-1-OH"],
-                                                                "C16-OH": metabolite_data["C16-OH"],
-                                                                "C18": metabolite_data["C18"],
-                                                                "C18-1": metabolite_data["C18-1"],
-                                                                "C18-1-OH": metabolite_data["C18-1-OH"],
-                                                                "C18-2": metabolite_data["C18-2"],
-                                                                "C18-OH": metabolite_data["C18-OH"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                st.image(plot_metabolite_z_scores(
-                                                            group_title= "Другие метаболиты",
-                                                        metabolite_concentrations= {
-                                                                "Pantothenic": metabolite_data["Pantothenic"],
-                                                                "Riboflavin": metabolite_data["Riboflavin"],
-                                                                "Melatonin": metabolite_data["Melatonin"],
-                                                                "Uridine": metabolite_data["Uridine"],
-                                                                "Adenosin": metabolite_data["Adenosin"],
-                                                                "Cytidine": metabolite_data["Cytidine"],
-                                                                "Cortisol": metabolite_data["Cortisol"],
-                                                                "Histamine": metabolite_data["Histamine"],
-                                                            },
-                                                            ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                                    
-                                        with col3:
-                                            st.markdown("**Cтарый метод:**")
-                                            st.dataframe(patient_risk_scores_old.sort_values(by="Метод оценки", ascending=True), hide_index=True,column_order=('Риск-скор', 'Группа риска', 'Метод оценки'))
-                                            with st.expander("Показатели по группам:", expanded=True):
-                                                display_group_cards(patient_risk_params_exp_old, patient_risk_scores_old)
-                                        
-                                        with col4:
-                                            # Display individual risk scores
-                                            st.markdown("**Z-scores:**")
-                                            st.dataframe(patient_risk_scores.sort_values(by="Метод оценки", ascending=True), hide_index=True,column_order=('Риск-скор', 'Группа риска', 'Метод оценки'))
-                                            with st.expander("Показатели по группам:", expanded=True):
-                                                display_group_cards(patient_risk_params_exp, patient_risk_scores)
-                                        
-                                        
+            if current_key not in reports:
+                with st.spinner("🔬 Читаем данные и генерируем отчет. Это займет не больше минуты..."):
+                    report = compute_report(metabolomic_data, st.session_state.edited_ref)
+                if report is None:
+                    return
+                evicted = reports.put(current_key, report)
+                if evicted:
+                    logging.info(f"Evicted {len(evicted)} cached reports, {reports.nbytes / 2**20:.0f} MB kept")
+            st.session_state.report_key = current_key
 
-                        else:  # Single patient case (original behavior)
-                            risk_params_exp_zscore = prepare_final_dataframe_zscore(risk_params_path, metabolomic_data_with_ratios_path, ref_stats_path)
-                            risk_params_exp_old = prepare_final_dataframe_old(risk_params_path, metabolomic_data_with_ratios_path)
-                            risk_params_exp_path = os.path.join(temp_dir, "risk_exp_params.xlsx")
-                            risk_params_exp_old_path = os.path.join(temp_dir, "risk_exp_params_old.xlsx")
-                            risk_params_exp_zscore.to_excel(risk_params_exp_path, index=False)
-                            risk_params_exp_old.to_excel(risk_params_exp_old_path, index=False)
-                                
-                            risk_scores = calculate_risks(risk_params_exp_zscore, metabolomic_data_with_ratios)
-                            risk_scores_path = os.path.join(temp_dir, "risk_scores.xlsx")
-                            risk_scores.to_excel(risk_scores_path, index=False)
-                            
-                            risk_scores_old = calculate_risks(risk_params_exp_old, metabolomic_data_with_ratios)
-                            risk_scores_old_path = os.path.join(temp_dir, "risk_scores_old.xlsx")
-                            risk_scores_old.to_excel(risk_scores_old_path, index=False)
-                            
-                            metrics_path = os.path.join(temp_dir, "metrics.xlsx")
-                            st.session_state.edited_ref['metrics_ml_models'].to_excel(metrics_path, index=False)
-                            st.info("✅ Предварительный просмотр рассчитанных значений!")
-                            cols = st.columns(3)
-                            with cols[0]:
-                                with st.expander("Коридоры", expanded=True ):
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Метаболизм фенилаланина",
-                                               metabolite_concentrations= {
-                                                    "Phenylalanine": metabolite_data["Phenylalanine"],
-                                                    "Tyrosin": metabolite_data["Tyrosin"],
-                                                    "Summ Leu-Ile": metabolite_data["Summ Leu-Ile"],
-                                                    "Valine": metabolite_data["Valine"],
-                                                    "BCAA": metabolite_data["BCAA"],
-                                                    "BCAA/AAA": metabolite_data["BCAA/AAA"],
-                                                    "Phe/Tyr": metabolite_data["Phe/Tyr"],
-                                                    "Val/C4": metabolite_data["Val/C4"],
-                                                    "(Leu+IsL)/(C3+С5+С5-1+C5-DC)": metabolite_data[
-                                                        "(Leu+IsL)/(C3+С5+С5-1+C5-DC)"
-                                                    ],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Метаболизм гистидина",
-                                               metabolite_concentrations= {
-                                                    "Histidine": metabolite_data["Histidine"],
-                                                    "Methylhistidine": metabolite_data["Methylhistidine"],
-                                                    "Threonine": metabolite_data["Threonine"],
-                                                    "Glycine": metabolite_data["Glycine"],
-                                                    "DMG": metabolite_data["DMG"],
-                                                    "Serine": metabolite_data["Serine"],
-                                                    "Lysine": metabolite_data["Lysine"],
-                                                    "Glutamic acid": metabolite_data["Glutamic acid"],
-                                                    "Glutamine/Glutamate": metabolite_data["Glutamine"],
-                                                    "Glutamine/Glutamate": metabolite_data["Glutamine/Glutamate"],
-                                                    "Glycine/Serine": metabolite_data["Glycine/Serine"],
-                                                    "GSG Index": metabolite_data["GSG Index"],
-                                                    "Carnosine": metabolite_data["Carnosine"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Метаболизм метионина",
-                                               metabolite_concentrations= {
-                                                    "Methionine": metabolite_data["Methionine"],
-                                                    "Methionine-Sulfoxide": metabolite_data["Methionine-Sulfoxide"],
-                                                    "Taurine": metabolite_data["Taurine"],
-                                                    "Betaine": metabolite_data["Betaine"],
-                                                    "Choline": metabolite_data["Choline"],
-                                                    "TMAO": metabolite_data["TMAO"],
-                                                    "Betaine/choline": metabolite_data["Betaine/choline"],
-                                                    "Methionine + Taurine": metabolite_data["Methionine + Taurine"],
-                                                    "Met Oxidation": metabolite_data["Met Oxidation"],
-                                                    "TMAO Synthesis": metabolite_data["TMAO Synthesis"],
-                                                    "DMG / Choline": metabolite_data["DMG / Choline"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Кинурениновый путь",
-                                               metabolite_concentrations= {
-                                                    "Tryptophan": metabolite_data["Tryptophan"],
-                                                    "Kynurenine": metabolite_data["Kynurenine"],
-                                                    "Antranillic acid": metabolite_data["Antranillic acid"],
-                                                    "Quinolinic acid": metabolite_data["Quinolinic acid"],
-                                                    "Xanthurenic acid": metabolite_data["Xanthurenic acid"],
-                                                    "Kynurenic acid": metabolite_data["Kynurenic acid"],
-                                                    "Kyn/Trp": metabolite_data["Kyn/Trp"],
-                                                    "Trp/(Kyn+QA)": metabolite_data["Trp/(Kyn+QA)"],
-                                                    "Kyn/Quin": metabolite_data["Kyn/Quin"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Серотониновый путь",
-                                               metabolite_concentrations= {
-                                                    "Serotonin": metabolite_data["Serotonin"],
-                                                    "HIAA": metabolite_data["HIAA"],
-                                                    "5-hydroxytryptophan": metabolite_data["5-hydroxytryptophan"],
-                                                    "Serotonin / Trp": metabolite_data["Serotonin / Trp"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Индоловый путь",
-                                               metabolite_concentrations= {
-                                                    "Indole-3-acetic acid": metabolite_data["Indole-3-acetic acid"],
-                                                    "Indole-3-lactic acid": metabolite_data["Indole-3-lactic acid"],
-                                                    "Indole-3-carboxaldehyde": metabolite_data[
-                                                        "Indole-3-carboxaldehyde"
-                                                    ],
-                                                    "Indole-3-propionic acid": metabolite_data[
-                                                        "Indole-3-propionic acid"
-                                                    ],
-                                                    "Indole-3-butyric": metabolite_data["Indole-3-butyric"],
-                                                    "Tryptamine": metabolite_data["Tryptamine"],
-                                                    "Tryptamine / IAA": metabolite_data["Tryptamine / IAA"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Метаболизм аргинина",
-                                               metabolite_concentrations= {
-                                                    "Proline": metabolite_data["Proline"],
-                                                    "Hydroxyproline": metabolite_data["Hydroxyproline"],
-                                                    "ADMA": metabolite_data["ADMA"],
-                                                    "NMMA": metabolite_data["NMMA"],
-                                                    "TotalDMA (SDMA)": metabolite_data["TotalDMA (SDMA)"],
-                                                    "Homoarginine": metabolite_data["Homoarginine"],
-                                                    "Arginine": metabolite_data["Arginine"],
-                                                    "Citrulline": metabolite_data["Citrulline"],
-                                                    "Ornitine": metabolite_data["Ornitine"],
-                                                    "Asparagine": metabolite_data["Asparagine"],
-                                                    "Aspartic acid": metabolite_data["Aspartic acid"],
-                                                    "Creatinine": metabolite_data["Creatinine"],
-                                                    "Arg/ADMA": metabolite_data["Arg/ADMA"],
-                                                    "(Arg+HomoArg)/ADMA": metabolite_data["(Arg+HomoArg)/ADMA"],
-                                                    "Arg/Orn+Cit": metabolite_data["Arg/Orn+Cit"],
-                                                    "ADMA/(Adenosin+Arginine)": metabolite_data[
-                                                        "ADMA/(Adenosin+Arginine)"
-                                                    ],
-                                                    "Symmetrical Arg Methylation": metabolite_data[
-                                                        "Symmetrical Arg Methylation"
-                                                    ],
-                                                    "Sum of Dimethylated Arg": metabolite_data[
-                                                        "Sum of Dimethylated Arg"
-                                                    ],
-                                                    "Ratio of Pro to Cit": metabolite_data["Ratio of Pro to Cit"],
-                                                    "Cit Synthesis": metabolite_data["Cit Synthesis"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Метаболизм ацилкарнитинов (соотношения)",
-                                               metabolite_concentrations= {
-                                                    "Alanine": metabolite_data["Alanine"],
-                                                    "C0": metabolite_data["C0"],
-                                                    "Ratio of AC-OHs to ACs": metabolite_data["Ratio of AC-OHs to ACs"],
-                                                    "СДК": metabolite_data["СДК"],
-                                                    "ССК": metabolite_data["ССК"],
-                                                    "СКК": metabolite_data["СКК"],
-                                                    "C0/(C16+C18)": metabolite_data["C0/(C16+C18)"],
-                                                    "CPT-2 Deficiency (NBS)": metabolite_data["CPT-2 Deficiency (NBS)"],
-                                                    "С2/С0": metabolite_data["С2/С0"],
-                                                    "Ratio of Short-Chain to Long-Chain ACs": metabolite_data[
-                                                        "Ratio of Short-Chain to Long-Chain ACs"
-                                                    ],
-                                                    "Ratio of Medium-Chain to Long-Chain ACs": metabolite_data[
-                                                        "Ratio of Medium-Chain to Long-Chain ACs"
-                                                    ],
-                                                    "Ratio of Short-Chain to Medium-Chain ACs": metabolite_data[
-                                                        "Ratio of Short-Chain to Medium-Chain ACs"
-                                                    ],
-                                                    "Sum of ACs": metabolite_data["Sum of ACs"],
-                                                    "Sum of ACs + С0": metabolite_data["Sum of ACs + С0"],
-                                                    "Sum of ACs/C0": metabolite_data["Sum of ACs/C0"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Короткоцепочечные ацилкарнитины",
-                                               metabolite_concentrations= {
-                                                    "C2": metabolite_data["C2"],
-                                                    "C3": metabolite_data["C3"],
-                                                    "C4": metabolite_data["C4"],
-                                                    "C5": metabolite_data["C5"],
-                                                    "C5-1": metabolite_data["C5-1"],
-                                                    "C5-DC": metabolite_data["C5-DC"],
-                                                    "C5-OH": metabolite_data["C5-OH"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Среднецепочечные ацилкарнитины",
-                                               metabolite_concentrations= {
-                                                    "C6": metabolite_data["C6"],
-                                                    "C6-DC": metabolite_data["C6-DC"],
-                                                    "C8": metabolite_data["C8"],
-                                                    "C8-1": metabolite_data["C8-1"],
-                                                    "C10": metabolite_data["C10"],
-                                                    "C10-1": metabolite_data["C10-1"],
-                                                    "C10-2": metabolite_data["C10-2"],
-                                                    "C12": metabolite_data["C12"],
-                                                    "C12-1": metabolite_data["C12-1"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Длинноцепочечные ацилкарнитины",
-                                               metabolite_concentrations= {
-                                                    "C14": metabolite_data["C14"],
-                                                    "C14-1": metabolite_data["C14-1"],
-                                                    "C14-2": metabolite_data["C14-2"],
-                                                    "C14-OH": metabolite_data["C14-OH"],
-                                                    "C16": metabolite_data["C16"],
-                                                    "C16-1": metabolite_data["C16-1"],
-                                                    "C16-1-OH": metabolite_data["C16-1-OH"],
-                                                    "C16-OH": metabolite_data["C16-OH"],
-                                                    "C18": metabolite_data["C18"],
-                                                    "C18-1": metabolite_data["C18-1"],
-                                                    "C18-1-OH": metabolite_data["C18-1-OH"],
-                                                    "C18-2": metabolite_data["C18-2"],
-                                                    "C18-OH": metabolite_data["C18-OH"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                                    st.image(plot_metabolite_z_scores(
-                                                group_title= "Другие метаболиты",
-                                               metabolite_concentrations= {
-                                                    "Pantothenic": metabolite_data["Pantothenic"],
-                                                    "Riboflavin": metabolite_data["Riboflavin"],
-                                                    "Melatonin": metabolite_data["Melatonin"],
-                                                    "Uridine": metabolite_data["Uridine"],
-                                                    "Adenosin": metabolite_data["Adenosin"],
-                                                    "Cytidine": metabolite_data["Cytidine"],
-                                                    "Cortisol": metabolite_data["Cortisol"],
-                                                    "Histamine": metabolite_data["Histamine"],
-                                                },
-                                                ref_stats=create_ref_stats_from_excel(ref_stats_path)))
-                            with cols[1]:
-                                st.header("Старые риски:")
-                                st.dataframe(risk_scores_old.sort_values(by="Метод оценки", ascending=True), hide_index=True,column_order=('Риск-скор', 'Группа риска', 'Метод оценки'))
-                                with st.expander("Показатели по группам:", expanded=True):
-                                    display_group_cards(risk_params_exp_old, risk_scores_old)
-                                
-                                
-                            with cols[2]:
-                                st.header("Z-score:")
-                                st.dataframe(risk_scores.sort_values(by="Метод оценки", ascending=True), hide_index=True,column_order=('Риск-скор', 'Группа риска', 'Метод оценки'))
-                                with st.expander("Показатели по группам:", expanded=True):
-                                    display_group_cards(risk_params_exp_zscore, risk_scores)
-                                
-                    except Exception as e:
-                        st.error(f"An error occurred: {str(e)}")
-                        logging.error(f"Error in report generation: {str(e)}")
+    # Last submitted report, unless it was evicted
+    shown_key = st.session_state.get('report_key')
+    report = reports.get(shown_key) if shown_key is not None else None
+    if report is None:
+        return
+    if current_key != shown_key:
+        st.info("Данные или параметры изменены после расчета. Нажмите «Сформировать отчет», чтобы пересчитать.")
+    if display_report(report):
+        # The sensitivity table grew the report: measure it again against the cap
+        evicted = reports.put(shown_key, report)
+        if evicted:
+            logging.info(f"Evicted {len(evicted)} cached reports, {reports.nbytes / 2**20:.0f} MB kept")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,288 @@
+"""Подбор порогов ML-моделей на размеченной когорте.
+
+The labelled cohort (an export, an archive or a cohort store) is scored once:
+every pipeline returns the raw probability compared with each of its threshold
+constants (threshold_probabilities), and the probabilities are cached next to
+the cohort, keyed by the source file and the model files. A sweep then
+evaluates a whole grid of candidate thresholds at once on the cached arrays:
+sensitivity, specificity, Youden's J and the resulting 0-10 score
+distribution per candidate. No forest is rerun for a new candidate.
+
+Samples whose label (``--label-column``, default Группа) is one of the
+``--positive`` values of a disease are positives, ``--control`` labels are
+negatives, others are left out. For a gated threshold (ONCO's liver stage)
+only samples that pass the gating threshold count. ``--write`` stores the
+chosen thresholds in ``models/<DISEASE>/thresholds.json``, which the registry
+applies to the pipeline class on the next start.
+
+Usage:
+    python threshold_sweep.py cohort.cohort --positive CVD=ИБС,ИМ --positive RA=РА [--out sweep] [--write]
+    python threshold_sweep.py labelled.xlsx --grid 0.3 0.9 0.005 --min-sensitivity 0.9
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from archive_scoring import read_chunks
+from cohort import CohortMatrix
+from cohort_store import is_cohort_store, values_path
+from models.registry import registry, thresholds_path
+from models.scoring import ScoreMapping, probabilities_to_scores
+from scoring_core import calculate_cohort_ratios
+
+CACHE_SUFFIX = ".probabilities.npz"
+READ_CHUNK_ROWS = 10000
+DEFAULT_LABEL_COLUMN = "Группа"
+DEFAULT_CONTROL_LABELS = ("Control",)
+DEFAULT_GRID = (0.05, 0.95, 0.01)
+SCORE_VALUES = np.arange(11)
+
+
+def cache_path(source):
+    return os.path.splitext(source.rstrip(os.sep))[0] + CACHE_SUFFIX
+
+
+def probability_fingerprint(source):
+    """Source file and every model file: the cache is valid while none of them changes"""
+    paths = [values_path(source) if is_cohort_store(source) else source]
+    for spec in registry.specs().values():
+        paths.extend(spec.model_files)
+    fingerprint = {"source": os.path.abspath(source)}
+    for path in paths:
+        stat = os.stat(path)
+        fingerprint[os.path.abspath(path)] = [stat.st_size, stat.st_mtime]
+    return json.dumps(fingerprint, sort_keys=True)
+
+
+def threshold_key(disease_name, threshold_name):
+    return f"{disease_name}.{threshold_name}"
+
+
+def score_probabilities(source, label_column=DEFAULT_LABEL_COLUMN, chunk_rows=READ_CHUNK_ROWS):
+    """(probabilities, labels): samples x DISEASE.THRESHOLD probability table and the label per sample"""
+    parts, labels = [], []
+    for chunk in read_chunks(source, chunk_rows):
+        if isinstance(chunk, CohortMatrix):
+            cohort = chunk
+        else:
+            cohort = calculate_cohort_ratios(CohortMatrix.from_frame(chunk, dtype=np.float64))
+        columns = {}
+        for disease_name in registry.specs():
+            probabilities = registry.get(disease_name).threshold_probabilities(cohort)
+            for threshold_name, values in probabilities.items():
+                columns[threshold_key(disease_name, threshold_name)] = values
+        parts.append(pd.DataFrame(columns, index=pd.Index(cohort.sample_ids.astype(str), name="sample")))
+        chunk_labels = cohort.meta.get("labels", {}).get(label_column)
+        labels.append(pd.Series(chunk_labels if chunk_labels is not None else [None] * len(cohort),
+                                index=parts[-1].index, dtype=object))
+    return pd.concat(parts), pd.concat(labels)
+
+
+def load_probabilities(source, label_column=DEFAULT_LABEL_COLUMN, refresh=False):
+    """Cached probabilities of a cohort; scored and cached on the first call or after a change"""
+    path = cache_path(source)
+    fingerprint = probability_fingerprint(source)
+    if not refresh and os.path.exists(path):
+        with np.load(path, allow_pickle=False) as cached:
+            if str(cached["fingerprint"]) == fingerprint and str(cached["label_column"]) == label_column:
+                index = pd.Index(cached["sample_ids"], name="sample")
+                probabilities = pd.DataFrame(cached["probabilities"], index=index, columns=cached["columns"])
+                labels = pd.Series(cached["labels"], index=index, dtype=object)
+                labels = labels.where(labels != "", None)
+                return probabilities, labels
+
+    start = time.perf_counter()
+    probabilities, labels = score_probabilities(source, label_column)
+    print(f"Scored {len(probabilities)} samples in {time.perf_counter() - start:.1f}s, cached in {path}")
+    tmp_path = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        fingerprint=np.array(fingerprint),
+        label_column=np.array(label_column),
+        sample_ids=probabilities.index.to_numpy(dtype=str),
+        labels=labels.fillna("").astype(str).to_numpy(dtype=str),
+        columns=probabilities.columns.to_numpy(dtype=str),
+        probabilities=probabilities.to_numpy(dtype=np.float64),
+    )
+    os.replace(tmp_path, path)
+    return probabilities, labels
+
+
+def sweep(probabilities, positive, candidates, mapping):
+    """Confusion counts, sensitivity/specificity and score distribution for every candidate at once.
+
+    probabilities are the samples to evaluate, positive their labels (True/False);
+    a sample is flagged when its probability reaches the threshold, as in the score mapping.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    positive = np.asarray(positive, dtype=bool)
+    candidates = np.asarray(candidates, dtype=np.float64)
+
+    flagged = probabilities[None, :] >= candidates[:, None]
+    tp = (flagged & positive).sum(axis=1)
+    fp = (flagged & ~positive).sum(axis=1)
+    fn = positive.sum() - tp
+    tn = (~positive).sum() - fp
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sensitivity = tp / (tp + fn)
+        specificity = tn / (tn + fp)
+
+    table = pd.DataFrame({
+        "threshold": candidates,
+        "tp": tp, "fp": fp, "tn": tn, "fn": fn,
+        "sensitivity": sensitivity,
+        "specificity": specificity,
+        "youden": sensitivity + specificity - 1,
+        "flagged_share": flagged.mean(axis=1) if len(probabilities) else np.nan,
+    })
+    grid_mapping = ScoreMapping(threshold=candidates[:, None], low_slope=mapping.low_slope,
+                                high_slope=mapping.high_slope, decimals=mapping.decimals)
+    scores = probabilities_to_scores(probabilities[None, :], grid_mapping)
+    for value in SCORE_VALUES:
+        table[f"score_{value}"] = (scores == value).sum(axis=1)
+    return table
+
+
+def choose(table, min_sensitivity=None):
+    """Row of the chosen threshold: best Youden's J, or best specificity at the required sensitivity"""
+    if min_sensitivity is not None:
+        eligible = table[table["sensitivity"] >= min_sensitivity]
+        if eligible.empty:
+            return None
+        return eligible.loc[eligible["specificity"].idxmax()]
+    if table["youden"].isna().all():
+        return None
+    return table.loc[table["youden"].idxmax()]
+
+
+def positive_labels(disease_name, threshold_name, positives):
+    """Labels that are positive for a threshold: DISEASE.THRESHOLD entry, DISEASE entry or the disease name"""
+    return positives.get(threshold_key(disease_name, threshold_name),
+                         positives.get(disease_name, (disease_name,)))
+
+
+def sweep_thresholds(probabilities, labels, positives, control_labels=DEFAULT_CONTROL_LABELS,
+                     candidates=None, min_sensitivity=None):
+    """Sweep every threshold of every pipeline; returns {DISEASE.THRESHOLD: (table, current, chosen)}.
+
+    Gated thresholds are swept after their gate, on the samples that pass the chosen gate value.
+    """
+    if candidates is None:
+        candidates = np.round(np.arange(DEFAULT_GRID[0], DEFAULT_GRID[1] + 1e-9, DEFAULT_GRID[2]), 6)
+    results = {}
+    for disease_name, spec in registry.specs().items():
+        pipeline_class = spec.pipeline_class
+        mapping = pipeline_class.score_mapping()
+        gates = pipeline_class.THRESHOLD_GATES
+        order = sorted(spec.thresholds, key=lambda name: name in gates)
+        chosen_values = {}
+        for threshold_name in order:
+            key = threshold_key(disease_name, threshold_name)
+            if key not in probabilities:
+                continue
+            current = spec.thresholds[threshold_name]
+            selected = labels.isin(positive_labels(disease_name, threshold_name, positives)) | labels.isin(control_labels)
+            if threshold_name in gates:
+                gate = gates[threshold_name]
+                gate_value = chosen_values.get(gate, spec.thresholds[gate])
+                selected &= probabilities[threshold_key(disease_name, gate)] >= gate_value
+            positive = labels[selected].isin(positive_labels(disease_name, threshold_name, positives))
+
+            grid = np.union1d(candidates, [current])
+            table = sweep(probabilities.loc[selected, key], positive, grid, mapping)
+            row = choose(table, min_sensitivity)
+            chosen_values[threshold_name] = current if row is None else float(row["threshold"])
+            results[key] = (table, current, row)
+    return results
+
+
+def write_thresholds(disease_name, thresholds, source, criterion):
+    """Store chosen thresholds in models/<DISEASE>/thresholds.json, keeping other entries"""
+    path = thresholds_path(os.path.join(registry.models_dir, disease_name))
+    config = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    config.setdefault("thresholds", {}).update(thresholds)
+    config.update({
+        "source": os.path.basename(source.rstrip(os.sep)),
+        "criterion": criterion,
+        "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def parse_positives(entries):
+    """["CVD=ИБС,ИМ", ...] -> {"CVD": ("ИБС", "ИМ"), ...}"""
+    positives = {}
+    for entry in entries or []:
+        name, _, values = entry.partition("=")
+        if not values:
+            raise ValueError(f"Expected DISEASE=label[,label...], got {entry!r}")
+        positives[name.strip()] = tuple(value.strip() for value in values.split(","))
+    return positives
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep ML model thresholds on a labelled cohort")
+    parser.add_argument("cohort", help="Labelled cohort: export, archive or cohort store")
+    parser.add_argument("--label-column", default=DEFAULT_LABEL_COLUMN)
+    parser.add_argument("--positive", action="append", metavar="DISEASE=LABELS",
+                        help="Positive labels of a disease (or DISEASE.THRESHOLD); default: the disease name")
+    parser.add_argument("--control", nargs="+", default=list(DEFAULT_CONTROL_LABELS), help="Negative labels")
+    parser.add_argument("--grid", type=float, nargs=3, default=list(DEFAULT_GRID), metavar=("START", "STOP", "STEP"))
+    parser.add_argument("--min-sensitivity", type=float,
+                        help="Choose the most specific threshold with at least this sensitivity (default: Youden's J)")
+    parser.add_argument("--out", help="Write one sweep table per threshold (CSV) into this folder")
+    parser.add_argument("--refresh", action="store_true", help="Rescore the cohort even if cached")
+    parser.add_argument("--write", action="store_true", help="Write the chosen thresholds to models/<DISEASE>/thresholds.json")
+    args = parser.parse_args()
+
+    probabilities, labels = load_probabilities(args.cohort, args.label_column, args.refresh)
+    candidates = np.round(np.arange(args.grid[0], args.grid[1] + args.grid[2] / 2, args.grid[2]), 6)
+
+    start = time.perf_counter()
+    results = sweep_thresholds(probabilities, labels, parse_positives(args.positive), args.control,
+                               candidates, args.min_sensitivity)
+    elapsed = time.perf_counter() - start
+    n_candidates = sum(len(table) for table, _, _ in results.values())
+    print(f"Swept {n_candidates} candidates in {elapsed * 1000:.0f} ms "
+          f"({elapsed * 1000 / max(n_candidates, 1):.2f} ms per candidate)")
+
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+    criterion = ("youden" if args.min_sensitivity is None
+                 else f"max specificity at sensitivity >= {args.min_sensitivity:g}")
+    chosen = {}
+    for key, (table, current, row) in results.items():
+        disease_name, threshold_name = key.split(".", 1)
+        now = table.loc[table["threshold"] == current].iloc[0]
+        n_positive, n_negative = int(now["tp"] + now["fn"]), int(now["tn"] + now["fp"])
+        print(f"{key}: current {current:g} (sens {now['sensitivity']:.3f}, spec {now['specificity']:.3f}, "
+              f"{n_positive} positive / {n_negative} negative)")
+        if not n_positive or not n_negative:
+            print("    no positive or no negative samples, kept")
+        elif row is None:
+            print(f"    no threshold reaches sensitivity {args.min_sensitivity:g}, kept")
+        else:
+            print(f"    chosen {row['threshold']:g} (sens {row['sensitivity']:.3f}, spec {row['specificity']:.3f})")
+            chosen.setdefault(disease_name, {})[threshold_name] = float(row["threshold"])
+        if args.out:
+            table.to_csv(os.path.join(args.out, f"{key}.csv"), index=False)
+
+    if args.write:
+        for disease_name, thresholds in chosen.items():
+            path = write_thresholds(disease_name, thresholds, args.cohort, criterion)
+            print(f"Thresholds of {disease_name} written to {path}")
+
+
+if __name__ == "__main__":
+    main()
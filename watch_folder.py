@@ -0,0 +1,301 @@
+"""Папка наблюдения: автоматический расчет выгрузок прибора.
+
+A long-running process polls a folder for instrument exports (Excel or CSV,
+one sample per row). A file is taken only after its size and mtime have not
+changed for ``--settle`` seconds, so exports that are still being written or
+copied are left alone; Excel lock files (``~$...``) and ``*.tmp``/``*.part``
+are ignored. The file is claimed by an atomic rename into ``processing/``,
+scored with the models loaded once at start (ratios, z-scores, banding and
+disease models, as archive_scoring.score_chunk), and its results workbook is
+written next to the archived input in ``done/`` (or into ``--out``). Failed
+files go to ``failed/``. Every poll rewrites ``status.json`` in the folder
+with the queue depth and the throughput in samples per minute; the same
+figures and the scoring latencies are available as Prometheus metrics
+(``--metrics-port`` / ``--metrics-file``, see metrics.py).
+
+Usage:
+    python watch_folder.py /mnt/exports --ref Ref.xlsx [--out results] [--interval 5] [--settle 10]
+    python watch_folder.py /mnt/exports --once
+"""
+import argparse
+import json
+import os
+import time
+import traceback
+from collections import deque
+
+import pandas as pd
+
+import metrics
+
+INPUT_EXTENSIONS = (".xlsx", ".xls", ".csv")
+IGNORED_PREFIXES = ("~$", ".")
+IGNORED_SUFFIXES = (".tmp", ".part", ".crdownload")
+PROCESSING_DIR = "processing"
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+STATUS_NAME = "status.json"
+RESULT_SUFFIX = "_scores.xlsx"
+
+DEFAULT_INTERVAL = 5.0
+DEFAULT_SETTLE = 10.0
+# Window of the samples/min figure
+THROUGHPUT_WINDOW = 600.0
+
+
+def is_export(name):
+    """Instrument export, not a lock file, partial copy or our own output"""
+    lower = name.lower()
+    return (
+        lower.endswith(INPUT_EXTENSIONS)
+        and not lower.startswith(IGNORED_PREFIXES)
+        and not lower.endswith(IGNORED_SUFFIXES)
+        and not lower.endswith(RESULT_SUFFIX)
+        and name != STATUS_NAME
+    )
+
+
+def list_exports(folder):
+    """Export files directly in folder (subfolders are the daemon's own)"""
+    with os.scandir(folder) as entries:
+        return sorted(entry.path for entry in entries if entry.is_file() and is_export(entry.name))
+
+
+class StableFiles:
+    """Files whose size and mtime stayed the same for settle seconds"""
+
+    def __init__(self, settle=DEFAULT_SETTLE):
+        self.settle = settle
+        self._seen = {}  # path -> ((size, mtime), time the signature was first seen)
+
+    def poll(self, paths, now=None):
+        """(ready, waiting) paths; a path is ready once its signature has settled"""
+        now = time.time() if now is None else now
+        ready, waiting = [], []
+        seen = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            previous = self._seen.get(path)
+            since = previous[1] if previous is not None and previous[0] == signature else now
+            seen[path] = (signature, since)
+            if stat.st_size > 0 and now - since >= self.settle and now - stat.st_mtime >= self.settle:
+                ready.append(path)
+            else:
+                waiting.append(path)
+        self._seen = seen
+        return ready, waiting
+
+    def forget(self, path):
+        self._seen.pop(path, None)
+
+
+def unique_path(directory, name):
+    """directory/name, with a counter added if the name is taken"""
+    stem, extension = os.path.splitext(name)
+    path = os.path.join(directory, name)
+    counter = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{stem}.{counter}{extension}")
+        counter += 1
+    return path
+
+
+def claim(path, folder):
+    """Atomically move an export into processing/; None if it vanished or is still locked"""
+    processing = os.path.join(folder, PROCESSING_DIR)
+    os.makedirs(processing, exist_ok=True)
+    target = unique_path(processing, os.path.basename(path))
+    try:
+        os.rename(path, target)
+    except (FileNotFoundError, PermissionError):
+        return None
+    return target
+
+
+def read_export(path):
+    if path.lower().endswith(".csv"):
+        return pd.read_csv(path)
+    return pd.read_excel(path)
+
+
+class Throughput:
+    """Samples per minute over a sliding window"""
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        self.window = window
+        self._events = deque()  # (finish time, samples)
+        self.total_samples = 0
+        self.total_files = 0
+
+    def record(self, n_samples, now=None):
+        self._events.append((time.time() if now is None else now, n_samples))
+        self.total_samples += n_samples
+        self.total_files += 1
+
+    def samples_per_minute(self, now=None):
+        now = time.time() if now is None else now
+        while self._events and now - self._events[0][0] > self.window:
+            self._events.popleft()
+        if not self._events:
+            return 0.0
+        span = max(now - self._events[0][0], 60.0)
+        return sum(n for _, n in self._events) * 60.0 / span
+
+
+def write_status(folder, status):
+    path = os.path.join(folder, STATUS_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(status, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def warm_models():
+    """Load every disease pipeline once, before the first file arrives"""
+    from models.registry import registry
+
+    for disease_name in registry.specs():
+        registry.get(disease_name)
+
+
+class FolderWatcher:
+    """Poll loop state: settled-file tracking, throughput and the scoring inputs"""
+
+    def __init__(self, folder, risk_params, ref_stats, out_dir=None, settle=DEFAULT_SETTLE, **dedupe):
+        self.folder = folder
+        self.risk_params = risk_params
+        self.ref_stats = ref_stats
+        self.out_dir = out_dir
+        self.dedupe = dedupe
+        self.stable = StableFiles(settle)
+        self.throughput = Throughput()
+        self.failed = 0
+        self.last_file = None
+
+    def result_path(self, done_path):
+        stem = os.path.splitext(os.path.basename(done_path))[0]
+        directory = self.out_dir or os.path.dirname(done_path)
+        os.makedirs(directory, exist_ok=True)
+        return unique_path(directory, stem + RESULT_SUFFIX)
+
+    def process(self, claimed):
+        """Score one claimed export; returns the number of samples, None on failure"""
+        from archive_scoring import score_chunk
+        from export_results import export_results
+
+        start = time.perf_counter()
+        name = os.path.basename(claimed)
+        try:
+            frame = read_export(claimed)
+            results = score_chunk(frame, self.risk_params, self.ref_stats, **self.dedupe)
+            done_dir = os.path.join(self.folder, DONE_DIR)
+            os.makedirs(done_dir, exist_ok=True)
+            done_path = unique_path(done_dir, name)
+            result_path = self.result_path(done_path)
+            tmp_path = result_path[:-len(".xlsx")] + ".tmp.xlsx"
+            export_results(results, tmp_path)
+            os.replace(tmp_path, result_path)
+            os.replace(claimed, done_path)
+        except Exception as e:
+            print(f"Failed to score {name}: {str(e)}")
+            traceback.print_exc()
+            failed_dir = os.path.join(self.folder, FAILED_DIR)
+            os.makedirs(failed_dir, exist_ok=True)
+            os.replace(claimed, unique_path(failed_dir, name))
+            self.failed += 1
+            return None
+
+        n_samples = len(frame)
+        self.throughput.record(n_samples)
+        self.last_file = name
+        print(f"{name}: {n_samples} samples in {time.perf_counter() - start:.1f}s -> {result_path}")
+        return n_samples
+
+    def status(self, waiting, ready):
+        metrics.QUEUE_DEPTH.set(len(waiting) + len(ready))
+        return {
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "queue_depth": len(waiting) + len(ready),
+            "waiting_to_settle": len(waiting),
+            "samples_per_minute": round(self.throughput.samples_per_minute(), 1),
+            "files_done": self.throughput.total_files,
+            "samples_done": self.throughput.total_samples,
+            "files_failed": self.failed,
+            "last_file": self.last_file,
+        }
+
+    def recover(self):
+        """Exports left in processing/ by an interrupted run are scored first"""
+        processing = os.path.join(self.folder, PROCESSING_DIR)
+        if os.path.isdir(processing):
+            for path in list_exports(processing):
+                print(f"Resuming {os.path.basename(path)} from an interrupted run")
+                self.process(path)
+
+    def poll_once(self):
+        """Score every settled export once; returns the status written"""
+        ready, waiting = self.stable.poll(list_exports(self.folder))
+        for i, path in enumerate(ready):
+            write_status(self.folder, self.status(waiting, ready[i:]))
+            self.stable.forget(path)
+            claimed = claim(path, self.folder)
+            if claimed is not None:
+                self.process(claimed)
+        status = self.status(waiting, [])
+        write_status(self.folder, status)
+        return status
+
+    def run(self, interval=DEFAULT_INTERVAL, once=False):
+        self.recover()
+        while True:
+            status = self.poll_once()
+            if once and not status["queue_depth"]:
+                return status
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score instrument exports as they appear in a folder")
+    parser.add_argument("folder", help="Folder the instrument writes its exports to")
+    parser.add_argument("--ref", default="Ref.xlsx", help="Reference workbook (Params_metaboscan, Ref_stats)")
+    parser.add_argument("--out", help="Results folder (default: next to the input in done/)")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="Seconds between polls")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE,
+                        help="Seconds a file must stay unchanged before it is taken")
+    parser.add_argument("--dedupe", action="store_true", help="Score identical sample rows once")
+    parser.add_argument("--once", action="store_true", help="Exit once the folder is empty")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this local port")
+    parser.add_argument("--metrics-file", help="Rewrite Prometheus metrics into this file periodically")
+    args = parser.parse_args()
+
+    from scoring_core import read_ref_stats
+
+    metrics.configure_from_env()
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    if args.metrics_file:
+        metrics.start_textfile_writer(args.metrics_file)
+
+    risk_params = pd.read_excel(args.ref, sheet_name="Params_metaboscan")
+    ref_stats = read_ref_stats(args.ref, sheet_name="Ref_stats")
+    warm_models()
+
+    watcher = FolderWatcher(args.folder, risk_params, ref_stats, out_dir=args.out,
+                            settle=args.settle, dedupe=args.dedupe)
+    print(f"Watching {os.path.abspath(args.folder)} every {args.interval:g}s")
+    try:
+        status = watcher.run(interval=args.interval, once=args.once)
+    except KeyboardInterrupt:
+        status = watcher.status([], [])
+    if args.metrics_file:
+        metrics.write_textfile(args.metrics_file)
+    print(f"Scored {status['samples_done']} samples from {status['files_done']} files, "
+          f"{status['files_failed']} failed")
+
+
+if __name__ == "__main__":
+    main()